@@ -0,0 +1,3862 @@
+#!/usr/bin/env python3
+"""Compress a single balenaOS raw disk image into concatenatable DEFLATE parts.
+
+Port of the ``prepareRawImage`` / ``cacheRawImageParts`` logic from the upstream
+balena-img ``prepare.ts`` script, reduced to act on one explicit ``.img`` file
+with no path-prefix walking, no S3 upload and no intel-edison handling.
+
+The image is split into "parts" at partition boundaries (with gap parts for the
+space between/around partitions). Each part is compressed as a raw DEFLATE stream
+terminated by an empty sync block (``00 00 ff ff``) so the parts can be
+concatenated, topped with a gzip header and footer, into a single valid gzip
+stream. This is the format consumed by etcher-sdk's BalenaS3CompressedSource,
+which re-appends the DEFLATE end marker (``03 00``) before inflating.
+
+Outputs, written under the chosen output directory:
+  - ``compressed{suffix}/part-N.deflate`` for each part
+  - ``image{suffix}.json`` manifest:
+        {"resin.img": {"parts": [{filename, crc, len, zLen, partitionIndex?}]}}
+
+Parts are independent DEFLATE streams, so ``--jobs N`` compresses up to N of
+them concurrently on a thread pool (zlib releases the GIL while it works). The
+manifest and part files are identical to the serial (``--jobs 1``) output.
+``--block-size`` additionally splits each part pigz-style into blocks that are
+compressed concurrently, each primed with the preceding 32 KiB as a dictionary
+and ended on a sync flush; the part is still one concatenatable DEFLATE stream
+with the same crc/len, only its compressed bytes differ.
+
+Zero runs (holes in sparse images found via ``SEEK_DATA``/``SEEK_HOLE``, and
+all-zero chunks) bypass zlib: their DEFLATE comes from a replicated template
+and their crc is advanced arithmetically, so empty space is nearly free.
+
+``--policy tuned`` / ``--auto`` pick the zlib level and strategy per part
+(by fixed rules, or by compressing samples of the part with each candidate) and
+record the choices in an ``image{suffix}.stats.json`` sidecar. ``--stats`` adds
+per-part byte counts and read/crc32/compress/write timings to that sidecar, and
+``--progress FILE`` streams JSON-lines part events for live CI progress.
+
+Compressed (gzip/xz/bzip2) images and ``-`` (stdin) are streamed: the
+partition table is read from the head of the stream and the parts are produced
+in one sequential pass with bounded memory, with no temporary ``.img``.
+
+``--max-part-size MIB`` cuts large partitions into several consecutive
+parts that share the partition's ``partitionIndex``, for more parallelism in
+producing, transferring and inflating them.
+
+Several ``IMAGE:TYPE`` arguments (e.g. the main, flasher and raw variants)
+are prepared in one run, with all their parts scheduled on the same pool.
+
+``--read-ahead N`` / ``--write-behind N`` pipeline reading, compression and
+writing on separate threads through bounded queues, with prefetch hints, a
+ring of reused read buffers and coalesced, preallocated writes.
+
+``--index-interval MIB`` full-flushes each part about every MIB MiB and records
+the restart points in an ``image{suffix}.index.json`` sidecar; inflate_from
+and read_part_range then start inflating a part from the nearest point, for
+resumed downloads and random access.
+
+``--prime-parts`` primes each part's compressor with the 32 KiB of the image
+before it (read from the image, so parts still compress concurrently and
+cache independently): consumers inflate the concatenated parts as one stream
+and already hold that window, so a part's first bytes can refer back into the
+previous part. Such parts are marked ``primed`` in the manifest and only
+inflate standalone with that window.
+
+``--bmap`` writes an ``image{suffix}.bmap`` block map (bmaptool format 2.0)
+of the blocks holding non-zero data, with a SHA-256 per range, from the holes
+and zero checks of the compression pass, so flashers can skip empty space.
+
+``--zero-free`` reads the block bitmaps of ext2/3/4 partitions and the
+allocation table of FAT partitions and compresses their free blocks as zeros,
+as if the image had been through zerofree, without a separate pass.
+
+``--cache-dir`` keeps a content-addressed cache of compressed parts keyed by
+the part bytes and compression settings, so partitions that did not change
+between builds are linked from the cache instead of recompressed. A probe key
+of each part's first and last MiB tells likely hits, which are read once for
+their key, from misses, which are hashed as they are compressed.
+
+``--chunk-hash-size MIB`` hashes each part in MIB MiB chunks (SHA-256) as it
+is compressed and writes them to an ``image{suffix}.hashes.json`` sidecar;
+``prepare-image.py diff OLD.hashes.json NEW.hashes.json`` reports the byte
+ranges of the new image that differ from the old one, for delta updates.
+
+``--gzip`` also writes ``image{suffix}.img.gz``: the parts copied between a
+gzip header and ``03 00`` plus a footer whose crc is combined from the part
+crcs (write_gzip), so a downloadable .img.gz needs no second compression pass.
+``--digests sha256,md5`` digests the whole image, every part file and the
+.img.gz while they are produced, into an ``image{suffix}.digests.json`` sidecar.
+
+``prepare-image.py verify image{suffix}.json [--image IMG]`` inflates the
+parts in parallel and checks their crc, len, zLen and sync marker against the
+manifest, and optionally that they reproduce the original image.
+
+This module is importable (``import prepare_image``; get_partitions,
+plan_parts, compress_range, prepare_raw_image and friends) and has no side
+effects on import or when its functions are called; ``prepare-image.py`` next
+to it is the command-line wrapper, which alone sets the build's umask.
+``prepare-image.py worker`` keeps a worker pool up and prepares images as jobs
+arrive, as JSON lines on stdin or as images landing in a ``--watch``ed
+directory, each prepared into its own ``NAME.prepared/`` directory.
+
+Dependencies: Python 3 standard library only (zlib, struct, json, argparse).
+"""
+
+import argparse
+import bisect
+import bz2
+import collections
+import concurrent.futures
+import contextlib
+import ctypes
+import errno
+import fnmatch
+import functools
+import gzip
+import hashlib
+import itertools
+import json
+import lzma
+import math
+import mmap
+import os
+import queue
+import shutil
+import struct
+import sys
+import threading
+import time
+import zlib
+
+SECTOR_SIZE = 512
+# MBR partition types that denote an extended (container) partition.
+EXTENDED_TYPES = {0x05, 0x0F, 0x85}
+GPT_PROTECTIVE_MBR_TYPE = 0xEE
+MBR_FIRST_LOGICAL_PARTITION = 5
+# Guard against malformed/looping EBR chains.
+MAX_LOGICAL_PARTITIONS = 256
+# Read size when streaming a part through the compressor.
+CHUNK_SIZE = 1 << 20  # 1 MiB
+# Minimum write size, and largest preallocation step, of a part written behind.
+WRITE_SIZE = 4 << 20  # 4 MiB
+PREALLOCATE_SIZE = 64 << 20  # 64 MiB
+# DEFLATE history window; a block primed with this much preceding data can
+# back-reference anything the inflater still has in its window.
+WINDOW_SIZE = 1 << 15  # 32 KiB
+# Empty final DEFLATE block; the consumer appends this before inflating.
+DEFLATE_END = b"\x03\x00"
+
+
+# --- functional core: partition parsing ------------------------------------
+
+
+def _read_at(f, offset, size):
+    f.seek(offset)
+    buf = f.read(size)
+    if len(buf) != size:
+        raise ValueError(f"Short read at offset {offset}: wanted {size}, got {len(buf)}")
+    return buf
+
+
+def _partition(start, size, index):
+    """Build a partition record (inclusive end byte) shared by the MBR/GPT parsers."""
+    return {"start": start, "end": start + size - 1, "size": size, "index": index}
+
+
+def _mbr_entries(buf):
+    """Return the (slot-order, type != 0) MBR partition entries from a 512B sector.
+
+    Mirrors partitioninfo's ``getPartitionsFromMBRBuf`` which filters out empty
+    (type 0) slots while preserving order. Each entry is a dict with the raw
+    relative LBA offset and size in sectors plus the partition type byte.
+    """
+    entries = []
+    for i in range(4):
+        base = 446 + i * 16
+        ptype = buf[base + 4]
+        lba_start, num_sectors = struct.unpack_from("<II", buf, base + 8)
+        if ptype != 0:
+            entries.append(
+                {"type": ptype, "lba_start": lba_start, "num_sectors": num_sectors}
+            )
+    return entries
+
+
+def _ebr_partitions(buf, index, offset, extended_base):
+    """Parse one EBR sector read from absolute byte ``offset``.
+
+    Returns (logical partitions, absolute offset of the next EBR or None).
+    Entries after the link to the next EBR are ignored, as partitioninfo does.
+    """
+    result = []
+    for p in _mbr_entries(buf):
+        if p["type"] not in EXTENDED_TYPES:
+            start = offset + p["lba_start"] * SECTOR_SIZE
+            size = p["num_sectors"] * SECTOR_SIZE
+            result.append(_partition(start, size, index))
+        else:
+            return result, extended_base + p["lba_start"] * SECTOR_SIZE
+    return result, None
+
+
+def _logical_partitions(f, index, offset, extended_base, limit):
+    """Walk the EBR chain of an extended partition.
+
+    ``offset`` is the absolute byte offset of the current EBR. ``extended_base``
+    is the absolute byte offset of the extended container (the base against which
+    next-EBR links are resolved). Mirrors partitioninfo's ``getLogicalPartitions``.
+    """
+    result = []
+    while offset is not None and limit > 0:
+        buf = _read_at(f, offset, SECTOR_SIZE)
+        found, offset = _ebr_partitions(buf, index, offset, extended_base)
+        result.extend(found)
+        index += 1
+        limit -= 1
+    return result
+
+
+def _mbr_primaries(f):
+    """Return (primary partitions, extended container entry or None) of an MBR."""
+    entries = _mbr_entries(_read_at(f, 0, SECTOR_SIZE))
+    partitions = []
+    extended = None
+    for i, p in enumerate(entries):
+        index = i + 1
+        if p["type"] in EXTENDED_TYPES:
+            extended = p
+            continue  # includeExtended: false
+        start = p["lba_start"] * SECTOR_SIZE
+        size = p["num_sectors"] * SECTOR_SIZE
+        partitions.append(_partition(start, size, index))
+    return partitions, extended
+
+
+def _parse_mbr(f):
+    """Parse an MBR partition table (primaries + logical, extended excluded)."""
+    partitions, extended = _mbr_primaries(f)
+    if extended is not None:
+        extended_base = extended["lba_start"] * SECTOR_SIZE
+        partitions.extend(
+            _logical_partitions(
+                f,
+                MBR_FIRST_LOGICAL_PARTITION,
+                extended_base,
+                extended_base,
+                MAX_LOGICAL_PARTITIONS,
+            )
+        )
+    return partitions
+
+
+def _parse_gpt(f, block_size):
+    """Parse a GPT at the given block size. Returns partitions or None on mismatch."""
+    header = _read_at(f, block_size, 92)
+    if header[:8] != b"EFI PART":
+        return None
+    entries_lba, num_entries, entry_size = struct.unpack_from("<QII", header, 72)
+    # The entry array is contiguous; read it in one shot and slice, rather than a
+    # seek+read syscall per entry (num_entries is 128 by default).
+    table = _read_at(f, entries_lba * block_size, num_entries * entry_size)
+    partitions = []
+    for i in range(num_entries):
+        entry = table[i * entry_size : (i + 1) * entry_size]
+        type_guid = entry[:16]
+        if type_guid == b"\x00" * 16:
+            continue  # unused entry slot
+        first_lba, last_lba = struct.unpack_from("<QQ", entry, 32)
+        start = first_lba * block_size
+        size = (last_lba - first_lba + 1) * block_size
+        partitions.append(_partition(start, size, i + 1))
+    return partitions
+
+
+def get_partitions(f):
+    """Return partitions sorted by disk position (start offset), matching
+    partitioninfo's index numbering and etcher-sdk's getDiskSizeAndPartitions."""
+    mbr_entries = _mbr_entries(_read_at(f, 0, SECTOR_SIZE))
+    if mbr_entries and mbr_entries[0]["type"] == GPT_PROTECTIVE_MBR_TYPE:
+        # Block size may be 512/1024/2048/4096; the GPT header follows the
+        # (protective) first block, so probe each candidate.
+        for block_size in (512, 1024, 2048, 4096):
+            partitions = _parse_gpt(f, block_size)
+            if partitions is not None:
+                return sorted(partitions, key=lambda p: p["start"])
+        raise ValueError("Protective MBR present but no valid GPT header found")
+    return sorted(_parse_mbr(f), key=lambda p: p["start"])
+
+
+# --- functional core: filesystem free space --------------------------------
+
+EXT_SUPERBLOCK_OFFSET = 1024
+EXT_MAGIC = 0xEF53
+# Incompat features after which the free-block bitmaps cannot be trusted as
+# read (journal needs recovery) or are found elsewhere (meta_bg).
+EXT_INCOMPAT_RECOVER = 0x4
+EXT_INCOMPAT_META_BG = 0x10
+EXT_INCOMPAT_64BIT = 0x80
+EXT_COMPAT_SPARSE_SUPER2 = 0x200
+EXT_RO_COMPAT_SPARSE_SUPER = 0x1
+# Either ro_compat feature makes the BLOCK_UNINIT group flag meaningful.
+EXT_RO_COMPAT_GDT_CSUM = 0x10
+EXT_RO_COMPAT_METADATA_CSUM = 0x400
+EXT_BG_BLOCK_UNINIT = 0x2
+
+
+def _clear_bit_runs(bitmap, nbits):
+    """Return (first, count) for each run of clear bits among the first ``nbits``
+    bits of ``bitmap`` (bit i is bit i % 8 of byte i // 8, as in ext4 and FAT)."""
+    free = ~int.from_bytes(bitmap, "little") & ((1 << nbits) - 1)
+    runs = []
+    pos = 0
+    while free:
+        skip = (free & -free).bit_length() - 1
+        free >>= skip
+        pos += skip
+        count = ((free + 1) & ~free).bit_length() - 1
+        runs.append((pos, count))
+        free >>= count
+        pos += count
+    return runs
+
+
+def _ext_has_super(group, sparse):
+    """Whether ``group`` holds a superblock backup (groups 0, 1 and powers of
+    3, 5 and 7 with sparse_super; all of them without)."""
+    if not sparse or group <= 1:
+        return True
+    for base in (3, 5, 7):
+        n = base
+        while n < group:
+            n *= base
+        if n == group:
+            return True
+    return False
+
+
+def _ext_free_ranges(f, start, end):
+    """Free blocks of an ext2/3/4 filesystem at ``start``, or None if there is none.
+
+    Reads the group descriptors and each group's block bitmap. The bitmap of
+    a BLOCK_UNINIT group is rebuilt from its metadata, as the kernel does: the
+    superblock and descriptor backups and any of its own bitmaps and inode
+    table, the rest being free. A filesystem that needs journal recovery or
+    uses meta_bg is skipped, as are BLOCK_UNINIT groups under sparse_super2.
+    """
+    sb = _read_at(f, start + EXT_SUPERBLOCK_OFFSET, 1024)
+    if struct.unpack_from("<H", sb, 0x38)[0] != EXT_MAGIC:
+        return None
+    blocks_lo, _reserved, _free, _inodes, first_data_block, log_block_size = (
+        struct.unpack_from("<IIIIII", sb, 0x4)
+    )
+    blocks_per_group = struct.unpack_from("<I", sb, 0x20)[0]
+    inodes_per_group = struct.unpack_from("<I", sb, 0x28)[0]
+    compat, incompat, ro_compat = struct.unpack_from("<III", sb, 0x5C)
+    inode_size = struct.unpack_from("<H", sb, 0x58)[0] or 128
+    reserved_gdt = struct.unpack_from("<H", sb, 0xCE)[0]
+    if incompat & (EXT_INCOMPAT_RECOVER | EXT_INCOMPAT_META_BG):
+        return []
+    block_size = 1024 << log_block_size
+    if block_size > 65536 or not 0 < blocks_per_group <= 8 * block_size:
+        return []
+    blocks_count = blocks_lo
+    desc_size = 32
+    if incompat & EXT_INCOMPAT_64BIT:
+        blocks_count |= struct.unpack_from("<I", sb, 0x150)[0] << 32
+        desc_size = max(32, struct.unpack_from("<H", sb, 0xFE)[0])
+    size = end - start + 1
+    if blocks_count * block_size > size or blocks_count <= first_data_block:
+        return []
+    uninit_flag = ro_compat & (EXT_RO_COMPAT_GDT_CSUM | EXT_RO_COMPAT_METADATA_CSUM)
+    sparse = ro_compat & EXT_RO_COMPAT_SPARSE_SUPER
+
+    groups = -(-(blocks_count - first_data_block) // blocks_per_group)
+    gdt_blocks = -(-groups * desc_size // block_size)
+    table_blocks = -(-inodes_per_group * inode_size // block_size)
+    table = _read_at(f, start + (first_data_block + 1) * block_size, groups * desc_size)
+    ranges = []
+    for group in range(groups):
+        desc = table[group * desc_size : (group + 1) * desc_size]
+        block_bitmap, inode_bitmap, inode_table = struct.unpack_from("<III", desc)
+        flags = struct.unpack_from("<H", desc, 0x12)[0]
+        if desc_size >= 64:
+            hi = struct.unpack_from("<III", desc, 0x20)
+            block_bitmap |= hi[0] << 32
+            inode_bitmap |= hi[1] << 32
+            inode_table |= hi[2] << 32
+        if not 0 < block_bitmap < blocks_count:
+            return []  # corrupt descriptor: trust nothing
+        first = first_data_block + group * blocks_per_group
+        nbits = min(blocks_per_group, blocks_count - first)
+        if uninit_flag and flags & EXT_BG_BLOCK_UNINIT:
+            if compat & EXT_COMPAT_SPARSE_SUPER2:
+                continue
+            used = 0
+            if _ext_has_super(group, sparse):
+                used = (1 << (1 + gdt_blocks + reserved_gdt)) - 1
+            for block, count in (
+                (block_bitmap, 1),
+                (inode_bitmap, 1),
+                (inode_table, table_blocks),
+            ):
+                lo = max(block, first) - first
+                hi = min(block + count, first + nbits) - first
+                if lo < hi:
+                    used |= ((1 << (hi - lo)) - 1) << lo
+            used &= (1 << nbits) - 1
+            bitmap = used.to_bytes((nbits + 7) // 8, "little")
+        else:
+            bitmap = _read_at(f, start + block_bitmap * block_size, (nbits + 7) // 8)
+        for bit, count in _clear_bit_runs(bitmap, nbits):
+            ranges.append((start + (first + bit) * block_size, count * block_size))
+    return ranges
+
+
+def _fat_free_ranges(f, start, end):
+    """Free clusters of a FAT12/16/32 filesystem at ``start``, or None if there is
+    none. Reads the first copy of the allocation table."""
+    boot = _read_at(f, start, SECTOR_SIZE)
+    if boot[510:512] != b"\x55\xaa" or boot[0] not in (0xEB, 0xE9):
+        return None
+    if boot[54:57] != b"FAT" and boot[82:87] != b"FAT32":
+        return None
+    sector_size, per_cluster, reserved, fats, root_entries, total16 = (
+        struct.unpack_from("<HBHBHH", boot, 11)
+    )
+    fat_size = struct.unpack_from("<H", boot, 22)[0]
+    total32, fat_size32 = struct.unpack_from("<II", boot, 32)
+    fat_size = fat_size or fat_size32
+    total = total16 or total32
+    if (
+        sector_size not in (512, 1024, 2048, 4096)
+        or per_cluster not in (1, 2, 4, 8, 16, 32, 64, 128)
+        or not (reserved and fats and fat_size)
+        or total * sector_size > end - start + 1
+    ):
+        return []
+    root_sectors = -(-root_entries * 32 // sector_size)
+    data_sector = reserved + fats * fat_size + root_sectors
+    if data_sector >= total:
+        return []
+    clusters = (total - data_sector) // per_cluster
+    table = _read_at(f, start + reserved * sector_size, fat_size * sector_size)
+    if clusters < 4085:
+        entry_bits = 12
+    elif clusters < 65525:
+        entry_bits = 16
+    else:
+        entry_bits = 32
+    if len(table) * 8 < (clusters + 2) * entry_bits:
+        return []
+
+    # A cluster is free when its table entry is 0 (the top nibble of a FAT32
+    # entry is reserved). Clusters 0 and 1 are not clusters.
+    if entry_bits == 12:
+        entries = []
+        for n in range(clusters + 2):
+            pair = table[n * 3 // 2] | table[n * 3 // 2 + 1] << 8
+            entries.append(pair >> 4 if n & 1 else pair & 0xFFF)
+    elif entry_bits == 16:
+        entries = struct.unpack_from(f"<{clusters + 2}H", table)
+    else:
+        entries = [
+            n & 0x0FFFFFFF for n in struct.unpack_from(f"<{clusters + 2}I", table)
+        ]
+    bitmap = bytearray((clusters + 7) // 8)
+    for n in range(clusters):
+        if entries[n + 2]:
+            bitmap[n // 8] |= 1 << (n % 8)
+    cluster_size = per_cluster * sector_size
+    data = start + data_sector * sector_size
+    return [
+        (data + first * cluster_size, count * cluster_size)
+        for first, count in _clear_bit_runs(bitmap, clusters)
+    ]
+
+
+def free_ranges(f, start, end):
+    """Return the free (offset, length) ranges of the filesystem in [start, end].
+
+    Supports ext2/3/4 (block bitmaps) and FAT12/16/32 (allocation table). The
+    ranges are absolute and sorted; unknown or unreadable filesystems have no
+    free ranges, so they are compressed as they are.
+    """
+    for parse in (_ext_free_ranges, _fat_free_ranges):
+        try:
+            ranges = parse(f, start, end)
+        except (ValueError, struct.error):
+            return []
+        if ranges is not None:
+            return ranges
+    return []
+
+
+def _clip_ranges(ranges, start, end):
+    """The parts of sorted (offset, length) ``ranges`` inside [start, end]."""
+    clipped = []
+    for offset, length in ranges:
+        lo, hi = max(offset, start), min(offset + length, end + 1)
+        if lo < hi:
+            clipped.append((lo, hi - lo))
+    return clipped
+
+
+# --- functional core: part planning ----------------------------------------
+
+
+def split_part(part, max_part_size=0):
+    """Split a planned part into consecutive parts of at most ``max_part_size``.
+
+    The cuts fall on multiples of ``max_part_size`` (itself a multiple of
+    CHUNK_SIZE) from the part's start, and every piece keeps the part's
+    partition_index. A ``max_part_size`` of 0 keeps the part whole.
+    """
+    if max_part_size % CHUNK_SIZE:
+        raise ValueError(f"max_part_size must be a multiple of {CHUNK_SIZE}")
+    if not max_part_size or part["end"] - part["start"] < max_part_size:
+        return [part]
+    pieces = []
+    for start in range(part["start"], part["end"] + 1, max_part_size):
+        end = min(start + max_part_size - 1, part["end"])
+        pieces.append({**part, "start": start, "end": end})
+    return pieces
+
+
+def plan_parts(partitions, size, max_part_size=0):
+    """Produce the ordered list of byte ranges to cache.
+
+    Emits a gap part for space before each partition, a partition part for each
+    partition (carrying its index), and a trailing gap part if the last
+    partition ends before EOF. Mirrors cacheRawImageParts' loop. With
+    ``max_part_size``, larger parts are then cut up by split_part.
+    """
+    parts = []
+    last_end = -1
+    for partition in partitions:
+        if partition["start"] != last_end + 1:
+            parts.append({"start": last_end + 1, "end": partition["start"] - 1})
+        parts.append(
+            {
+                "start": partition["start"],
+                "end": partition["end"],
+                "partition_index": partition["index"],
+            }
+        )
+        last_end = partition["end"]
+    if last_end != size - 1:
+        parts.append({"start": last_end + 1, "end": size - 1})
+    return [piece for part in parts for piece in split_part(part, max_part_size)]
+
+
+# --- functional core: crc32 combination -----------------------------------
+
+
+def _gf2_matrix_times(mat, vec):
+    result = 0
+    i = 0
+    while vec:
+        if vec & 1:
+            result ^= mat[i]
+        vec >>= 1
+        i += 1
+    return result
+
+
+def _gf2_matrix_square(mat):
+    return [_gf2_matrix_times(mat, mat[n]) for n in range(32)]
+
+
+@functools.lru_cache(maxsize=None)
+def _crc32_zeros_operator(k):
+    """The GF(2) operator that feeds 2**k zero bytes through a CRC-32 register.
+
+    Squared from the previous power, once per process: crc32_combine then only
+    applies one cached operator per set bit of its length.
+    """
+    if k:
+        return tuple(_gf2_matrix_square(_crc32_zeros_operator(k - 1)))
+    # Operator for one zero bit: the CRC-32 polynomial, then shifts.
+    mat = [0xEDB88320] + [1 << n for n in range(31)]
+    for _ in range(3):  # two, four, eight zero bits
+        mat = _gf2_matrix_square(mat)
+    return tuple(mat)
+
+
+def crc32_combine(crc1, crc2, len2):
+    """Return crc32(A + B) given crc1 = crc32(A), crc2 = crc32(B) and len(B).
+
+    Port of zlib's ``crc32_combine`` (not exposed by Python's zlib module):
+    applies len2 zero bytes to crc1 with the cached power-of-two operators of
+    _crc32_zeros_operator, so the (fixed) block lengths of a block-parallel
+    part cost one or two GF(2) matrix products each.
+    """
+    k = 0
+    while len2 > 0:
+        if len2 & 1:
+            crc1 = _gf2_matrix_times(_crc32_zeros_operator(k), crc1)
+        len2 >>= 1
+        k += 1
+    return (crc1 ^ crc2) & 0xFFFFFFFF
+
+
+# Zero runs up to this long are crc'd by zlib; past it, the at most one cached
+# operator per bit of crc32_combine is cheaper.
+ZLIB_ZEROS_SIZE = 128 << 10  # 128 KiB
+
+
+def crc32_zeros(crc, length):
+    """Return crc32(A + b"\\0" * length) given crc = crc32(A).
+
+    Up to ZLIB_ZEROS_SIZE zeros, zlib.crc32 over the shared zero chunk is
+    cheaper than the pure-Python combine below (and releases the GIL). Longer
+    runs apply the combine operators, whose cost grows with log(length):
+    CRC-32 pre/post-inverts its register, so appending zeros is the operator
+    applied to the inverted crc against an all-ones "crc2".
+    """
+    if length <= ZLIB_ZEROS_SIZE:
+        return zlib.crc32(memoryview(_ZERO_CHUNK)[:length], crc) if length else crc
+    return crc32_combine(crc ^ 0xFFFFFFFF, 0xFFFFFFFF, length)
+
+
+# --- imperative shell: instrumentation -------------------------------------
+
+# Phases timed per part when instrumentation is on.
+TIMED_PHASES = ("read", "crc32", "hash", "compress", "write")
+# Emit a progress event for a part every time this many more bytes are done.
+PROGRESS_INTERVAL = 64 << 20  # 64 MiB
+
+
+def _timed(fn, timings, phase):
+    """Wrap ``fn`` to add its wall time to ``timings[phase]``.
+
+    Returns ``fn`` itself when ``timings`` is None, so disabled instrumentation
+    costs nothing in the hot loop.
+    """
+    if timings is None:
+        return fn
+
+    def timed(*args):
+        began = time.perf_counter()
+        try:
+            return fn(*args)
+        finally:
+            timings[phase] += time.perf_counter() - began
+
+    return timed
+
+
+def _timed_iter(iterable, timings, phase):
+    """Like _timed, for the time spent producing each item of ``iterable``."""
+    if timings is None:
+        return iterable
+
+    def timed():
+        iterator = iter(iterable)
+        while True:
+            began = time.perf_counter()
+            item = next(iterator, None)
+            timings[phase] += time.perf_counter() - began
+            if item is None:
+                return
+            yield item
+
+    return timed()
+
+
+# --- imperative shell: compression + output --------------------------------
+
+_ZERO_CHUNK = bytes(CHUNK_SIZE)
+
+
+def _is_zero(chunk):
+    # bytes.startswith memcmps any buffer (bytes or a memoryview, unlike ==
+    # which unpacks memoryviews element by element) and stops at the first
+    # non-zero byte, so real data is rejected almost immediately.
+    view = memoryview(chunk)
+    for pos in range(0, len(view), CHUNK_SIZE):
+        if not _ZERO_CHUNK.startswith(view[pos : pos + CHUNK_SIZE]):
+            return False
+    return True
+
+
+def _data_segments(f, start, end):
+    """Split [start, end] into (offset, length, is_data) runs via SEEK_DATA/SEEK_HOLE.
+
+    Holes read back as zeros, so they never need to be read. Falls back to one
+    data segment for objects without a real fd or filesystems without hole
+    support. The fd offset is restored so ``f``'s read buffer stays coherent.
+    """
+    stop = end + 1
+    try:
+        fd = f.fileno()
+        saved = os.lseek(fd, 0, os.SEEK_CUR)
+    except (AttributeError, OSError):
+        return [(start, stop - start, True)]
+    segments = []
+    pos = start
+    try:
+        while pos < stop:
+            try:
+                data = min(os.lseek(fd, pos, os.SEEK_DATA), stop)
+            except OSError as e:
+                if e.errno != errno.ENXIO:
+                    raise
+                data = stop  # no data past pos: the rest is a hole
+            if data > pos:
+                segments.append((pos, data - pos, False))
+            if data >= stop:
+                break
+            hole = min(os.lseek(fd, data, os.SEEK_HOLE), stop)
+            segments.append((data, hole - data, True))
+            pos = hole
+    except (AttributeError, OSError):
+        segments = [(start, stop - start, True)]
+    finally:
+        os.lseek(fd, saved, os.SEEK_SET)
+    return segments
+
+
+def _mask_free(segments, free):
+    """Turn the ``free`` (offset, length) ranges of ``segments`` into zero runs.
+
+    Both lists are sorted; adjacent zero runs are merged.
+    """
+    masked = []
+
+    def add(offset, length, is_data):
+        if masked and not is_data and not masked[-1][2]:
+            offset, length = masked[-1][0], length + masked[-1][1]
+            masked.pop()
+        masked.append((offset, length, is_data))
+
+    i = 0
+    for offset, length, is_data in segments:
+        pos, stop = offset, offset + length
+        while is_data and i < len(free) and free[i][0] < stop:
+            lo = max(free[i][0], pos)
+            hi = min(free[i][0] + free[i][1], stop)
+            if lo < hi:
+                if lo > pos:
+                    add(pos, lo - pos, True)
+                add(lo, hi - lo, False)
+                pos = hi
+            if free[i][0] + free[i][1] > stop:
+                break
+            i += 1
+        if pos < stop:
+            add(pos, stop - pos, is_data)
+    return masked
+
+
+def _read_chunks(f, offset, length, chunk_size):
+    """Buffered reads: a fresh ``bytes`` per chunk. A None length reads to EOF."""
+    f.seek(offset)
+    while length is None or length > 0:
+        chunk = f.read(chunk_size if length is None else min(chunk_size, length))
+        if not chunk:
+            return
+        if length is not None:
+            length -= len(chunk)
+        yield chunk
+
+
+def _mmap_chunks(f, offset, length, chunk_size):
+    """Zero-copy reads: memoryview slices of a read-only mapping of the range.
+
+    The kernel is told the access is sequential, and pages behind the chunk
+    being handed out are dropped with MADV_DONTNEED, so RSS stays around one
+    chunk however big the range is. Dropped pages of a shared file mapping are
+    simply refaulted from the page cache if a consumer still touches them.
+    """
+    base = offset - offset % mmap.ALLOCATIONGRANULARITY
+    skew = offset - base
+    if base + skew + length > os.fstat(f.fileno()).st_size:
+        return  # let the caller report the short range, as for a short read
+    # The mapping is never closed explicitly: consumers may still hold slices,
+    # and it is unmapped once the last of them is released.
+    mm = mmap.mmap(f.fileno(), skew + length, access=mmap.ACCESS_READ, offset=base)
+    if hasattr(mm, "madvise") and hasattr(mmap, "MADV_SEQUENTIAL"):
+        mm.madvise(mmap.MADV_SEQUENTIAL)
+    dontneed = getattr(mmap, "MADV_DONTNEED", None) if hasattr(mm, "madvise") else None
+    view = memoryview(mm)
+    released = 0
+    for pos in range(skew, skew + length, chunk_size):
+        if dontneed is not None:
+            drop = pos - pos % mmap.PAGESIZE
+            if drop > released:
+                mm.madvise(dontneed, released, drop - released)
+                released = drop
+        yield view[pos : min(pos + chunk_size, skew + length)]
+
+
+def _iter_chunks(
+    f,
+    start,
+    end,
+    chunk_size,
+    detect_zeros=True,
+    use_mmap=False,
+    read_chunks=None,
+    free=(),
+):
+    """Yield (chunk, length) covering [start, end] in order.
+
+    ``chunk`` is None when the run is known to be zeros (a hole, or a chunk that
+    read back all-zero), so callers can skip both zlib and crc32 for it.
+    Otherwise it is ``bytes``, or a memoryview into a mapping of the image with
+    ``use_mmap``; zlib.crc32 and compressobj.compress take either.
+
+    An ``end`` of None means "to EOF", for streamed input of unknown size.
+    ``read_chunks`` replaces the buffered reader (see _readahead_chunks).
+    ``free`` lists (offset, length) ranges to treat as zeros without reading
+    them, e.g. free filesystem blocks (see free_ranges).
+    """
+    if end is None:
+        segments = [(start, None, True)]
+        use_mmap = False
+    elif detect_zeros:
+        segments = _data_segments(f, start, end)
+    else:
+        segments = [(start, end - start + 1, True)]
+    if free:
+        segments = _mask_free(segments, free)
+    read_chunks = read_chunks or _read_chunks
+    if use_mmap:
+        try:
+            f.fileno()
+            read_chunks = _mmap_chunks
+        except (AttributeError, OSError):
+            pass  # e.g. an in-memory file: nothing to map
+    for offset, length, is_data in segments:
+        if not is_data:
+            yield None, length
+            continue
+        for chunk in read_chunks(f, offset, length, chunk_size):
+            if length is not None:
+                length -= len(chunk)
+            if detect_zeros and _is_zero(chunk):
+                yield None, len(chunk)
+            else:
+                yield chunk, len(chunk)
+        if length:
+            raise ValueError(f"Unexpected EOF reading range [{start}, {end}]")
+
+
+def _readahead_chunks(depth, ring=None):
+    """Return a read_chunks function that asks the kernel to prefetch.
+
+    Each read first extends a POSIX_FADV_WILLNEED hint to ``depth + 1`` chunks
+    past the read position, so the disk (or network volume) is busy while the
+    consumer works. With a ``ring`` of bytearrays, chunks are read into its
+    buffers in turn and handed out as memoryviews instead of new ``bytes``; see
+    _prefetch for when a buffer can be reused.
+    """
+    slots = itertools.cycle(ring or ())
+
+    def read_chunks(f, offset, length, chunk_size):
+        try:
+            fd = f.fileno()
+        except (AttributeError, OSError):
+            fd = None  # e.g. a stream: nothing to advise
+        advise = fd is not None and hasattr(os, "posix_fadvise")
+        readinto = getattr(f, "readinto", None) if ring else None
+        stop = None if length is None else offset + length
+        advised = offset
+        pos = offset
+        f.seek(offset)
+        while stop is None or pos < stop:
+            want = chunk_size if stop is None else min(chunk_size, stop - pos)
+            if advise:
+                horizon = pos + (depth + 1) * chunk_size
+                if stop is not None:
+                    horizon = min(horizon, stop)
+                if horizon > advised:
+                    os.posix_fadvise(
+                        fd, advised, horizon - advised, os.POSIX_FADV_WILLNEED
+                    )
+                    advised = horizon
+            if readinto is None:
+                chunk = f.read(want)
+            else:
+                view = memoryview(next(slots))
+                chunk = view[: readinto(view[:want])]
+            if not chunk:
+                return
+            pos += len(chunk)
+            yield chunk
+
+    return read_chunks
+
+
+def _prefetch(items, depth):
+    """Iterate ``items`` on a reader thread, running up to ``depth`` items ahead.
+
+    The consumer holds at most one item at a time (it asks for the next one
+    once done with the last), so at most ``depth + 1`` items are in flight: a
+    ring of ``depth + 2`` buffers, filled in turn, never overwrites one still
+    in use. Errors raised by ``items`` are re-raised in the consumer.
+    """
+    done = object()
+    pipe = queue.Queue(maxsize=depth)
+    stop = threading.Event()
+
+    def produce():
+        try:
+            for item in items:
+                if stop.is_set():
+                    return
+                pipe.put((item, None))
+            pipe.put((done, None))
+        except BaseException as e:
+            pipe.put((done, e))
+
+    reader = threading.Thread(target=produce, daemon=True)
+    reader.start()
+    try:
+        while True:
+            item, error = pipe.get()
+            if error is not None:
+                raise error
+            if item is done:
+                return
+            yield item
+    finally:
+        # Unblock and retire the reader if the consumer stopped early.
+        stop.set()
+        while reader.is_alive():
+            try:
+                pipe.get(timeout=0.05)
+            except queue.Empty:
+                pass
+        reader.join()
+
+
+# Filesystems (st_dev) that rejected fallocate; see _preallocate.
+_NO_FALLOCATE = set()
+
+
+@functools.lru_cache(maxsize=None)
+def _fallocate_function():
+    """libc's fallocate(2), or None where it is unavailable.
+
+    os.posix_fallocate is not used: on filesystems without fallocate (NFS, many
+    FUSE mounts, older CIFS) glibc emulates it by writing to every block, which
+    doubles the writes preallocating is meant to speed up.
+    """
+    try:
+        libc = ctypes.CDLL(None, use_errno=True)
+        fallocate = getattr(libc, "fallocate64", None) or libc.fallocate
+    except (AttributeError, OSError, TypeError):
+        return None
+    fallocate.argtypes = (ctypes.c_int, ctypes.c_int, ctypes.c_int64, ctypes.c_int64)
+    fallocate.restype = ctypes.c_int
+    return fallocate
+
+
+def _preallocate(fd, offset, length):
+    """Reserve ``length`` bytes of ``fd`` from ``offset``; whether it did.
+
+    A filesystem that does not support fallocate (EOPNOTSUPP or EINVAL) is not
+    asked again by this process.
+    """
+    fallocate = _fallocate_function()
+    if fallocate is None:
+        return False
+    dev = os.fstat(fd).st_dev
+    if dev in _NO_FALLOCATE:
+        return False
+    if fallocate(fd, 0, offset, length) == 0:
+        return True
+    if ctypes.get_errno() in (errno.EOPNOTSUPP, errno.EINVAL):
+        _NO_FALLOCATE.add(dev)
+    return False
+
+
+class _WriteBehind:
+    """File-like writer that hands writes to a writer thread.
+
+    Up to ``depth`` writes are queued; the writer thread coalesces them into
+    writes of at least WRITE_SIZE. Given the part's expected ``size``, it also
+    preallocates the file up to that size, PREALLOCATE_SIZE at a time (trimmed
+    back to the written size on close), so the filesystem can lay the part out
+    contiguously; after the first refusal the part is written without. Write
+    errors surface on a later write or on close.
+    """
+
+    def __init__(self, out, depth, size=0):
+        self._out = out
+        self._size = size
+        self._queue = queue.Queue(maxsize=depth)
+        self._error = None
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def write(self, data):
+        if self._error is not None:
+            raise self._error
+        self._queue.put(data)
+        return len(data)
+
+    def close(self):
+        self._queue.put(None)
+        self._thread.join()
+        if self._error is not None:
+            raise self._error
+
+    def _run(self):
+        fd = self._out.fileno()
+        pending = bytearray()
+        written = 0
+        allocated = 0 if self._size else -1
+        data = b""
+        try:
+            while data is not None:
+                data = self._queue.get()
+                if data is not None:
+                    pending += data
+                    if len(pending) < WRITE_SIZE:
+                        continue
+                if pending:
+                    end = written + len(pending)
+                    if 0 <= allocated < min(end, self._size):
+                        step = min(
+                            max(PREALLOCATE_SIZE, end - allocated),
+                            self._size - allocated,
+                        )
+                        if _preallocate(fd, allocated, step):
+                            allocated += step
+                        else:
+                            allocated = -1  # refused; stop trying for this part
+                    with memoryview(pending) as view:
+                        pos = 0
+                        while pos < len(view):
+                            pos += self._out.write(view[pos:])
+                    written += len(pending)
+                    pending.clear()
+        except BaseException as e:
+            self._error = e
+            while data is not None:
+                data = self._queue.get()  # keep writers unblocked until close()
+        finally:
+            if allocated > written:
+                os.ftruncate(fd, written)
+
+
+class _HashingWriter:
+    """File-like writer that also feeds everything written to ``hashes``."""
+
+    def __init__(self, out, hashes):
+        self._out = out
+        self._hashes = hashes
+
+    def write(self, data):
+        for h in self._hashes:
+            h.update(data)
+        return self._out.write(data)
+
+
+@contextlib.contextmanager
+def _open_output(out_path, write_behind=0, hashes=(), size=0):
+    """Open a part for writing, behind a _WriteBehind queue if ``write_behind``.
+
+    The output bytes are also fed to each of the ``hashes`` objects as written.
+    ``size`` is the part's expected size, which caps the preallocation.
+    """
+    if not write_behind:
+        with open(out_path, "wb") as out:
+            yield _HashingWriter(out, hashes) if hashes else out
+        return
+    with open(out_path, "wb", buffering=0) as raw:
+        out = _WriteBehind(raw, write_behind, size)
+        try:
+            yield _HashingWriter(out, hashes) if hashes else out
+        finally:
+            out.close()
+
+
+def _pipelined_chunks(
+    f, start, end, chunk_size, detect_zeros, use_mmap, free, read_ahead, reuse
+):
+    """_iter_chunks on a prefetching reader thread (see _prefetch).
+
+    ``reuse`` reads into a ring of buffers, which is only safe when the
+    consumer is done with each chunk before asking for the next one.
+    """
+    ring = None
+    if reuse and not use_mmap:
+        ring = [bytearray(chunk_size) for _ in range(read_ahead + 2)]
+    read_chunks = None if use_mmap else _readahead_chunks(read_ahead, ring)
+    chunks = _iter_chunks(
+        f, start, end, chunk_size, detect_zeros, use_mmap, read_chunks, free
+    )
+    return _prefetch(chunks, read_ahead)
+
+
+def _new_compressor(
+    zdict=b"", level=zlib.Z_DEFAULT_COMPRESSION, strategy=zlib.Z_DEFAULT_STRATEGY
+):
+    # compressobj rejects an empty zdict, so only pass one when there is history.
+    extra = {"zdict": zdict} if zdict else {}
+    return zlib.compressobj(
+        level, zlib.DEFLATED, -zlib.MAX_WBITS, zlib.DEF_MEM_LEVEL, strategy, **extra
+    )
+
+
+@functools.lru_cache(maxsize=16)
+def _zero_fragment(length):
+    """Sync-flushed DEFLATE for ``length`` zeros.
+
+    It only back-references bytes it emitted itself, so it is valid after any
+    byte-aligned point in a stream and can be replicated for long runs.
+    """
+    co = _new_compressor()
+    return co.compress(bytes(length)) + co.flush(zlib.Z_SYNC_FLUSH)
+
+
+def _write_zeros(out, length):
+    """Write DEFLATE for ``length`` zeros from cached templates; return its size."""
+    full, tail = divmod(length, CHUNK_SIZE)
+    written = 0
+    if full:
+        fragment = _zero_fragment(CHUNK_SIZE)
+        while full:
+            batch = min(full, 64)
+            out.write(fragment * batch)
+            written += len(fragment) * batch
+            full -= batch
+    if tail:
+        fragment = _zero_fragment(tail)
+        out.write(fragment)
+        written += len(fragment)
+    return written
+
+
+def _deflate(co, data):
+    return co.compress(data)
+
+
+def _flush(co):
+    return co.flush(zlib.Z_SYNC_FLUSH)
+
+
+def _full_flush(co):
+    return co.flush(zlib.Z_FULL_FLUSH)
+
+
+def _next_point(offset, interval):
+    """The first index point offset past ``offset``."""
+    return (offset // interval + 1) * interval
+
+
+@functools.lru_cache(maxsize=None)
+def _zero_digest(size):
+    """SHA-256 hex digest of ``size`` zero bytes."""
+    h = hashlib.sha256()
+    view = memoryview(_ZERO_CHUNK)
+    for pos in range(0, size, CHUNK_SIZE):
+        h.update(view[: min(size - pos, CHUNK_SIZE)])
+    return h.hexdigest()
+
+
+class _ChunkHasher:
+    """SHA-256 digests of consecutive ``size``-byte chunks of a part.
+
+    Fed the same chunks (or zero run lengths) as the compressor, so the data is
+    hashed from the buffers it was read into, in the same pass. Chunks that
+    fall entirely in a zero run get a precomputed digest without hashing.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.digests = []
+        self._h = hashlib.sha256()
+        self._filled = 0
+
+    def _advance(self, length):
+        self._filled += length
+        if self._filled == self.size:
+            self.digests.append(self._h.hexdigest())
+            self._h = hashlib.sha256()
+            self._filled = 0
+
+    def update(self, data):
+        view = memoryview(data)
+        while len(view):
+            take = min(len(view), self.size - self._filled)
+            self._h.update(view[:take])
+            self._advance(take)
+            view = view[take:]
+
+    def zeros(self, length):
+        zeros = memoryview(_ZERO_CHUNK)
+        while length:
+            if not self._filled and length >= self.size:
+                count = length // self.size
+                self.digests.extend([_zero_digest(self.size)] * count)
+                length -= count * self.size
+                continue
+            take = min(length, self.size - self._filled, CHUNK_SIZE)
+            self._h.update(zeros[:take])
+            self._advance(take)
+            length -= take
+
+    def finish(self):
+        """Return the digests, the last one of a short final chunk if any."""
+        if self._filled:
+            self.digests.append(self._h.hexdigest())
+            self._filled = 0
+        return self.digests
+
+
+def _hash_zeros(hashes, length):
+    """Feed ``length`` zero bytes to each of ``hashes`` from the shared zero chunk.
+
+    Hashes with a ``zeros`` method (see _PartFeed) take the run as a length.
+    """
+    zeros = memoryview(_ZERO_CHUNK)
+    plain = []
+    for h in hashes:
+        if hasattr(h, "zeros"):
+            h.zeros(length)
+        else:
+            plain.append(h)
+    while length and plain:
+        take = min(length, CHUNK_SIZE)
+        for h in plain:
+            h.update(zeros[:take])
+        length -= take
+
+
+def _update_all(hashes, data):
+    for h in hashes:
+        h.update(data)
+
+
+class _BlockMapper:
+    """bmap-style ranges of the ``block_size`` blocks of a part holding data.
+
+    Fed the same data chunks as the compressor (zero runs are simply not fed),
+    it checks each block of a chunk for zeros and SHA-256s the mapped ranges
+    from those buffers as it goes. Bytes of a mapped block that fall outside
+    the data chunks are zeros, and are hashed as such. The part must start on
+    a block boundary.
+    """
+
+    def __init__(self, block_size):
+        self.block_size = block_size
+        self.ranges = []
+        self._start = None  # byte offset of the open range
+        self._end = 0  # block-rounded end of the open range
+        self._hashed = 0  # bytes of the open range hashed so far, from _start
+        self._h = None
+
+    def _close(self, limit):
+        end = min(self._end, limit)
+        _hash_zeros([self._h], end - self._start - self._hashed)
+        self.ranges.append([self._start, end, self._h.hexdigest()])
+        self._start = None
+
+    def _map(self, offset, data):
+        """Add the non-zero bytes ``data`` at ``offset`` to the ranges."""
+        first = offset // self.block_size * self.block_size
+        if self._start is not None and first > self._end:
+            self._close(self._end)
+        if self._start is None:
+            self._start, self._hashed = first, 0
+            self._h = hashlib.sha256()
+        _hash_zeros([self._h], offset - self._start - self._hashed)
+        self._h.update(data)
+        self._hashed = offset + len(data) - self._start
+        end = offset + len(data)
+        self._end = -(-end // self.block_size) * self.block_size
+
+    def update(self, offset, chunk):
+        view = memoryview(chunk)
+        run = None  # start of the current run of non-zero blocks in view
+        pos = 0
+        while pos < len(view):
+            step = self.block_size - (offset + pos) % self.block_size
+            zero = _ZERO_CHUNK.startswith(view[pos : pos + step])
+            if zero and run is not None:
+                self._map(offset + run, view[run:pos])
+                run = None
+            elif not zero and run is None:
+                run = pos
+            pos += step
+        if run is not None:
+            self._map(offset + run, view[run:])
+
+    def finish(self, length):
+        """Return the [start, end, sha256] ranges; ``length`` is the part's."""
+        if self._start is not None:
+            self._close(length)
+        return self.ranges
+
+
+def _compress_block(data, zdict, level, strategy):
+    """Compress one block into a sync-flushed raw DEFLATE fragment.
+
+    ``zdict`` is the source data preceding the block (up to WINDOW_SIZE), which
+    the inflater already holds in its window when it reaches this fragment.
+    Also returns the time spent in crc32 and in zlib; at block granularity the
+    clock reads are noise, so they are taken unconditionally.
+    """
+    began = time.perf_counter()
+    co = _new_compressor(zdict, level, strategy)
+    blob = co.compress(data) + co.flush(zlib.Z_SYNC_FLUSH)
+    compressed = time.perf_counter()
+    crc = zlib.crc32(data)
+    return blob, crc, len(data), time.perf_counter() - compressed, compressed - began
+
+
+class BlockPool:
+    """Threads that compress the blocks of block-parallel parts, shared by all
+    the parts of a run so that concurrent parts do not each bring their own.
+
+    At most ``2 * jobs`` blocks are in flight across every part using the pool,
+    so memory stays bounded at that many blocks plus their compressed output
+    however many parts run at once.
+    """
+
+    def __init__(self, jobs):
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=jobs)
+        self._slots = threading.Semaphore(2 * jobs)
+
+    def submit(self, fn, *args):
+        return self._executor.submit(fn, *args)
+
+    def try_reserve(self):
+        return self._slots.acquire(blocking=False)
+
+    def reserve(self):
+        self._slots.acquire()
+
+    def release(self):
+        self._slots.release()
+
+    def shutdown(self):
+        self._executor.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.shutdown()
+
+
+def _compress_range_blocks(
+    chunks,
+    out_path,
+    block_jobs,
+    block_pool,
+    level,
+    strategy,
+    timings,
+    progress,
+    write_behind,
+    size,
+    index_interval,
+    hasher,
+    part_hashes,
+    image_hashes,
+    zdict,
+    mapper,
+):
+    """Block-parallel variant of compress_range (see its docstring).
+
+    Blocks go to ``block_pool``, or to a BlockPool of ``block_jobs`` threads
+    made for this part, which bounds the blocks in flight (see BlockPool). An
+    index point is a block compressed without the preceding history as its
+    dictionary.
+    """
+    crc = 0
+    uncompressed_len = 0
+    compressed_len = 0
+    submitted = 0
+    history = zdict
+    zeros = 0  # zeros since crc was last brought up to date
+    pending = collections.deque()
+    index = [[0, 0, 0]] if index_interval else None
+    next_point = index_interval
+
+    def crc_now():
+        # Adjacent zero runs are folded into crc as one run.
+        nonlocal crc, zeros
+        if zeros:
+            crc = zeros_crc(crc, zeros)
+            zeros = 0
+        return crc
+
+    def drain(write):
+        nonlocal crc, uncompressed_len, compressed_len
+        future, restart = pending.popleft()
+        blob, block_crc, block_len, crc_s, compress_s = future.result()
+        pool.release()
+        if restart:
+            index.append([uncompressed_len, compressed_len, crc_now()])
+        crc = crc32_combine(crc_now(), block_crc, block_len)
+        uncompressed_len += block_len
+        compressed_len += len(blob)
+        write(blob)
+        if timings is not None:
+            timings["crc32"] += crc_s
+            timings["compress"] += compress_s
+        if progress is not None:
+            progress(uncompressed_len)
+
+    with contextlib.ExitStack() as stack:
+        out = stack.enter_context(
+            _open_output(out_path, write_behind, part_hashes, size)
+        )
+        pool = block_pool or stack.enter_context(BlockPool(block_jobs))
+        write = _timed(out.write, timings, "write")
+        write_zeros = _timed(_write_zeros, timings, "write")
+        zeros_crc = _timed(crc32_zeros, timings, "crc32")
+        if hasher is not None:
+            hash_data = _timed(hasher.update, timings, "hash")
+            hash_zeros = _timed(hasher.zeros, timings, "hash")
+        image_data = _timed(_update_all, timings, "hash")
+        image_zeros = _timed(_hash_zeros, timings, "hash")
+        if mapper is not None:
+            map_data = _timed(mapper.update, timings, "hash")
+        for block, length in _timed_iter(chunks, timings, "read"):
+            if block is None:
+                # Zero runs are cheap enough to emit inline once the blocks
+                # ahead of them are written.
+                while pending:
+                    drain(write)
+                if hasher is not None:
+                    hash_zeros(length)
+                if image_hashes:
+                    image_zeros(image_hashes, length)
+                while length:
+                    take = length
+                    if index is not None:
+                        if uncompressed_len >= next_point:
+                            index.append([uncompressed_len, compressed_len, crc_now()])
+                            next_point = _next_point(uncompressed_len, index_interval)
+                            history = b""
+                        take = min(length, next_point - uncompressed_len)
+                    zeros += take
+                    uncompressed_len += take
+                    compressed_len += write_zeros(out, take)
+                    history = (history + bytes(min(take, WINDOW_SIZE)))[-WINDOW_SIZE:]
+                    length -= take
+                submitted = uncompressed_len
+                if progress is not None:
+                    progress(uncompressed_len)
+            else:
+                restart = index is not None and submitted >= next_point
+                if restart:
+                    next_point = _next_point(submitted, index_interval)
+                    history = b""
+                # Drain our own blocks rather than wait for a slot while holding
+                # some: a part only ever blocks with nothing in flight.
+                while not pool.try_reserve():
+                    if not pending:
+                        pool.reserve()
+                        break
+                    drain(write)
+                future = pool.submit(_compress_block, block, history, level, strategy)
+                pending.append((future, restart))
+                if hasher is not None:
+                    hash_data(block)
+                if image_hashes:
+                    image_data(image_hashes, block)
+                if mapper is not None:
+                    map_data(submitted, block)
+                submitted += length
+                history = (history + block[-WINDOW_SIZE:])[-WINDOW_SIZE:]
+        while pending:
+            drain(write)
+        if uncompressed_len == 0:
+            # Keep the empty-range output identical to the streaming path.
+            blob = _compress_block(b"", b"", level, strategy)[0]
+            compressed_len += len(blob)
+            write(blob)
+    result = {"crc": crc_now(), "len": uncompressed_len, "zLen": compressed_len}
+    if index is not None:
+        result["index"] = index
+    if hasher is not None:
+        result["hashes"] = hasher.finish()
+    if part_hashes:
+        result["digests"] = {h.name: h.hexdigest() for h in part_hashes}
+    if zdict:
+        result["primed"] = True
+    if mapper is not None:
+        result["bmap"] = mapper.finish(uncompressed_len)
+    return result
+
+
+def compress_range(
+    f,
+    start,
+    end,
+    out_path,
+    block_size=0,
+    block_jobs=1,
+    block_pool=None,
+    detect_zeros=True,
+    use_mmap=False,
+    level=zlib.Z_DEFAULT_COMPRESSION,
+    strategy=zlib.Z_DEFAULT_STRATEGY,
+    timings=None,
+    progress=None,
+    read_ahead=0,
+    write_behind=0,
+    free=(),
+    index_interval=0,
+    chunk_hash_size=0,
+    digests=(),
+    image_hashes=(),
+    zdict=b"",
+    bmap_block_size=0,
+):
+    """Compress the inclusive byte range [start, end] of ``f`` into a DEFLATE part.
+
+    Streams the data through zlib so partitions never load fully into memory.
+    Returns the part metadata: crc (of the uncompressed bytes), len (uncompressed
+    byte count) and zLen (compressed byte count).
+
+    With ``block_size`` set, the range is cut into blocks of that many bytes that
+    ``block_jobs`` threads compress concurrently, pigz-style; the block crcs are
+    merged with crc32_combine. ``block_pool``, a BlockPool, runs the blocks
+    instead, shared with other parts compressing at the same time.
+
+    With ``detect_zeros`` (the default), holes in sparse files are skipped
+    without reading and all-zero chunks bypass zlib: the compressor is
+    sync-flushed and replicated zero templates are emitted instead, with the crc
+    advanced by crc32_zeros.
+
+    ``use_mmap`` reads through a memory mapping of the file instead of
+    buffered reads (see _mmap_chunks); the output is the same. An ``end`` of
+    None compresses up to EOF (see prepare_stream_image).
+
+    ``free`` lists (offset, length) ranges, such as unallocated filesystem
+    blocks, that are compressed as zeros without being read; crc and len then
+    describe the emitted bytes, zeros included.
+
+    ``level`` and ``strategy`` are the zlib settings for the data (zero runs
+    always use the shared templates); any combination stays concatenatable.
+
+    ``timings``, if given, is a dict with a float per TIMED_PHASES entry that
+    receives the wall time spent in each phase. ``progress``, if given, is
+    called with the running uncompressed byte count after each chunk.
+
+    ``read_ahead`` > 0 pipelines the stages: a reader thread prefetches that
+    many chunks ahead (with POSIX_FADV_WILLNEED hints), reading into a ring of
+    reusable buffers, and ``write_behind`` > 0 queues that many writes to a
+    writer thread that coalesces and preallocates (see _WriteBehind). The
+    output is unchanged, and the extra memory is bounded by roughly
+    ``(read_ahead + 2 + write_behind) * chunk size + WRITE_SIZE`` per part,
+    where the chunk size is ``block_size`` if set. The read/write timings then
+    measure the time spent waiting on those stages.
+
+    ``index_interval`` > 0 makes a restart point at the first chunk (or block)
+    boundary at or after every multiple of that many bytes: the compressor is
+    Z_FULL_FLUSHed there (or a block starts without history), so inflating can
+    start at that compressed offset with no preceding data. The points are
+    returned as ``index``: [uncompressed offset, compressed offset, crc of the
+    bytes before it] triples, starting with [0, 0, 0] (see inflate_from).
+
+    ``chunk_hash_size`` > 0 also returns ``hashes``: the SHA-256 hex digests of
+    the range in consecutive chunks of that many bytes (the last one possibly
+    shorter), hashed from the same buffers as they stream past (see
+    diff_hashes).
+
+    ``digests`` names hashlib algorithms (e.g. "sha256", "md5") to digest the
+    part file with as it is written, returned as ``digests``: {name: hex}.
+    ``image_hashes`` are hashlib objects that the uncompressed bytes of the
+    range are fed to, e.g. to digest a whole image part by part in order.
+
+    ``zdict`` primes the compressor with the (up to WINDOW_SIZE) bytes that
+    precede the range, which an inflater of the concatenated parts already
+    holds, so the start of the range can refer back into them. The part then
+    only inflates with that dictionary (see verify_part) and is marked
+    ``primed`` in the result.
+
+    ``bmap_block_size`` > 0 also returns ``bmap``: the [start, end, sha256]
+    byte ranges of the blocks of that size (counted from ``start``) that hold
+    non-zero data, with the digest of each range's bytes (see write_bmap).
+    """
+    chunk_size = block_size or CHUNK_SIZE
+    hasher = _ChunkHasher(chunk_hash_size) if chunk_hash_size else None
+    part_hashes = [hashlib.new(name) for name in digests]
+    # The part rarely outgrows the range; this caps its preallocation.
+    expected_size = 0 if end is None else end - start + 1
+    mapper = _BlockMapper(bmap_block_size) if bmap_block_size else None
+    if read_ahead:
+        # Blocks are still held by the block workers when the next one is read,
+        # so they cannot share the buffer ring.
+        chunks = _pipelined_chunks(
+            f,
+            start,
+            end,
+            chunk_size,
+            detect_zeros,
+            use_mmap,
+            free,
+            read_ahead,
+            reuse=not block_size,
+        )
+    else:
+        chunks = _iter_chunks(
+            f, start, end, chunk_size, detect_zeros, use_mmap, free=free
+        )
+    if block_size:
+        return _compress_range_blocks(
+            chunks,
+            out_path,
+            block_jobs,
+            block_pool,
+            level,
+            strategy,
+            timings,
+            progress,
+            write_behind,
+            expected_size,
+            index_interval,
+            hasher,
+            part_hashes,
+            image_hashes,
+            zdict,
+            mapper,
+        )
+    co = None
+    crc = 0
+    uncompressed_len = 0
+    compressed_len = 0
+    zero_run = 0
+    zeros = 0  # zeros since crc was last brought up to date
+    history = zdict  # what the inflater holds before the next compressor
+    index = [[0, 0, 0]] if index_interval else None
+    next_point = index_interval
+    crc32 = _timed(zlib.crc32, timings, "crc32")
+    zeros_crc = _timed(crc32_zeros, timings, "crc32")
+    deflate = _timed(_deflate, timings, "compress")
+    flush = _timed(_flush, timings, "compress")
+    full_flush = _timed(_full_flush, timings, "compress")
+    if hasher is not None:
+        hash_data = _timed(hasher.update, timings, "hash")
+        hash_zeros = _timed(hasher.zeros, timings, "hash")
+    image_data = _timed(_update_all, timings, "hash")
+    image_zeros = _timed(_hash_zeros, timings, "hash")
+    if mapper is not None:
+        map_data = _timed(mapper.update, timings, "hash")
+    with _open_output(out_path, write_behind, part_hashes, expected_size) as out:
+        write = _timed(out.write, timings, "write")
+        write_zeros = _timed(_write_zeros, timings, "write")
+
+        def restart(offset):
+            # Nothing after a full flush refers back past it, and zero templates
+            # are self-contained; a compressor started after a zero run must
+            # then only be primed with the zeros past this point.
+            nonlocal compressed_len, zero_run, history, next_point, crc, zeros
+            if co is not None:
+                blob = full_flush(co)
+                compressed_len += len(blob)
+                write(blob)
+            zero_run = 0
+            history = b""
+            crc, zeros = zeros_crc(crc, zeros), 0
+            index.append([offset, compressed_len, crc & 0xFFFFFFFF])
+            next_point = _next_point(offset, index_interval)
+
+        for chunk, length in _timed_iter(chunks, timings, "read"):
+            offset = uncompressed_len
+            uncompressed_len += length
+            if progress is not None:
+                progress(uncompressed_len)
+            if chunk is None:
+                if co is not None:
+                    blob = flush(co)
+                    compressed_len += len(blob)
+                    write(blob)
+                    co = None
+                if hasher is not None:
+                    hash_zeros(length)
+                if image_hashes:
+                    image_zeros(image_hashes, length)
+                while length:
+                    take = length
+                    if index is not None:
+                        if offset >= next_point:
+                            restart(offset)
+                        take = min(length, next_point - offset)
+                    zeros += take  # adjacent zero runs fold into crc as one
+                    compressed_len += write_zeros(out, take)
+                    zero_run += take
+                    offset += take
+                    length -= take
+                continue
+            if index is not None and offset >= next_point:
+                restart(offset)
+            if co is None:
+                # Resume after a zero run with the zeros as history, behind the
+                # priming window if nothing was compressed yet.
+                window = history + bytes(min(zero_run, WINDOW_SIZE))
+                co = _new_compressor(window[-WINDOW_SIZE:], level, strategy)
+                zero_run = 0
+                history = b""
+            if zeros:
+                crc, zeros = zeros_crc(crc, zeros), 0
+            crc = crc32(chunk, crc)
+            if hasher is not None:
+                hash_data(chunk)
+            if image_hashes:
+                image_data(image_hashes, chunk)
+            if mapper is not None:
+                map_data(offset, chunk)
+            blob = deflate(co, chunk)
+            if blob:
+                compressed_len += len(blob)
+                write(blob)
+        if co is not None or uncompressed_len == 0:
+            # Z_SYNC_FLUSH ends the stream on an empty, non-final block
+            # (00 00 ff ff) so parts remain concatenatable; matches gzip-stream's
+            # stripped output. Zero templates already end that way.
+            blob = flush(co or _new_compressor(b"", level, strategy))
+            compressed_len += len(blob)
+            write(blob)
+    crc = zeros_crc(crc, zeros)
+    result = {"crc": crc & 0xFFFFFFFF, "len": uncompressed_len, "zLen": compressed_len}
+    if index is not None:
+        result["index"] = index
+    if hasher is not None:
+        result["hashes"] = hasher.finish()
+    if part_hashes:
+        result["digests"] = {h.name: h.hexdigest() for h in part_hashes}
+    if zdict:
+        result["primed"] = True
+    if mapper is not None:
+        result["bmap"] = mapper.finish(uncompressed_len)
+    return result
+
+
+# --- imperative shell: per-part compression settings ----------------------
+
+# "default" compresses every part at zlib's default level; "tuned" applies the
+# fixed per-part rules in choose_settings; "auto" compresses samples of each
+# part with every candidate.
+POLICIES = ("default", "tuned", "auto")
+# Parts are sampled as this many windows of SAMPLE_SIZE bytes spread evenly
+# across the part (or the whole part when it is smaller than that).
+SAMPLE_COUNT = 8
+SAMPLE_SIZE = 128 << 10  # 128 KiB
+# Samples whose level-1 output is at least this fraction of their size are
+# treated as incompressible (already-compressed payloads, encrypted data).
+INCOMPRESSIBLE_RATIO = 0.97
+# Level for partitions that compress in the "tuned" policy.
+TUNED_PARTITION_LEVEL = 9
+# "auto" tries these (level, strategy) pairs, cheapest first, and keeps the first
+# whose sampled output is within AUTO_SIZE_TOLERANCE of the smallest. Ranking by
+# size alone keeps the choice, and so the parts, the same from run to run.
+AUTO_CANDIDATES = (
+    (0, zlib.Z_DEFAULT_STRATEGY),
+    (1, zlib.Z_RLE),
+    (1, zlib.Z_DEFAULT_STRATEGY),
+    (6, zlib.Z_DEFAULT_STRATEGY),
+    (9, zlib.Z_DEFAULT_STRATEGY),
+)
+AUTO_SIZE_TOLERANCE = 0.01
+STRATEGY_NAMES = {
+    zlib.Z_DEFAULT_STRATEGY: "default",
+    zlib.Z_FILTERED: "filtered",
+    zlib.Z_HUFFMAN_ONLY: "huffman_only",
+    zlib.Z_RLE: "rle",
+    zlib.Z_FIXED: "fixed",
+}
+
+
+def _sample(f, start, end):
+    """Return the non-zero sample windows of [start, end] (zeros bypass zlib)."""
+    size = end - start + 1
+    if size <= SAMPLE_COUNT * SAMPLE_SIZE:
+        offsets, length = [start], size
+    else:
+        stride = (size - SAMPLE_SIZE) // (SAMPLE_COUNT - 1)
+        offsets, length = [start + i * stride for i in range(SAMPLE_COUNT)], SAMPLE_SIZE
+    samples = []
+    for offset in offsets:
+        window = _read_at(f, offset, length)
+        if not _is_zero(window):
+            samples.append(window)
+    return samples
+
+
+def _sampled_size(samples, level, strategy):
+    total = 0
+    for window in samples:
+        co = _new_compressor(b"", level, strategy)
+        total += len(co.compress(window)) + len(co.flush(zlib.Z_SYNC_FLUSH))
+    return total
+
+
+def choose_settings(f, part, policy="default"):
+    """Pick the zlib level/strategy for one planned part under ``policy``.
+
+    Returns {"level", "strategy", "reason"}. "auto" takes the cheapest of
+    AUTO_CANDIDATES that compresses the samples nearly as well as the best one,
+    which depends only on the data, never on timings. The "tuned" rules:
+    incompressible samples -> level 0 (stored), gaps -> level 1, other
+    partitions -> TUNED_PARTITION_LEVEL. Root filesystem slots cannot be told apart from the
+    partition table alone, so every compressible partition gets the higher
+    level; the boot and state partitions are small enough not to matter.
+    """
+    if policy == "default":
+        return {
+            "level": zlib.Z_DEFAULT_COMPRESSION,
+            "strategy": zlib.Z_DEFAULT_STRATEGY,
+            "reason": "default",
+        }
+    samples = _sample(f, part["start"], part["end"])
+    if not samples:
+        # Only zero runs were seen; those bypass zlib, so keep any stray data cheap.
+        return {"level": 1, "strategy": zlib.Z_DEFAULT_STRATEGY, "reason": "zeros"}
+    if policy == "auto":
+        sizes = [
+            _sampled_size(samples, level, strategy)
+            for level, strategy in AUTO_CANDIDATES
+        ]
+        smallest = min(sizes)
+        level, strategy = next(
+            candidate
+            for candidate, size in zip(AUTO_CANDIDATES, sizes)
+            if size <= smallest * (1 + AUTO_SIZE_TOLERANCE)
+        )
+        return {"level": level, "strategy": strategy, "reason": "auto"}
+    sampled = sum(len(window) for window in samples)
+    level1 = _sampled_size(samples, 1, zlib.Z_DEFAULT_STRATEGY)
+    if level1 >= sampled * INCOMPRESSIBLE_RATIO:
+        level, reason = 0, "incompressible"
+    elif "partition_index" not in part:
+        level, reason = 1, "gap"
+    else:
+        level, reason = TUNED_PARTITION_LEVEL, "partition"
+    return {"level": level, "strategy": zlib.Z_DEFAULT_STRATEGY, "reason": reason}
+
+
+# --- imperative shell: content-addressed part cache ------------------------
+
+# Block size of the bmap block maps (bmaptool's usual filesystem block size).
+BMAP_BLOCK_SIZE = 4096
+
+# compress_range options that change how a part is produced but not its bytes.
+_CACHE_NEUTRAL_KWARGS = {
+    "block_jobs",
+    "block_pool",
+    "use_mmap",
+    "read_ahead",
+    "write_behind",
+}
+
+
+def _cache_hash(start, end, range_kwargs):
+    """A sha256 primed with everything that shapes the compressed output of
+    [start, end] but its bytes (zlib build and the output-affecting
+    compress_range options); fed the bytes, its digest is the cache key.
+    """
+    settings = {
+        k: v for k, v in range_kwargs.items() if k not in _CACHE_NEUTRAL_KWARGS
+    }
+    settings["zlib"] = zlib.ZLIB_RUNTIME_VERSION
+    if "zdict" in settings:
+        settings["zdict"] = hashlib.sha256(settings["zdict"]).hexdigest()
+    h = hashlib.sha256(json.dumps(settings, sort_keys=True).encode())
+    h.update(struct.pack("<Q", end - start + 1))
+    return h
+
+
+def _cache_key(f, start, end, range_kwargs):
+    """The cache key of [start, end] from a pass of its own over the bytes.
+
+    The bytes hashed are the ones compress_range emits (``free`` ranges as
+    zeros), as fed to its ``image_hashes``, so a part compressed with the
+    hash alongside gets the same key without this extra pass.
+    """
+    h = _cache_hash(start, end, range_kwargs)
+    free = range_kwargs.get("free", ())
+    # Zero runs are fed from the shared zero buffer rather than being read.
+    for chunk, length in _iter_chunks(f, start, end, CHUNK_SIZE, free=free):
+        if chunk is None:
+            _hash_zeros((h,), length)
+        else:
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def _probe_key(f, start, end, range_kwargs):
+    """A cheap stand-in for the cache key: the settings, the length and only
+    the first and last CHUNK_SIZE bytes of [start, end].
+
+    Parts whose probe key was never stored (see _cache_mark) cannot be in
+    the cache, so they are compressed with the key hashed alongside instead
+    of being read once for the key and again to compress.
+    """
+    h = _cache_hash(start, end, range_kwargs)
+    free = range_kwargs.get("free", ())
+    head_end = min(end, start + CHUNK_SIZE - 1)
+    tail_start = max(head_end + 1, end - CHUNK_SIZE + 1)
+    for lo, hi in ((start, head_end), (tail_start, end)):
+        for chunk, length in _iter_chunks(f, lo, hi, CHUNK_SIZE, free=free):
+            if chunk is None:
+                _hash_zeros((h,), length)
+            else:
+                h.update(chunk)
+    return h.hexdigest()
+
+
+def _probe_path(cache_dir, probe):
+    return os.path.join(cache_dir, "probe", probe[:2], probe)
+
+
+def _cache_mark(cache_dir, probe):
+    """Record that a part with probe key ``probe`` is in the cache.
+
+    Done after each store and fetch, so a marker is never older than the
+    entries it leads to, and evict_cache can age markers out with them.
+    """
+    path = _probe_path(cache_dir, probe)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    try:
+        with open(path, "a"):
+            pass
+        os.utime(path)
+    except FileNotFoundError:
+        pass  # evicted meanwhile; a missing marker only costs a probe
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+def _cache_fetch(entry, out_path):
+    """Materialize a cached part at ``out_path``; return its metadata or None."""
+    try:
+        with open(entry + ".json") as fh:
+            result = json.load(fh)
+        # Touch the entry first: its mtime is the LRU stamp used by
+        # evict_cache, and an entry evicted (e.g. by a build sharing the
+        # cache) since the probe is then a miss before anything is linked.
+        os.utime(entry + ".deflate")
+        if os.path.getsize(entry + ".deflate") != result["zLen"]:
+            return None
+        try:
+            os.link(entry + ".deflate", out_path)
+        except OSError:
+            shutil.copyfile(entry + ".deflate", out_path)
+    except (OSError, ValueError, KeyError):
+        return None
+    return result
+
+
+def _cache_store(entry, out_path, result):
+    """Copy a freshly compressed part into the cache.
+
+    A copy rather than a hardlink, so rewriting the output later can never
+    corrupt the cache. Files land via rename, so concurrent writers sharing
+    the cache (e.g. CI jobs on one volume) never see a partial entry.
+    """
+    os.makedirs(os.path.dirname(entry), exist_ok=True)
+    tmp = f"{entry}.{os.getpid()}.{threading.get_ident()}.tmp"
+    shutil.copyfile(out_path, tmp)
+    os.replace(tmp, entry + ".deflate")
+    with open(tmp, "w") as fh:
+        json.dump(result, fh)
+    os.replace(tmp, entry + ".json")
+
+
+def evict_cache(cache_dir, max_bytes):
+    """Delete least-recently-used cache entries until they total <= max_bytes.
+
+    Probe markers last used before the oldest entry left go with them.
+    """
+    entries = []
+    markers = []
+    for root, _dirs, files in os.walk(cache_dir):
+        for name in files:
+            path = os.path.join(root, name)
+            is_marker = os.path.basename(os.path.dirname(root)) == "probe"
+            if not is_marker and not name.endswith(".deflate"):
+                continue
+            try:
+                st = os.stat(path)
+            except FileNotFoundError:
+                continue  # evicted concurrently
+            if is_marker:
+                markers.append((st.st_mtime, path))
+            else:
+                entries.append((st.st_mtime, st.st_size, path))
+    total = sum(size for _mtime, size, _path in entries)
+    entries.sort()
+    while entries and total > max_bytes:
+        _mtime, size, path = entries.pop(0)
+        _remove(path[: -len(".deflate")] + ".json")
+        _remove(path)
+        total -= size
+    oldest = entries[0][0] if entries else math.inf
+    for mtime, path in markers:
+        if mtime < oldest:
+            _remove(path)
+
+
+def _window_before(f, start, free=()):
+    """The (up to WINDOW_SIZE) bytes before ``start`` as the inflater holds them:
+    read from ``f``, with the ``free`` ranges as zeros."""
+    window = bytearray()
+    lo = max(0, start - WINDOW_SIZE)
+    for chunk, length in _iter_chunks(f, lo, start - 1, WINDOW_SIZE, free=free):
+        window += bytes(length) if chunk is None else chunk
+    return bytes(window)
+
+
+def _compress_part(
+    f,
+    part,
+    out_path,
+    cache_dir=None,
+    policy="default",
+    instrument=False,
+    progress=None,
+    image_hashes=(),
+    prime_parts=False,
+    **range_kwargs,
+):
+    """Compress one planned part, reusing a cached result when ``cache_dir`` is set.
+
+    Returns (manifest metadata, stats) where stats records the settings used
+    and, with ``instrument``, the byte counts and per-phase timings. ``progress``
+    is an emit(event) callable for the JSON-lines progress stream.
+    ``image_hashes`` are passed to compress_range, so they are only fed when the
+    part is compressed rather than fetched from the cache. ``prime_parts``
+    primes the compressor with the source bytes before the part (see
+    compress_range's ``zdict``), with its ``window_free`` ranges as zeros.
+    """
+    began = time.perf_counter()
+    settings = choose_settings(f, part, policy)
+    range_kwargs["level"] = settings["level"]
+    range_kwargs["strategy"] = settings["strategy"]
+    stats = {
+        "level": settings["level"],
+        "strategy": STRATEGY_NAMES.get(settings["strategy"], settings["strategy"]),
+        "reason": settings["reason"],
+    }
+    if part.get("free"):
+        # Part of the settings, so the cache key covers the emitted bytes.
+        range_kwargs["free"] = part["free"]
+    if part.get("bmap_block_size"):
+        range_kwargs["bmap_block_size"] = part["bmap_block_size"]
+    if prime_parts and part["start"]:
+        # Likewise: read from the image, not from the previous part's output,
+        # so parts stay independent of each other's scheduling and caching.
+        free = part.get("window_free", ())
+        range_kwargs["zdict"] = _window_before(f, part["start"], free)
+    size = None if part["end"] is None else part["end"] - part["start"] + 1
+    timings = dict.fromkeys(TIMED_PHASES, 0.0) if instrument else None
+    on_bytes = None
+    if progress is not None:
+        progress({"event": "part_start", "part": out_path, "len": size})
+        reported = 0
+
+        def on_bytes(done):
+            nonlocal reported
+            if done - reported >= PROGRESS_INTERVAL:
+                reported = done
+                event = {"event": "part_progress", "part": out_path, "done": done}
+                progress({**event, "len": size})
+
+    def compress():
+        return compress_range(
+            f,
+            part["start"],
+            part["end"],
+            out_path,
+            timings=timings,
+            progress=on_bytes,
+            image_hashes=image_hashes,
+            **range_kwargs,
+        )
+
+    cached = False
+    if not cache_dir:
+        result = compress()
+    else:
+        # The output may be a hardlink into the cache from a previous run; never
+        # write through it.
+        _remove(out_path)
+        start, end = part["start"], part["end"]
+        probe = _probe_key(f, start, end, range_kwargs)
+        if os.path.exists(_probe_path(cache_dir, probe)):
+            # Likely a hit: read the part once for its key.
+            key = _cache_key(f, start, end, range_kwargs)
+            result = _cache_fetch(os.path.join(cache_dir, key[:2], key), out_path)
+            cached = result is not None
+            if not cached:
+                result = compress()
+        else:
+            # A miss: hash the part for its key as it is compressed.
+            h = _cache_hash(start, end, range_kwargs)
+            image_hashes = [*image_hashes, h]
+            result = compress()
+            key = h.hexdigest()
+        if not cached:
+            _cache_store(os.path.join(cache_dir, key[:2], key), out_path, result)
+        _cache_mark(cache_dir, probe)
+
+    if instrument:
+        elapsed = time.perf_counter() - began
+        bytes_in, bytes_out = result["len"], result["zLen"]
+        stats.update(
+            {
+                "cached": cached,
+                "bytes_in": bytes_in,
+                "bytes_out": bytes_out,
+                "ratio": round(bytes_out / bytes_in, 4) if bytes_in else 0,
+                "seconds": round(elapsed, 6),
+                "mb_per_s": round(bytes_in / elapsed / 1e6, 1) if elapsed else 0,
+            }
+        )
+        for phase in TIMED_PHASES:
+            stats[f"{phase}_s"] = round(timings[phase], 6)
+    if progress is not None:
+        progress({"event": "part_done", "part": out_path, **result, **stats})
+    return result, stats
+
+
+def _compress_part_at(image_path, part, out_path, **kwargs):
+    """_compress_part on its own file handle (safe to run concurrently)."""
+    with open(image_path, "rb") as f:
+        return _compress_part(f, part, out_path, **kwargs)
+
+
+def _write_manifest(output_dir, suffix, parts, filenames, results):
+    metadata = []
+    for part, filename, (result, _stats) in zip(parts, filenames, results):
+        entry = {"filename": filename, **result}
+        entry.pop("index", None)  # goes to the index sidecar
+        entry.pop("hashes", None)  # goes to the hashes sidecar
+        entry.pop("digests", None)  # goes to the digests sidecar
+        entry.pop("bmap", None)  # goes to the block map
+        if "partition_index" in part:
+            entry["partitionIndex"] = f"({part['partition_index']})"
+        metadata.append(entry)
+
+    manifest_path = os.path.join(output_dir, f"image{suffix}.json")
+    with open(manifest_path, "w") as out:
+        json.dump({"resin.img": {"parts": metadata}}, out, indent=4)
+    return manifest_path
+
+
+def _write_stats(output_dir, suffix, filenames, results):
+    """Write the image{suffix}.stats.json sidecar, in manifest order."""
+    parts = [
+        {"filename": filename, **stats}
+        for filename, (_result, stats) in zip(filenames, results)
+    ]
+    stats_path = os.path.join(output_dir, f"image{suffix}.stats.json")
+    with open(stats_path, "w") as out:
+        json.dump({"resin.img": {"parts": parts}}, out, indent=4)
+    return stats_path
+
+
+def _write_index(output_dir, suffix, filenames, results, interval):
+    """Write the image{suffix}.index.json seek index sidecar, in manifest order."""
+    parts = [
+        {"filename": filename, "points": result["index"]}
+        for filename, (result, _stats) in zip(filenames, results)
+    ]
+    index_path = os.path.join(output_dir, f"image{suffix}.index.json")
+    with open(index_path, "w") as out:
+        json.dump({"resin.img": {"interval": interval, "parts": parts}}, out)
+    return index_path
+
+
+def _write_hashes(output_dir, suffix, parts, filenames, results, chunk_size):
+    """Write the image{suffix}.hashes.json chunk hash sidecar, in manifest order.
+
+    Each part records its offset in the image, so indexes of two builds can be
+    compared range by range (see diff_hashes).
+    """
+    entries = [
+        {
+            "filename": filename,
+            "start": part["start"],
+            "len": result["len"],
+            "hashes": result["hashes"],
+        }
+        for part, filename, (result, _stats) in zip(parts, filenames, results)
+    ]
+    hashes_path = os.path.join(output_dir, f"image{suffix}.hashes.json")
+    with open(hashes_path, "w") as out:
+        json.dump(
+            {
+                "resin.img": {
+                    "algorithm": "sha256",
+                    "chunk_size": chunk_size,
+                    "parts": entries,
+                }
+            },
+            out,
+        )
+    return hashes_path
+
+
+def _write_digests(output_dir, suffix, filenames, results, image, gzip_file=None):
+    """Write the image{suffix}.digests.json sidecar: {algorithm: hex digest} of
+    the whole (uncompressed) image, of each part file and of the .img.gz."""
+    digests = {
+        "image": {h.name: h.hexdigest() for h in image},
+        "parts": [
+            {"filename": filename, **result["digests"]}
+            for filename, (result, _stats) in zip(filenames, results)
+        ],
+    }
+    if gzip_file is not None:
+        digests["gzip"] = {h.name: h.hexdigest() for h in gzip_file}
+    digests_path = os.path.join(output_dir, f"image{suffix}.digests.json")
+    with open(digests_path, "w") as out:
+        json.dump({"resin.img": digests}, out, indent=4)
+    return digests_path
+
+
+# Bytes of parts compressed ahead of their turn held for the image digests.
+DIGEST_BUFFER_SIZE = 64 << 20  # 64 MiB
+
+
+def check_digests(digests):
+    """Raise ValueError unless every name in ``digests`` is a hashlib algorithm
+    with a fixed digest size (shake_128 and shake_256 need a length)."""
+    for name in digests:
+        try:
+            digest_size = hashlib.new(name).digest_size
+        except ValueError:
+            raise ValueError(f"Unknown digest algorithm: {name}") from None
+        if not digest_size:
+            raise ValueError(f"Digest algorithm has no fixed size: {name}")
+
+
+class _OrderedDigest:
+    """Feeds ``hashes`` the bytes compress_range emits for an image's ``parts``
+    in image order, while the parts are compressed in any order.
+
+    Each part's compress_range is given ``feed(index)`` as an image hash and
+    calls finish(index) when done. The part next in image order feeds
+    ``hashes`` directly; the others hold on to their bytes (zero runs as
+    lengths) until their turn, up to ``budget`` bytes between them. Only what
+    was not held is read again from the image: the rest of a part that ran
+    past the budget, caught up on its own thread once its turn comes, and
+    parts fetched from the cache, which emit nothing. ``reread`` counts those
+    bytes.
+
+    Held bytes and rereads are fed outside the lock, with the part marked
+    busy, so the other parts keep compressing (and holding their bytes)
+    meanwhile; only the part being caught up waits for it.
+    """
+
+    def __init__(self, image_path, parts, hashes, budget=DIGEST_BUFFER_SIZE):
+        self._image_path = image_path
+        self._parts = parts
+        self._hashes = hashes
+        self._budget = budget
+        self._cond = threading.Condition()
+        self._held = 0
+        self._next = 0
+        # Per part: held (chunk or None, length) pairs, held data bytes, bytes
+        # emitted so far, the offset from which they were dropped, whether a
+        # thread is feeding its bytes outside the lock, and done.
+        self._states = [
+            {
+                "held": [],
+                "size": 0,
+                "pos": 0,
+                "dropped": None,
+                "busy": False,
+                "done": False,
+            }
+            for _part in parts
+        ]
+        self.reread = 0
+
+    def feed(self, index):
+        return _PartFeed(self, index)
+
+    def _update(self, index, chunk, length):
+        with self._cond:
+            state = self._states[index]
+            if index == self._next:
+                self._cond.wait_for(lambda: not state["busy"])
+                if state["dropped"] is not None:
+                    span = (state["dropped"], state["pos"])
+                    state["dropped"] = None
+                    self._feed_unlocked(index, (), span)
+                self._emit(chunk, length)
+            elif state["dropped"] is None:
+                if chunk is not None and self._held + length > self._budget:
+                    state["dropped"] = state["pos"]
+                else:
+                    if chunk is not None:
+                        chunk = bytes(chunk)  # may be a reused read buffer
+                        state["size"] += length
+                        self._held += length
+                    state["held"].append((chunk, length))
+            state["pos"] += length
+
+    def finish(self, index):
+        """Mark part ``index`` compressed (or fetched) and feed whatever is due."""
+        with self._cond:
+            state = self._states[index]
+            state["done"] = True
+            if state["dropped"] is None and state["pos"] < self._len(index):
+                state["dropped"] = state["pos"]
+            while self._next < len(self._parts):
+                index = self._next
+                state = self._states[index]
+                if state["busy"]:
+                    return  # its feeder carries on, see _update
+                span = None
+                if state["done"] and state["dropped"] is not None:
+                    span = (state["dropped"], self._len(index))
+                    state["dropped"] = None
+                if state["held"] or span:
+                    held = state["held"]
+                    self._held -= state["size"]
+                    state["held"], state["size"] = [], 0
+                    self._feed_unlocked(index, held, span)
+                    continue  # it may have finished meanwhile
+                if not state["done"]:
+                    return  # it feeds the rest itself, see _update
+                self._next += 1
+
+    def _feed_unlocked(self, index, held, span):
+        """Feed ``held`` and the ``span`` reread of part ``index`` with the lock
+        released; called with it held and part ``index`` next in order."""
+        state = self._states[index]
+        state["busy"] = True
+        self._cond.release()
+        try:
+            for chunk, length in held:
+                self._emit(chunk, length)
+            if span:
+                self._reread(index, *span)
+        finally:
+            self._cond.acquire()
+            state["busy"] = False
+            self._cond.notify_all()
+
+    def _len(self, index):
+        part = self._parts[index]
+        return part["end"] - part["start"] + 1
+
+    def _emit(self, chunk, length):
+        if chunk is None:
+            _hash_zeros(self._hashes, length)
+        else:
+            _update_all(self._hashes, chunk)
+
+    def _reread(self, index, start, end):
+        """Feed bytes [start, end) of part ``index``, read from the image."""
+        part = self._parts[index]
+        self.reread += end - start
+        with open(self._image_path, "rb") as f:
+            for chunk, length in _iter_chunks(
+                f,
+                part["start"] + start,
+                part["start"] + end - 1,
+                CHUNK_SIZE,
+                free=part.get("free", ()),
+            ):
+                self._emit(chunk, length)
+
+
+class _PartFeed:
+    """The image hash one part's compress_range feeds, see _OrderedDigest."""
+
+    def __init__(self, digest, index):
+        self._digest = digest
+        self._index = index
+
+    def update(self, chunk):
+        self._digest._update(self._index, chunk, len(chunk))
+
+    def zeros(self, length):
+        self._digest._update(self._index, None, length)
+
+
+def _bmap_block_size(parts):
+    """BMAP_BLOCK_SIZE, or the largest power of two below it that every part
+    starts on, so that each block belongs to one part (see _BlockMapper)."""
+    block_size = BMAP_BLOCK_SIZE
+    while block_size > 1 and any(part["start"] % block_size for part in parts):
+        block_size //= 2
+    return block_size
+
+
+def write_bmap(bmap_path, image_size, block_size, ranges):
+    """Write a bmaptool (format 2.0) block map of ``ranges``.
+
+    ``ranges`` are sorted, block-aligned [start, end, sha256] byte ranges of
+    the image that hold data; the file's own checksum is computed with its
+    value zeroed, as bmaptool does.
+    """
+    mapped = 0
+    range_lines = []
+    for start, end, digest in ranges:
+        first, last = start // block_size, -(-end // block_size) - 1
+        mapped += last - first + 1
+        blocks = f"{first}-{last}" if last > first else f"{first}"
+        range_lines.append(f'        <Range chksum="{digest}"> {blocks} </Range>')
+    placeholder = "0" * 64
+    text = "\n".join(
+        [
+            '<?xml version="1.0" ?>',
+            '<bmap version="2.0">',
+            f"    <ImageSize> {image_size} </ImageSize>",
+            f"    <BlockSize> {block_size} </BlockSize>",
+            f"    <BlocksCount> {-(-image_size // block_size)} </BlocksCount>",
+            f"    <MappedBlocksCount> {mapped} </MappedBlocksCount>",
+            "    <ChecksumType> sha256 </ChecksumType>",
+            f"    <BmapFileChecksum> {placeholder} </BmapFileChecksum>",
+            "    <BlockMap>",
+            *range_lines,
+            "    </BlockMap>",
+            "</bmap>",
+            "",
+        ]
+    )
+    checksum = hashlib.sha256(text.encode()).hexdigest()
+    with open(bmap_path, "w") as out:
+        out.write(text.replace(placeholder, checksum, 1))
+    return bmap_path
+
+
+def _write_bmap(output_dir, suffix, parts, results, block_size):
+    """Write image{suffix}.bmap from the per-part block maps."""
+    ranges = [
+        [part["start"] + start, part["start"] + end, digest]
+        for part, (result, _stats) in zip(parts, results)
+        for start, end, digest in result["bmap"]
+    ]
+    image_size = sum(result["len"] for result, _stats in results)
+    bmap_path = os.path.join(output_dir, f"image{suffix}.bmap")
+    return write_bmap(bmap_path, image_size, block_size, ranges)
+
+
+def write_stats_summary(stats_path, manifest_paths):
+    """Write per-image totals, from the stats sidecars next to each manifest."""
+    images = []
+    for manifest_path in manifest_paths:
+        with open(manifest_path[: -len(".json")] + ".stats.json") as fh:
+            stats = json.load(fh)["resin.img"]["parts"]
+        bytes_in = sum(part["bytes_in"] for part in stats)
+        bytes_out = sum(part["bytes_out"] for part in stats)
+        totals = {
+            "manifest": manifest_path,
+            "parts": len(stats),
+            "cached": sum(part["cached"] for part in stats),
+            "bytes_in": bytes_in,
+            "bytes_out": bytes_out,
+            "ratio": round(bytes_out / bytes_in, 4) if bytes_in else 0,
+        }
+        for phase in TIMED_PHASES:
+            key = f"{phase}_s"
+            totals[key] = round(sum(part[key] for part in stats), 6)
+        images.append(totals)
+    with open(stats_path, "w") as out:
+        json.dump({"images": images}, out, indent=4)
+
+
+def progress_writer(stream):
+    """Return an emit(event) callable writing JSON lines to ``stream``.
+
+    Safe to call from the worker threads; each event gets a timestamp and is
+    flushed immediately so CI can tail it live.
+    """
+    lock = threading.Lock()
+
+    def emit(event):
+        line = json.dumps({"time": round(time.time(), 3), **event})
+        with lock:
+            stream.write(line + "\n")
+            stream.flush()
+
+    return emit
+
+
+# gzip member header: deflate, no flags, no mtime (reproducible), OS unknown.
+GZIP_HEADER = b"\x1f\x8b\x08\x00\x00\x00\x00\x00\x00\xff"
+
+
+def write_gzip(manifest_path, out_path=None, hashes=()):
+    """Assemble the parts of an image{suffix}.json into a single .img.gz.
+
+    The parts are copied in order between GZIP_HEADER and DEFLATE_END plus the
+    gzip footer, whose crc is combined from the manifest's per-part crcs, so
+    the whole image is never recompressed (or even inflated). Parts are read
+    from the compressed{suffix}/ directory next to the manifest; ``out_path``
+    defaults to image{suffix}.img.gz beside it. The file's bytes are also fed
+    to each of the ``hashes`` objects. Returns the path written.
+    """
+    directory, manifest_name = os.path.split(os.path.abspath(manifest_path))
+    suffix = manifest_name[len("image") : -len(".json")]
+    parts_dir = os.path.join(directory, f"compressed{suffix}")
+    if out_path is None:
+        out_path = os.path.join(directory, f"image{suffix}.img.gz")
+    with open(manifest_path) as fh:
+        entries = json.load(fh)["resin.img"]["parts"]
+    crc = 0
+    length = 0
+    with open(out_path, "wb") as raw:
+        out = _HashingWriter(raw, hashes) if hashes else raw
+        out.write(GZIP_HEADER)
+        for entry in entries:
+            with open(os.path.join(parts_dir, entry["filename"]), "rb") as part:
+                shutil.copyfileobj(part, out, WRITE_SIZE)
+            crc = crc32_combine(crc, entry["crc"], entry["len"])
+            length += entry["len"]
+        out.write(DEFLATE_END + struct.pack("<II", crc, length & 0xFFFFFFFF))
+    return out_path
+
+
+def prepare_raw_images(
+    images,
+    jobs=1,
+    block_size=0,
+    detect_zeros=True,
+    use_mmap=False,
+    cache_dir=None,
+    cache_max_size=0,
+    policy="default",
+    instrument=False,
+    progress=None,
+    stats_path=None,
+    read_ahead=0,
+    write_behind=0,
+    max_part_size=0,
+    zero_free=False,
+    index_interval=0,
+    chunk_hash_size=0,
+    gzip_output=False,
+    digests=(),
+    prime_parts=False,
+    bmap=False,
+    pool=None,
+):
+    """Prepare several images, e.g. the main, flasher and raw variants, at once.
+
+    ``images`` is a list of (image_path, output_dir, suffix); each gets the
+    compressed{suffix}/ parts and image{suffix}.json that prepare_raw_image
+    would write, and the manifest paths are returned in the same order.
+
+    The parts of all images share one pool of ``jobs`` workers, largest part
+    first, so the wall time tends towards the largest image rather than the
+    sum. Results are collected in plan order so no manifest depends on
+    completion order. A non-zero ``block_size`` also splits each part into
+    blocks, compressed on one BlockPool of ``jobs`` threads shared by all the
+    parts, so at most ``2 * jobs`` blocks are in flight however many parts run
+    at once (see compress_range); ``detect_zeros`` toggles the zero-run fast
+    path and ``use_mmap`` the memory-mapped read path.
+
+    ``cache_dir`` enables the content-addressed part cache: parts whose bytes
+    and settings were compressed before are hardlinked (or copied) from it
+    instead of recompressed. ``cache_max_size`` > 0 then trims the cache to that
+    many bytes, least recently used first.
+
+    ``policy`` selects the zlib level/strategy per part (see choose_settings);
+    with anything but "default" the choices are recorded in an
+    image{suffix}.stats.json sidecar next to the manifest.
+
+    ``instrument`` adds per-part byte counts, ratio and read/crc32/compress/
+    write timings to that sidecar (which it then always writes), and
+    ``stats_path`` also gets totals for every image. ``progress`` is an
+    emit(event) callable (see progress_writer) receiving part start, progress
+    and done events.
+
+    ``read_ahead`` and ``write_behind`` pipeline each part's reads and writes
+    on their own threads, with queues that deep (see compress_range).
+    ``max_part_size`` cuts larger parts into several (see split_part), so a
+    big data partition can be produced and transferred in parallel pieces.
+
+    ``zero_free`` compresses the unallocated blocks of ext2/3/4 and FAT
+    partitions as zeros (see free_ranges), which the manifest's crc/len then
+    reflect: the prepared image is the original with its free space zeroed.
+
+    ``index_interval`` > 0 puts restart points in each part about that many
+    bytes apart (see compress_range) and lists them in an
+    image{suffix}.index.json sidecar, for inflate_from.
+
+    ``chunk_hash_size`` > 0 hashes each part in chunks of that many bytes while
+    compressing it and lists the digests in an image{suffix}.hashes.json
+    sidecar, which diff_hashes compares against a previous build's.
+
+    ``gzip_output`` also writes each image as image{suffix}.img.gz, assembled
+    from its parts (see write_gzip) rather than compressed a second time.
+
+    ``digests`` names hashlib algorithms (e.g. "sha256", "md5") to digest the
+    whole image, each part file and the .img.gz with; they are written to an
+    image{suffix}.digests.json sidecar so release steps need not reread them.
+    The image digest is fed from compress_range's own buffers in image order:
+    a part compressed ahead of its turn holds its bytes until then, up to
+    DIGEST_BUFFER_SIZE per image, and only bytes past that and parts fetched
+    from the cache are read from the image again (see _OrderedDigest).
+
+    ``prime_parts`` primes each part's compressor with the 32 KiB of the image
+    before it, which the consumer has just inflated from the previous part
+    (see compress_range's ``zdict``). The window is read from the image, so
+    parts still compress concurrently and cache independently; they then only
+    inflate standalone with that window, which verify_manifest takes care of.
+
+    ``bmap`` also writes an image{suffix}.bmap block map (bmaptool format) of
+    the blocks that hold non-zero data, each range with its SHA-256, found
+    from the holes and the zero checks of the compression pass itself, so
+    flashers can skip writing the rest. Unmapped blocks read as zeros in the
+    prepared image; like bmaptool, a flasher treats them as don't-care.
+
+    ``pool`` is an executor to run the parts on instead of a pool of ``jobs``
+    threads made for this call, e.g. a long-lived one kept warm by
+    run_worker.
+    """
+    if policy not in POLICIES:
+        raise ValueError(f"Unknown compression policy: {policy}")
+    check_digests(digests)
+    part_kwargs = {
+        "policy": policy,
+        "instrument": instrument,
+        "progress": progress,
+        "block_size": block_size,
+        "block_jobs": jobs,
+        "detect_zeros": detect_zeros,
+        "use_mmap": use_mmap,
+        "cache_dir": cache_dir,
+        "read_ahead": read_ahead,
+        "write_behind": write_behind,
+        "prime_parts": prime_parts,
+    }
+    if index_interval:
+        part_kwargs["index_interval"] = index_interval
+    if chunk_hash_size:
+        part_kwargs["chunk_hash_size"] = chunk_hash_size
+    if digests:
+        part_kwargs["digests"] = list(digests)
+    image_hashes = [[hashlib.new(name) for name in digests] for _image in images]
+    plans = []
+    for image_path, output_dir, suffix in images:
+        size = os.path.getsize(image_path)
+        with open(image_path, "rb") as f:
+            partitions = get_partitions(f)
+        parts = plan_parts(partitions, size, max_part_size)
+        if zero_free:
+            image_free = []
+            with open(image_path, "rb") as f:
+                for partition in partitions:
+                    free = free_ranges(f, partition["start"], partition["end"])
+                    image_free += free
+                    for part in parts:
+                        if part.get("partition_index") == partition["index"]:
+                            part["free"] = _clip_ranges(
+                                free, part["start"], part["end"]
+                            )
+            if prime_parts:
+                # The window before a part is zeroed wherever its bytes were.
+                image_free.sort()
+                for part in parts:
+                    lo = max(0, part["start"] - WINDOW_SIZE)
+                    window_free = _clip_ranges(image_free, lo, part["start"] - 1)
+                    if window_free:
+                        part["window_free"] = window_free
+        if bmap:
+            bmap_block_size = _bmap_block_size(parts)
+            for part in parts:
+                part["bmap_block_size"] = bmap_block_size
+        compressed_dir = os.path.join(output_dir, f"compressed{suffix}")
+        os.makedirs(compressed_dir, exist_ok=True)
+        filenames = [f"part-{i}.deflate" for i in range(len(parts))]
+        out_paths = [os.path.join(compressed_dir, name) for name in filenames]
+        plans.append((parts, filenames, out_paths))
+
+    results = [[None] * len(parts) for parts, _filenames, _out_paths in plans]
+    tasks = [
+        (image_index, part_index)
+        for image_index, (parts, _filenames, _out_paths) in enumerate(plans)
+        for part_index in range(len(parts))
+    ]
+    parallel = pool is not None or (jobs > 1 and len(tasks) > 1)
+    ordered = [
+        _OrderedDigest(image[0], plan[0], hashes)
+        for image, plan, hashes in zip(images, plans, image_hashes)
+        if digests
+    ]
+
+    def compress_task(task, f=None):
+        image_index, part_index = task
+        parts, _filenames, out_paths = plans[image_index]
+        kwargs = part_kwargs
+        if ordered:
+            feed = ordered[image_index].feed(part_index)
+            kwargs = {**part_kwargs, "image_hashes": [feed]}
+        args = (parts[part_index], out_paths[part_index])
+        if f is None:
+            result = _compress_part_at(images[image_index][0], *args, **kwargs)
+        else:
+            result = _compress_part(f, *args, **kwargs)
+        if ordered:
+            ordered[image_index].finish(part_index)
+        return result
+
+    with contextlib.ExitStack() as stack:
+        if block_size:
+            part_kwargs["block_pool"] = stack.enter_context(BlockPool(jobs))
+        if parallel:
+
+            def task_size(task):
+                part = plans[task[0]][0][task[1]]
+                return part["end"] - part["start"]
+
+            if pool is None:
+                pool = stack.enter_context(
+                    concurrent.futures.ThreadPoolExecutor(max_workers=jobs)
+                )
+            futures = {
+                task: pool.submit(compress_task, task)
+                for task in sorted(tasks, key=task_size, reverse=True)
+            }
+            for (image_index, part_index), future in futures.items():
+                results[image_index][part_index] = future.result()
+        else:
+            for image_index, (image_path, _output_dir, _suffix) in enumerate(images):
+                with open(image_path, "rb") as f:
+                    for part_index in range(len(plans[image_index][0])):
+                        results[image_index][part_index] = compress_task(
+                            (image_index, part_index), f
+                        )
+    if cache_dir and cache_max_size:
+        evict_cache(cache_dir, cache_max_size)
+
+    manifest_paths = []
+    for (_image_path, output_dir, suffix), plan, image_results, hashes in zip(
+        images, plans, results, image_hashes
+    ):
+        parts, filenames, _out_paths = plan
+        manifest_paths.append(
+            _write_manifest(output_dir, suffix, parts, filenames, image_results)
+        )
+        if policy != "default" or instrument:
+            _write_stats(output_dir, suffix, filenames, image_results)
+        if index_interval:
+            _write_index(output_dir, suffix, filenames, image_results, index_interval)
+        if chunk_hash_size:
+            _write_hashes(
+                output_dir, suffix, parts, filenames, image_results, chunk_hash_size
+            )
+        gzip_hashes = [hashlib.new(name) for name in digests] if gzip_output else None
+        if gzip_output:
+            write_gzip(manifest_paths[-1], hashes=gzip_hashes)
+        if digests:
+            _write_digests(
+                output_dir, suffix, filenames, image_results, hashes, gzip_hashes
+            )
+        if bmap:
+            block_size = parts[0]["bmap_block_size"] if parts else BMAP_BLOCK_SIZE
+            _write_bmap(output_dir, suffix, parts, image_results, block_size)
+    if instrument and stats_path:
+        write_stats_summary(stats_path, manifest_paths)
+    return manifest_paths
+
+
+def prepare_raw_image(image_path, output_dir, suffix="", **kwargs):
+    """Compress ``image_path`` into compressed{suffix}/part-N.deflate parts and
+    write the image{suffix}.json manifest under ``output_dir``.
+
+    Takes the same keyword options as prepare_raw_images.
+    """
+    return prepare_raw_images([(image_path, output_dir, suffix)], **kwargs)[0]
+
+
+# --- imperative shell: streamed input -------------------------------------
+
+# Read size when pulling from a streamed (piped or decompressed) image.
+STREAM_READ_SIZE = 1 << 20  # 1 MiB
+# Magic numbers of the compressed image formats opened transparently.
+_STREAM_FORMATS = (
+    (b"\x1f\x8b", gzip.open),
+    (b"\xfd7zXZ\x00", lzma.open),
+    (b"BZh", bz2.open),
+)
+
+
+class _StreamFile:
+    """Forward-only, seekable-within-a-window view of a non-seekable stream.
+
+    Bytes are buffered from ``keep_from`` (or from the read position when it
+    is None) onwards, so the parsers can look ahead and seek back while the
+    partition layout is discovered, and the compressor can then consume the
+    stream once with bounded memory. ``keep_behind`` more bytes before that
+    are kept too.
+    """
+
+    def __init__(self, stream):
+        self._stream = stream
+        self._buf = bytearray()
+        self._buf_start = 0
+        self._pos = 0
+        self._eof = False
+        self.keep_from = 0
+        self.keep_behind = 0
+
+    def seek(self, offset):
+        if offset < self._buf_start:
+            raise ValueError(f"Cannot seek back to {offset} in a streamed image")
+        self._pos = offset
+
+    def tell(self):
+        return self._pos
+
+    def read(self, size):
+        want = self._pos + size - self._buf_start
+        while len(self._buf) < want and not self._eof:
+            data = self._stream.read(max(STREAM_READ_SIZE, want - len(self._buf)))
+            if data:
+                self._buf += data
+            else:
+                self._eof = True
+        rel = self._pos - self._buf_start
+        data = bytes(self._buf[rel : rel + size])
+        self._pos += len(data)
+        keep = self._pos if self.keep_from is None else min(self._pos, self.keep_from)
+        keep -= self.keep_behind
+        if keep > self._buf_start:
+            # bytearray deletes from the front in O(1) amortized.
+            del self._buf[: keep - self._buf_start]
+            self._buf_start = keep
+        return data
+
+
+def _is_compressed(path):
+    with open(path, "rb") as fh:
+        head = fh.read(6)
+    return any(head.startswith(magic) for magic, _opener in _STREAM_FORMATS)
+
+
+def open_image_stream(path):
+    """Open ``path`` ('-' for stdin, or a buffered binary file object) as a
+    stream, decompressing gzip, xz and bzip2 transparently based on their magic
+    numbers.
+
+    A file opened here by path is reopened by the decompressor itself, so that
+    closing the returned stream closes it too; a file object (or stdin) stays
+    owned by the caller.
+    """
+    owned = not hasattr(path, "read") and path != "-"
+    if hasattr(path, "read"):
+        raw = path
+    else:
+        raw = sys.stdin.buffer if path == "-" else open(path, "rb")
+    head = raw.peek(6)[:6] if hasattr(raw, "peek") else b""
+    for magic, opener in _STREAM_FORMATS:
+        if head.startswith(magic):
+            if owned:
+                raw.close()
+                return opener(path, "rb")
+            return opener(raw, "rb")
+    return raw
+
+
+def prepare_stream_image(
+    stream,
+    output_dir,
+    suffix="",
+    block_size=0,
+    block_jobs=1,
+    detect_zeros=True,
+    instrument=False,
+    progress=None,
+    read_ahead=0,
+    write_behind=0,
+    max_part_size=0,
+    index_interval=0,
+    chunk_hash_size=0,
+    gzip_output=False,
+    digests=(),
+    prime_parts=False,
+    bmap=False,
+):
+    """prepare_raw_image for a non-seekable stream (a pipe or a decompressor).
+
+    The partition table is parsed from the head of the stream; for MBR images
+    the EBR chain is followed as the stream passes each EBR, which always
+    precedes its logical partition. Parts are then compressed strictly in
+    order while the stream is consumed once, so memory stays bounded by the
+    largest lookahead (the gap before an EBR) rather than the image size. The
+    trailing gap runs to EOF, since the size is unknown up front.
+
+    Produces the same parts and manifest as the file path. Per-part policies
+    and the part cache need random access to a part before compressing it, so
+    they are file-only, as is spreading parts across workers; ``block_size``
+    still parallelizes within each part. ``read_ahead`` moves the stream
+    reads (and so the decompression) onto a reader thread. ``max_part_size``
+    splits parts as in prepare_raw_images, except for the trailing gap, whose
+    size is not known until the stream ends. ``index_interval`` and
+    ``chunk_hash_size`` write the seek index and chunk hash sidecars,
+    ``gzip_output`` the .img.gz and ``digests`` the digests sidecar, as in
+    prepare_raw_images; the parts stream past in order, so the whole image is
+    always digested from compress_range's buffers. ``prime_parts`` keeps the
+    last WINDOW_SIZE bytes of the stream buffered to prime the next part with.
+    ``bmap`` maps SECTOR_SIZE blocks: the part boundaries are not known in
+    advance, but always fall on sectors.
+    """
+    check_digests(digests)
+    f = _StreamFile(stream)
+    if prime_parts:
+        f.keep_behind = WINDOW_SIZE
+    part_kwargs = {
+        "instrument": instrument,
+        "progress": progress,
+        "block_size": block_size,
+        "block_jobs": block_jobs,
+        "detect_zeros": detect_zeros,
+        "read_ahead": read_ahead,
+        "write_behind": write_behind,
+        "prime_parts": prime_parts,
+    }
+    if index_interval:
+        part_kwargs["index_interval"] = index_interval
+    if chunk_hash_size:
+        part_kwargs["chunk_hash_size"] = chunk_hash_size
+    if bmap:
+        part_kwargs["bmap_block_size"] = SECTOR_SIZE
+    image_hashes = [hashlib.new(name) for name in digests]
+    if digests:
+        part_kwargs["digests"] = list(digests)
+        part_kwargs["image_hashes"] = image_hashes
+    known = []
+    next_ebr = None
+    mbr_entries = _mbr_entries(_read_at(f, 0, SECTOR_SIZE))
+    if mbr_entries and mbr_entries[0]["type"] == GPT_PROTECTIVE_MBR_TYPE:
+        known = get_partitions(f)  # header and entry array sit at the head
+    else:
+        known, extended = _mbr_primaries(f)
+        if extended is not None:
+            extended_base = extended["lba_start"] * SECTOR_SIZE
+            next_ebr = (
+                extended_base,
+                MBR_FIRST_LOGICAL_PARTITION,
+                MAX_LOGICAL_PARTITIONS,
+            )
+
+    compressed_dir = os.path.join(output_dir, f"compressed{suffix}")
+    os.makedirs(compressed_dir, exist_ok=True)
+    parts, filenames, results = [], [], []
+
+    def emit(part):
+        if part["end"] is not None:
+            pieces = split_part(part, max_part_size)
+            if len(pieces) > 1:
+                for piece in pieces:
+                    emit(piece)
+                return
+        filename = f"part-{len(parts)}.deflate"
+        out_path = os.path.join(compressed_dir, filename)
+        f.keep_from = None  # consume the part once, without retaining it
+        result = _compress_part(f, part, out_path, **part_kwargs)
+        if part["end"] is None:
+            if result[0]["len"] == 0:
+                os.remove(out_path)  # the last partition ended at EOF
+                return
+            end = part["start"] + result[0]["len"] - 1
+            part = {"start": part["start"], "end": end}
+        parts.append(part)
+        filenames.append(filename)
+        results.append(result)
+
+    pos = 0
+    while True:
+        f.keep_from = pos
+        upcoming = [p for p in known if p["end"] >= pos]
+        # Discover logical partitions whose EBR comes before the next known one.
+        while next_ebr is not None and (
+            not upcoming or next_ebr[0] < min(p["start"] for p in upcoming)
+        ):
+            offset, index, limit = next_ebr
+            if offset < pos:
+                raise ValueError(f"EBR at {offset} lies behind the stream position")
+            buf = _read_at(f, offset, SECTOR_SIZE)
+            found, offset = _ebr_partitions(buf, index, offset, extended_base)
+            known.extend(found)
+            upcoming.extend(found)
+            if offset is None or limit <= 1:
+                next_ebr = None
+            else:
+                next_ebr = (offset, index + 1, limit - 1)
+        if not upcoming:
+            emit({"start": pos, "end": None})
+            break
+        partition = min(upcoming, key=lambda p: p["start"])
+        if partition["start"] < pos:
+            raise ValueError("Overlapping partitions cannot be streamed")
+        if partition["start"] > pos:
+            emit({"start": pos, "end": partition["start"] - 1})
+        emit(
+            {
+                "start": partition["start"],
+                "end": partition["end"],
+                "partition_index": partition["index"],
+            }
+        )
+        pos = partition["end"] + 1
+
+    manifest_path = _write_manifest(output_dir, suffix, parts, filenames, results)
+    if instrument:
+        _write_stats(output_dir, suffix, filenames, results)
+    if index_interval:
+        _write_index(output_dir, suffix, filenames, results, index_interval)
+    if chunk_hash_size:
+        _write_hashes(output_dir, suffix, parts, filenames, results, chunk_hash_size)
+    gzip_hashes = [hashlib.new(name) for name in digests] if gzip_output else None
+    if gzip_output:
+        write_gzip(manifest_path, hashes=gzip_hashes)
+    if digests:
+        _write_digests(
+            output_dir, suffix, filenames, results, image_hashes, gzip_hashes
+        )
+    if bmap:
+        _write_bmap(output_dir, suffix, parts, results, SECTOR_SIZE)
+    return manifest_path
+
+
+# --- imperative shell: verification ----------------------------------------
+
+
+SYNC_MARKER = b"\x00\x00\xff\xff"
+
+
+def _inflate_chunks(fh, zdict=b""):
+    """Yield the inflated bytes of a raw DEFLATE part, at most CHUNK_SIZE at a time.
+
+    Zero runs expand ~1000x, so output is drained in bounded slices rather than
+    per input chunk. ``zdict`` is the window a primed part was compressed
+    against. Raises ValueError if the part is not a bare sequence of non-final
+    blocks.
+    """
+    d = zlib.decompressobj(-zlib.MAX_WBITS, zdict=zdict)
+    for data in iter(functools.partial(fh.read, CHUNK_SIZE), b""):
+        while True:
+            out = d.decompress(data, CHUNK_SIZE)
+            if out:
+                yield out
+            data = d.unconsumed_tail
+            if not data and len(out) < CHUNK_SIZE:
+                break
+    if d.eof:
+        raise ValueError("contains a final block; parts must not be terminated")
+
+
+def _first_difference(a, b):
+    """Index of the first differing byte of two unequal buffers."""
+    pairs = enumerate(zip(a, b))
+    return next((i for i, (x, y) in pairs if x != y), min(len(a), len(b)))
+
+
+def verify_part(part_path, entry, image_path=None, offset=0, zdict=b""):
+    """Check one part file against its manifest entry; return a list of problems.
+
+    Checks zLen against the file size, the trailing sync marker, and the crc
+    and len of the inflated bytes. With ``image_path``, the inflated bytes are
+    also compared with the image from ``offset`` on. A ``primed`` part needs
+    the WINDOW_SIZE bytes before it as ``zdict``.
+    """
+    return _check_part(part_path, entry, image_path, offset, zdict)[0]
+
+
+def _check_part(part_path, entry, image_path, offset, window):
+    """verify_part, also returning the window after the part.
+
+    ``window`` is the inflated output before the part (up to WINDOW_SIZE
+    bytes), the dictionary of a primed part; on success the returned window
+    ends with the part's own output.
+    """
+    name = entry["filename"]
+    zdict = window if entry.get("primed") else b""
+    try:
+        z_len = os.path.getsize(part_path)
+    except OSError as e:
+        return [f"{name}: {e.strerror}"], b""
+    problems = []
+    if z_len != entry["zLen"]:
+        problems.append(f"{name}: zLen {z_len} != manifest {entry['zLen']}")
+    crc = 0
+    length = 0
+    mismatch = None
+    image = open(image_path, "rb") if image_path else None
+    try:
+        with open(part_path, "rb") as fh:
+            if image is not None:
+                image.seek(offset)
+            try:
+                for out in _inflate_chunks(fh, zdict):
+                    crc = zlib.crc32(out, crc)
+                    window = (window + out[-WINDOW_SIZE:])[-WINDOW_SIZE:]
+                    if image is not None and mismatch is None:
+                        expected = image.read(len(out))
+                        if out != expected:
+                            diff = _first_difference(out, expected)
+                            mismatch = offset + length + diff
+                    length += len(out)
+            except (ValueError, zlib.error) as e:
+                return problems + [f"{name}: invalid DEFLATE stream: {e}"], b""
+            fh.seek(max(0, z_len - len(SYNC_MARKER)))
+            if fh.read() != SYNC_MARKER:
+                problems.append(f"{name}: does not end with the sync flush marker")
+    finally:
+        if image is not None:
+            image.close()
+    if length != entry["len"]:
+        problems.append(f"{name}: len {length} != manifest {entry['len']}")
+    if crc != entry["crc"]:
+        problems.append(f"{name}: crc {crc:#010x} != manifest {entry['crc']:#010x}")
+    if mismatch is not None:
+        problems.append(f"{name}: differs from the image at offset {mismatch}")
+    return problems, window
+
+
+def verify_manifest(manifest_path, image_path=None, jobs=1):
+    """Verify every part listed in an image{suffix}.json; return the problems.
+
+    Parts are read from the compressed{suffix}/ directory next to the manifest
+    and inflated on ``jobs`` threads, largest first. With ``image_path`` each
+    part is also compared with its slice of the original image; since every
+    part is checked to be a run of non-final blocks ending on a sync flush,
+    this is equivalent to inflating the concatenated parts plus DEFLATE_END,
+    without needing the whole stream (or image) in memory.
+
+    A primed part (see prepare_raw_images) inflates against the window before
+    it, which is read from ``image_path`` if given; otherwise it only exists as
+    the previous part's output, so such manifests are checked in order on one
+    thread.
+    """
+    directory, manifest_name = os.path.split(os.path.abspath(manifest_path))
+    suffix = manifest_name[len("image") : -len(".json")]
+    parts_dir = os.path.join(directory, f"compressed{suffix}")
+    with open(manifest_path) as fh:
+        entries = json.load(fh)["resin.img"]["parts"]
+
+    offsets = []
+    total = 0
+    for entry in entries:
+        offsets.append(total)
+        total += entry["len"]
+    problems = []
+    if image_path is not None and os.path.getsize(image_path) != total:
+        problems.append(
+            f"{manifest_name}: parts cover {total} bytes, image is "
+            f"{os.path.getsize(image_path)}"
+        )
+
+    if image_path is None and any(entry.get("primed") for entry in entries):
+        window = b""
+        for entry, offset in zip(entries, offsets):
+            part_path = os.path.join(parts_dir, entry["filename"])
+            part_problems, window = _check_part(part_path, entry, None, offset, window)
+            problems += part_problems
+        return problems
+
+    def check(index):
+        entry = entries[index]
+        part_path = os.path.join(parts_dir, entry["filename"])
+        zdict = b""
+        if entry.get("primed"):
+            with open(image_path, "rb") as image:
+                zdict = _window_before(image, offsets[index])
+        return verify_part(part_path, entry, image_path, offsets[index], zdict)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as pool:
+        order = sorted(range(len(entries)), key=lambda i: -entries[i]["zLen"])
+        futures = {index: pool.submit(check, index) for index in order}
+        for index in range(len(entries)):
+            problems += futures[index].result()
+    return problems
+
+
+def verify_main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="prepare-image.py verify",
+        description="Check compressed parts against their image*.json manifest.",
+    )
+    parser.add_argument("manifest", nargs="+", help="image{suffix}.json to verify")
+    parser.add_argument(
+        "--image",
+        help="Also check that the parts inflate to this raw .img (one manifest only)",
+    )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=0,
+        help="Number of parts to inflate concurrently (default: 0 = one per CPU)",
+    )
+    args = parser.parse_args(argv)
+    if args.jobs < 0:
+        parser.error("--jobs must be >= 0")
+    if args.image and len(args.manifest) > 1:
+        parser.error("--image needs exactly one manifest")
+    jobs = args.jobs or os.cpu_count() or 1
+
+    failed = False
+    for manifest_path in args.manifest:
+        problems = verify_manifest(manifest_path, args.image, jobs)
+        for problem in problems:
+            print(problem, file=sys.stderr)
+        failed = failed or bool(problems)
+        status = "FAILED" if problems else "OK"
+        print(f"{status}: {os.path.basename(manifest_path)}")
+    return 1 if failed else 0
+
+
+# --- imperative shell: seek index reader -----------------------------------
+
+
+def load_index(manifest_path):
+    """Return {filename: index points} from the index sidecar of a manifest."""
+    with open(manifest_path[: -len(".json")] + ".index.json") as fh:
+        parts = json.load(fh)["resin.img"]["parts"]
+    return {part["filename"]: part["points"] for part in parts}
+
+
+def index_point(points, offset):
+    """The last index point at or before uncompressed ``offset`` in a part."""
+    return points[max(0, bisect.bisect_right(points, [offset, math.inf]) - 1)]
+
+
+def inflate_from(fh, point, zdict=b""):
+    """Yield a part's inflated bytes from an index ``point`` to its end.
+
+    ``fh`` is the part file, positioned anywhere. Each chunk can be checked
+    with zlib.crc32 from the point's crc on, so a resumed download or flash
+    still ends with the part's manifest crc. Inflating a primed part from its
+    start needs the window before the part as ``zdict``; the later points are
+    full flushes and need nothing.
+    """
+    fh.seek(point[1])
+    yield from _inflate_chunks(fh, zdict if point[0] == 0 else b"")
+
+
+def read_part_range(part_path, points, offset, length, zdict=b""):
+    """Return ``length`` uncompressed bytes of a part from ``offset`` on, inflating
+    only from the nearest index point before it (see inflate_from for
+    ``zdict``)."""
+    point = index_point(points, offset)
+    skip = offset - point[0]
+    data = bytearray()
+    with open(part_path, "rb") as fh:
+        for chunk in inflate_from(fh, point, zdict):
+            if skip >= len(chunk):
+                skip -= len(chunk)
+                continue
+            data += chunk[skip : skip + length - len(data)]
+            skip = 0
+            if len(data) == length:
+                break
+    return bytes(data)
+
+
+# --- imperative shell: chunk hash diff -------------------------------------
+
+
+def load_hashes(hashes_path):
+    """Return (chunk size, [(image offset, length, digest)]) from a hashes sidecar."""
+    with open(hashes_path) as fh:
+        index = json.load(fh)["resin.img"]
+    chunk_size = index["chunk_size"]
+    chunks = []
+    for part in index["parts"]:
+        for i, digest in enumerate(part["hashes"]):
+            offset = i * chunk_size
+            length = min(chunk_size, part["len"] - offset)
+            chunks.append((part["start"] + offset, length, digest))
+    return chunk_size, sorted(chunks)
+
+
+def diff_hashes(old_path, new_path):
+    """Compare two builds' image{suffix}.hashes.json; return the changed ranges.
+
+    A chunk of the new image is unchanged when the old index has a chunk with
+    the same offset, length and digest; everything else is reported as
+    [offset, length] byte ranges of the new image, adjacent ones merged.
+    """
+    old_size, old_chunks = load_hashes(old_path)
+    new_size, new_chunks = load_hashes(new_path)
+    if old_size != new_size:
+        raise ValueError(
+            f"Chunk sizes differ ({old_size} and {new_size}); rebuild one "
+            "index with the other's --chunk-hash-size"
+        )
+    old = {(offset, length): digest for offset, length, digest in old_chunks}
+    changed = []
+    unchanged_bytes = 0
+    for offset, length, digest in new_chunks:
+        if old.get((offset, length)) == digest:
+            unchanged_bytes += length
+        elif changed and changed[-1][0] + changed[-1][1] == offset:
+            changed[-1][1] += length
+        else:
+            changed.append([offset, length])
+    return {
+        "chunk_size": new_size,
+        "changed": changed,
+        "changed_bytes": sum(length for _offset, length in changed),
+        "unchanged_bytes": unchanged_bytes,
+    }
+
+
+def diff_main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="prepare-image.py diff",
+        description="Report the byte ranges of a new image that differ from an "
+        "old one, from their image*.hashes.json chunk hash indexes.",
+    )
+    parser.add_argument("old", help="image{suffix}.hashes.json of the old build")
+    parser.add_argument("new", help="image{suffix}.hashes.json of the new build")
+    args = parser.parse_args(argv)
+    try:
+        report = diff_hashes(args.old, args.new)
+    except (OSError, ValueError, KeyError) as e:
+        parser.error(str(e))
+    json.dump(report, sys.stdout)
+    print()
+    return 0
+
+
+# --- imperative shell: worker mode -----------------------------------------
+
+# Job keys passed on to prepare_raw_images (sizes in bytes, as in the API).
+JOB_OPTIONS = (
+    "block_size",
+    "detect_zeros",
+    "use_mmap",
+    "cache_dir",
+    "cache_max_size",
+    "policy",
+    "instrument",
+    "read_ahead",
+    "write_behind",
+    "max_part_size",
+    "zero_free",
+    "index_interval",
+    "chunk_hash_size",
+    "gzip_output",
+    "digests",
+    "prime_parts",
+    "bmap",
+)
+# Seconds between scans of a watched directory.
+WATCH_POLL = 2.0
+
+
+def prepare_job(job, pool=None, progress=None, **defaults):
+    """Prepare the image a job describes; return its manifest path.
+
+    A job is a dict with the ``image`` path and optionally its ``type`` (the
+    IMAGE:TYPE of the CLI), an ``output_dir`` (default: the image's directory)
+    and any JOB_OPTIONS, which override ``defaults``. Compressed images are
+    streamed as in main().
+    """
+    unknown = set(job) - {"image", "type", "output_dir", *JOB_OPTIONS}
+    if unknown:
+        raise ValueError(f"Unknown job keys: {', '.join(sorted(unknown))}")
+    image_path = job["image"]
+    output_dir = job.get("output_dir") or os.path.dirname(os.path.abspath(image_path))
+    suffix = f"-{job['type']}" if job.get("type") else ""
+    kwargs = {**defaults, **{k: v for k, v in job.items() if k in JOB_OPTIONS}}
+    check_digests(kwargs.get("digests", ()))
+    if _is_compressed(image_path):
+        with open_image_stream(image_path) as stream:
+            return prepare_stream_image(
+                stream, output_dir, suffix, progress=progress, **_stream_kwargs(kwargs)
+            )
+    images = [(image_path, output_dir, suffix)]
+    return prepare_raw_images(images, pool=pool, progress=progress, **kwargs)[0]
+
+
+def run_worker(jobs, emit, workers=1, progress=None, **defaults):
+    """Prepare each job from the ``jobs`` iterable as it arrives.
+
+    All parts run on one thread pool of ``workers`` threads that stays up
+    between jobs. Every job ends with a "job_done" event carrying its manifest
+    (or "job_failed" with the error) passed to ``emit``; a failed job does not
+    stop the worker.
+    """
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+        for job in jobs:
+            began = time.perf_counter()
+            image = job.get("image") if isinstance(job, dict) else None
+            try:
+                if image is None:
+                    raise ValueError("A job needs an 'image'")
+                manifest_path = prepare_job(
+                    job, pool, progress, jobs=workers, **defaults
+                )
+            except Exception as e:
+                # Whatever a bad image makes the readers and parsers raise
+                # (EOFError, zlib.error, struct.error...) fails only its job.
+                error = str(e) or type(e).__name__
+                emit({"event": "job_failed", "image": image, "error": error})
+                continue
+            seconds = round(time.perf_counter() - began, 3)
+            emit(
+                {
+                    "event": "job_done",
+                    "image": image,
+                    "manifest": manifest_path,
+                    "seconds": seconds,
+                }
+            )
+
+
+def read_jobs(stream):
+    """Yield jobs from JSON lines; a bare string is taken as an image path."""
+    for line in stream:
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            job = json.loads(line)
+        except ValueError:
+            job = {"line": line}  # fails in run_worker, with the others
+        yield {"image": job} if isinstance(job, str) else job
+
+
+def watch_jobs(directory, matches=(("*.img", ""),), output_dir=None, polls=None):
+    """Yield a job for each image that lands in ``directory``.
+
+    ``matches`` are (glob, image type) pairs tried in order against the file
+    names; symlinks (e.g. Yocto's unversioned image links) are left alone.
+    Each image is prepared into its own NAME.prepared/ directory under
+    ``output_dir`` (default: ``directory``), so images matching the same glob
+    do not overwrite each other's manifest and parts. An image is picked up
+    once its size and mtime held still for a poll (so it is not read
+    half-copied), unless its manifest is newer than it, and again whenever it
+    changes. ``polls`` limits the number of scans.
+    """
+    seen = {}
+    settled = {}
+    scans = itertools.count() if polls is None else range(polls)
+    for scan in scans:
+        if scan:
+            time.sleep(WATCH_POLL)
+        for name in sorted(os.listdir(directory)):
+            image_type = next(
+                (t for pattern, t in matches if fnmatch.fnmatch(name, pattern)), None
+            )
+            path = os.path.join(directory, name)
+            if image_type is None or os.path.islink(path) or not os.path.isfile(path):
+                continue
+            st = os.stat(path)
+            stamp = (st.st_size, st.st_mtime_ns)
+            if seen.get(path) == stamp:
+                continue
+            if settled.get(path) != stamp:
+                settled[path] = stamp  # wait for it to hold still
+                continue
+            seen[path] = stamp
+            suffix = f"-{image_type}" if image_type else ""
+            image_dir = os.path.join(output_dir or directory, f"{name}.prepared")
+            manifest_path = os.path.join(image_dir, f"image{suffix}.json")
+            try:
+                if os.stat(manifest_path).st_mtime_ns >= st.st_mtime_ns:
+                    continue  # prepared by an earlier run
+            except FileNotFoundError:
+                pass
+            os.makedirs(image_dir, exist_ok=True)
+            yield {"image": path, "type": image_type, "output_dir": image_dir}
+
+
+def _split_match(arg):
+    """Split a ``GLOB[=TYPE]`` --match argument."""
+    pattern, _sep, image_type = arg.partition("=")
+    return pattern, image_type
+
+
+def worker_main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="prepare-image.py worker",
+        description="Prepare images as jobs arrive, on a worker pool kept warm "
+        "between them. Jobs are JSON lines on stdin ({\"image\": PATH, "
+        "\"type\": TYPE, \"output_dir\": DIR, ...options}) unless --watch is "
+        "given; a JSON-lines event per finished job goes to stdout.",
+    )
+    parser.add_argument(
+        "--watch",
+        metavar="DIR",
+        help="Prepare the images that land in this directory instead",
+    )
+    parser.add_argument(
+        "--match",
+        action="append",
+        type=_split_match,
+        metavar="GLOB[=TYPE]",
+        help="With --watch, the image file names to pick up and their image "
+        "type (repeatable; default: *.img with no type)",
+    )
+    parser.add_argument(
+        "-o",
+        "--output-dir",
+        help="With --watch, where to write each image's NAME.prepared/ "
+        "directory of compressed{suffix}/ and image{suffix}.json (default: the "
+        "watched directory)",
+    )
+    _add_prepare_arguments(parser)
+    args = parser.parse_args(argv)
+    defaults = _prepare_kwargs(parser, args)
+    workers = defaults.pop("jobs")
+    if args.watch:
+        jobs = watch_jobs(args.watch, args.match or [("*.img", "")], args.output_dir)
+    else:
+        jobs = read_jobs(sys.stdin)
+    progress, progress_file = _open_progress(args.progress)
+    try:
+        run_worker(jobs, progress_writer(sys.stdout), workers, progress, **defaults)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if progress_file is not None:
+            progress_file.close()
+    return 0
+
+
+def _split_image_arg(arg, default_type):
+    """Split an ``IMAGE[:TYPE]`` argument; an existing path always wins."""
+    path, sep, image_type = arg.rpartition(":")
+    if os.path.isfile(arg) or not sep or "/" in image_type:
+        return arg, default_type
+    return path, image_type
+
+
+def _add_prepare_arguments(parser):
+    """Add the compression options shared by the one-shot and worker modes."""
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=1,
+        help="Number of parts to compress concurrently, across all images "
+        "(default: 1; 0 = one per CPU)",
+    )
+    parser.add_argument(
+        "--block-size",
+        type=int,
+        default=0,
+        metavar="MIB",
+        help="Also split each part into blocks of this many MiB compressed on "
+        "--jobs threads (default: 0 = whole-part streams)",
+    )
+    parser.add_argument(
+        "--no-zero-detect",
+        dest="detect_zeros",
+        action="store_false",
+        help="Compress holes and all-zero chunks through zlib like any other data",
+    )
+    parser.add_argument(
+        "--mmap",
+        dest="use_mmap",
+        action="store_true",
+        help="Read the image through a memory mapping (zero-copy) instead of "
+        "buffered reads",
+    )
+    parser.add_argument(
+        "--max-part-size",
+        type=int,
+        default=0,
+        metavar="MIB",
+        help="Split partitions and gaps larger than this many MiB into several "
+        "consecutive parts, which keep their partitionIndex (default: 0 = one "
+        "part per partition)",
+    )
+    parser.add_argument(
+        "--index-interval",
+        type=int,
+        default=0,
+        metavar="MIB",
+        help="Make a restart point in each part about every this many MiB and "
+        "list them in image{suffix}.index.json, so parts can be inflated from "
+        "the middle (default: 0 = no index)",
+    )
+    parser.add_argument(
+        "--chunk-hash-size",
+        type=int,
+        default=0,
+        metavar="MIB",
+        help="SHA-256 each part in chunks of this many MiB as it is compressed "
+        "and list them in image{suffix}.hashes.json, for delta updates against "
+        "another build ('diff'; default: 0 = no hashes)",
+    )
+    parser.add_argument(
+        "--gzip",
+        dest="gzip_output",
+        action="store_true",
+        help="Also write image{suffix}.img.gz, assembled from the parts with a "
+        "gzip header and footer instead of compressing the image again",
+    )
+    parser.add_argument(
+        "--digests",
+        type=lambda value: [name for name in value.split(",") if name],
+        default=[],
+        metavar="ALGS",
+        help="Comma-separated hashlib algorithms (e.g. sha256,md5) to digest the "
+        "whole image, each part and the --gzip file with while compressing, "
+        "written to image{suffix}.digests.json. Parts fetched from the cache, "
+        "and parts that run more than 64 MiB ahead of their turn in parallel "
+        "runs, are read again for the image digest",
+    )
+    parser.add_argument(
+        "--prime-parts",
+        action="store_true",
+        help="Prime each part's compressor with the 32 KiB of the image before "
+        "it, which consumers inflating the concatenated parts already hold "
+        "(smaller part starts; primed parts no longer inflate on their own)",
+    )
+    parser.add_argument(
+        "--bmap",
+        action="store_true",
+        help="Also write image{suffix}.bmap, a bmaptool block map of the blocks "
+        "holding data (with per-range SHA-256), so flashers can skip the rest",
+    )
+    parser.add_argument(
+        "--zero-free",
+        action="store_true",
+        help="Emit the unallocated blocks of ext2/3/4 and FAT partitions as "
+        "zeros (the manifest then describes the zeroed image)",
+    )
+    parser.add_argument(
+        "--read-ahead",
+        type=int,
+        default=0,
+        metavar="CHUNKS",
+        help="Read on a separate thread, prefetching up to this many chunks "
+        "(--block-size blocks, or 1 MiB) ahead of the compressor into reused "
+        "buffers (default: 0 = read inline)",
+    )
+    parser.add_argument(
+        "--write-behind",
+        type=int,
+        default=0,
+        metavar="WRITES",
+        help="Queue up to this many writes to a writer thread that coalesces "
+        "them and preallocates the part files (default: 0 = write inline)",
+    )
+    parser.add_argument(
+        "--policy",
+        choices=POLICIES,
+        default="default",
+        help="Per-part zlib level/strategy: 'default' for all parts, 'tuned' "
+        "rules (stored for incompressible data, level 1 for gaps, level 9 for "
+        "partitions) or 'auto' sampling (default: default)",
+    )
+    parser.add_argument(
+        "--auto",
+        dest="policy",
+        action="store_const",
+        const="auto",
+        help="Shorthand for --policy auto",
+    )
+    parser.add_argument(
+        "--progress",
+        metavar="FILE",
+        help="Stream JSON-lines progress events to FILE ('-' for stderr)",
+    )
+    parser.add_argument(
+        "--cache-dir",
+        help="Reuse compressed parts from (and add new ones to) this "
+        "content-addressed cache directory",
+    )
+    parser.add_argument(
+        "--cache-max-size",
+        type=int,
+        default=0,
+        metavar="MIB",
+        help="Evict least recently used cache entries beyond this many MiB "
+        "(default: 0 = unbounded)",
+    )
+
+
+def _prepare_kwargs(parser, args):
+    """Validate the shared options; return prepare_raw_images keyword arguments."""
+    for name in (
+        "jobs",
+        "block_size",
+        "max_part_size",
+        "index_interval",
+        "chunk_hash_size",
+        "read_ahead",
+        "write_behind",
+        "cache_max_size",
+    ):
+        if getattr(args, name) < 0:
+            parser.error(f"--{name.replace('_', '-')} must be >= 0")
+    try:
+        check_digests(args.digests)
+    except ValueError as e:
+        parser.error(f"--digests: {e}")
+    return {
+        "jobs": args.jobs or os.cpu_count() or 1,
+        "block_size": args.block_size << 20,
+        "detect_zeros": args.detect_zeros,
+        "use_mmap": args.use_mmap,
+        "cache_dir": args.cache_dir,
+        "cache_max_size": args.cache_max_size << 20,
+        "policy": args.policy,
+        "read_ahead": args.read_ahead,
+        "write_behind": args.write_behind,
+        "max_part_size": args.max_part_size << 20,
+        "zero_free": args.zero_free,
+        "index_interval": args.index_interval << 20,
+        "chunk_hash_size": args.chunk_hash_size << 20,
+        "gzip_output": args.gzip_output,
+        "digests": args.digests,
+        "prime_parts": args.prime_parts,
+        "bmap": args.bmap,
+    }
+
+
+# prepare_raw_images options that only apply to a raw .img.
+_FILE_ONLY_KWARGS = ("policy", "cache_dir", "cache_max_size", "zero_free", "use_mmap")
+
+
+def _stream_kwargs(kwargs):
+    """prepare_stream_image keyword arguments from prepare_raw_images ones.
+
+    Raises ValueError for the options that need random access to the image;
+    the memory mapping is simply not used for a stream.
+    """
+    if (
+        kwargs.get("policy", "default") != "default"
+        or kwargs.get("cache_dir")
+        or kwargs.get("zero_free")
+    ):
+        raise ValueError(
+            "--policy/--auto, --cache-dir and --zero-free need a raw .img, "
+            "not a stream"
+        )
+    stream_kwargs = {k: v for k, v in kwargs.items() if k not in _FILE_ONLY_KWARGS}
+    stream_kwargs["block_jobs"] = stream_kwargs.pop("jobs", 1)
+    return stream_kwargs
+
+
+def _open_progress(path):
+    """Return (emit, file to close) for a --progress argument."""
+    if path == "-":
+        return progress_writer(sys.stderr), None
+    if path:
+        progress_file = open(path, "w")
+        return progress_writer(progress_file), progress_file
+    return None, None
+
+
+# Subcommands, chosen by the first argument alone; an image file with one of
+# these names is given as ./NAME or after "--".
+SUBCOMMANDS = {"verify": verify_main, "worker": worker_main, "diff": diff_main}
+
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv[1:]
+    if argv[:1] and argv[0] in SUBCOMMANDS:
+        return SUBCOMMANDS[argv[0]](argv[1:])
+    parser = argparse.ArgumentParser(
+        description="Compress a balenaOS raw disk image into DEFLATE parts + manifest.",
+        epilog="Subcommands: verify, worker and diff (see SUBCOMMAND --help). "
+        "To compress an image file named like one, give it as ./NAME or after --.",
+    )
+    parser.add_argument(
+        "image",
+        nargs="+",
+        help="Path to the raw .img file to compress. Several images may be given "
+        "as IMAGE:TYPE (e.g. balena.img: flasher.img:flasher raw.img:raw) to "
+        "prepare them together on one worker pool. A .img.gz/.img.xz/.img.bz2 "
+        "or '-' (stdin) is streamed without a temporary .img",
+    )
+    parser.add_argument(
+        "-o",
+        "--output-dir",
+        help="Directory to write compressed{suffix}/ and image{suffix}.json "
+        "(default: the image's directory)",
+    )
+    parser.add_argument(
+        "--image-type",
+        default="",
+        help="Image type for output naming, e.g. 'flasher' -> compressed-flasher/ "
+        "and image-flasher.json (default: none -> compressed/ and image.json); "
+        "applies to images given without :TYPE",
+    )
+    _add_prepare_arguments(parser)
+    parser.add_argument(
+        "--stats",
+        nargs="?",
+        const="",
+        metavar="FILE",
+        help="Time each part's read/crc32/hash/compress/write phases and record "
+        "them with byte counts in image{suffix}.stats.json; with FILE, also "
+        "write per-image totals there",
+    )
+    args = parser.parse_args(argv)
+    kwargs = _prepare_kwargs(parser, args)
+    kwargs["instrument"] = args.stats is not None
+
+    images = []
+    streams = []
+    seen = set()
+    for arg in args.image:
+        image_path, image_type = _split_image_arg(arg, args.image_type)
+        if image_path != "-" and not os.path.isfile(image_path):
+            parser.error(f"Image not found: {image_path}")
+        if args.output_dir:
+            output_dir = args.output_dir
+        elif image_path == "-":
+            output_dir = os.getcwd()
+        else:
+            output_dir = os.path.dirname(os.path.abspath(image_path))
+        suffix = f"-{image_type}" if image_type else ""
+        if (output_dir, suffix) in seen:
+            parser.error(f"More than one image would write image{suffix}.json")
+        seen.add((output_dir, suffix))
+        if image_path == "-" or _is_compressed(image_path):
+            streams.append((image_path, output_dir, suffix))
+        else:
+            images.append((image_path, output_dir, suffix))
+    try:
+        stream_kwargs = _stream_kwargs(kwargs) if streams else {}
+    except ValueError as e:
+        parser.error(str(e))
+
+    progress, progress_file = _open_progress(args.progress)
+    manifest_paths = []
+    try:
+        if images:
+            manifest_paths += prepare_raw_images(images, progress=progress, **kwargs)
+        for image_path, output_dir, suffix in streams:
+            with open_image_stream(image_path) as stream:
+                manifest_paths.append(
+                    prepare_stream_image(
+                        stream, output_dir, suffix, progress=progress, **stream_kwargs
+                    )
+                )
+    finally:
+        if progress_file is not None:
+            progress_file.close()
+    if args.stats:
+        write_stats_summary(args.stats, manifest_paths)
+    for manifest_path in manifest_paths:
+        print(f"Prepared compressed parts and {os.path.basename(manifest_path)}")
+
+
+def run(argv=None):
+    """Script entry point: main() under the umask the build containers expect."""
+    # Match the original script: allow files/folders to be removed from outside
+    # the build container by a non-root user. Kept out of main() so importing
+    # and calling this module has no process-wide side effects.
+    os.umask(0)
+    return main(argv)
+
+
+if __name__ == "__main__":
+    sys.exit(run())
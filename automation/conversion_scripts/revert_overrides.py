@@ -0,0 +1,354 @@
+#!/usr/bin/env python3
+#
+# Conversion script to add new override syntax to existing bitbake metadata
+#
+# Copyright (C) 2021 Richard Purdie
+#
+# SPDX-License-Identifier: GPL-2.0-only
+#
+
+#
+# To use this script on a new layer you need to list the overrides the
+# layer is known to use in the list below.
+#
+# Known constraint: Matching is 'loose' and in particular will find variable
+# and function names with "_append" and "_remove" in them. Those need to be
+# filtered out manually or in the skip list below.
+#
+# With --stamp-file, files converted by an earlier run with the same version
+# and lists, and not modified since, are skipped.
+#
+# This module is importable and does nothing on import: convert() converts a
+# string, convertstream() a stream, processfile() a file in place and
+# processtree() whole layers, serially or on a process pool. The
+# revert-overrides.py script next to it is the command-line wrapper.
+#
+
+import argparse
+import concurrent.futures
+import contextlib
+import functools
+import hashlib
+import io
+import json
+import re
+import os
+import sys
+import tempfile
+import shutil
+
+# List of strings to treat as overrides
+vars = ["append", "prepend", "remove"]
+vars = vars + ["qemuarm", "qemux86", "qemumips", "qemuppc", "qemuriscv", "qemuall"]
+vars = vars + ["genericx86", "edgerouter", "beaglebone-yocto"]
+vars = vars + ["armeb", "arm", "armv5", "armv6", "armv4", "powerpc64", "aarch64", "riscv32", "riscv64", "x86", "mips64", "powerpc", "intel-quark"]
+vars = vars + ["mipsarch", "x86-x32", "mips16e", "microblaze", "e5500-64b", "mipsisa32", "mipsisa64"]
+vars = vars + ["class-native", "class-target", "class-cross-canadian", "class-cross", "class-devupstream"]
+vars = vars + ["tune-",  "pn-", "forcevariable"]
+vars = vars + ["libc-musl", "libc-glibc", "libc-newlib","libc-baremetal"]
+vars = vars + ["task-configure", "task-compile", "task-install", "task-clean", "task-image-qa", "task-rm_work", "task-image-complete", "task-populate-sdk"]
+vars = vars + ["toolchain-clang", "mydistro", "nios2", "sdkmingw32", "overrideone", "overridetwo"]
+vars = vars + ["linux-gnux32", "linux-muslx32", "linux-gnun32", "mingw32", "poky", "darwin", "linuxstdbase"]
+vars = vars + ["linux-gnueabi", "eabi"]
+vars = vars + ["virtclass-multilib", "virtclass-mcextend"]
+
+# List of strings to treat as overrides but only with whitespace following or another override (more restricted matching).
+# Handles issues with arc matching arch.
+shortvars = ["arc", "mips", "mipsel", "sh4"]
+
+# Variables which take packagenames as an override
+packagevars = ["FILES", "RDEPENDS", "RRECOMMENDS", "SUMMARY", "DESCRIPTION", "RSUGGESTS", "RPROVIDES", "RCONFLICTS", "PKG", "ALLOW_EMPTY",
+              "pkg_postrm", "pkg_postinst_ontarget", "pkg_postinst", "INITSCRIPT_NAME", "INITSCRIPT_PARAMS", "DEBIAN_NOAUTONAME", "ALTERNATIVE",
+              "PKGE", "PKGV", "PKGR", "USERADD_PARAM", "GROUPADD_PARAM", "CONFFILES", "SYSTEMD_SERVICE", "LICENSE", "SECTION", "pkg_preinst",
+              "pkg_prerm", "RREPLACES", "GROUPMEMS_PARAM", "SYSTEMD_AUTO_ENABLE", "SKIP_FILEDEPS", "PRIVATE_LIBS", "PACKAGE_ADD_METADATA",
+              "INSANE_SKIP", "DEBIANNAME", "SYSTEMD_SERVICE_ESCAPED"]
+
+# Expressions to skip if encountered, these are not overrides
+skips = ["parser_append", "recipe_to_append", "extra_append", "to_remove", "show_appends", "applied_appends", "file_appends", "handle_remove"]
+skips = skips + ["expanded_removes", "color_remove", "test_remove", "empty_remove", "toaster_prepend", "num_removed", "licfiles_append", "_write_append"]
+skips = skips + ["no_report_remove", "test_prepend", "test_append", "multiple_append", "test_remove", "shallow_remove", "do_remove_layer", "first_append"]
+skips = skips + ["parser_remove", "to_append", "no_remove", "bblayers_add_remove", "bblayers_remove", "apply_append", "is_x86", "base_dep_prepend"]
+skips = skips + ["autotools_dep_prepend", "go_map_arm", "alt_remove_links", "systemd_append_file", "file_append", "process_file_darwin"]
+skips = skips + ["run_loaddata_poky", "determine_if_poky_env", "do_populate_poky_src", "libc_cv_include_x86_isa_level", "test_rpm_remove", "do_install_armmultilib"]
+skips = skips + ["get_appends_for_files", "test_doubleref_remove", "test_bitbakelayers_add_remove", "elf32_x86_64", "colour_remove", "revmap_remove"]
+skips = skips + ["test_rpm_remove", "test_bitbakelayers_add_remove", "recipe_append_file", "log_data_removed", "recipe_append", "systemd_machine_unit_append"]
+skips = skips + ["recipetool_append", "changetype_remove", "try_appendfile_wc", "test_qemux86_directdisk", "test_layer_appends", "tgz_removed"]
+
+imagevars = ["IMAGE_CMD", "EXTRA_IMAGECMD", "IMAGE_TYPEDEP", "CONVERSION_CMD", "COMPRESS_CMD"]
+packagevars = packagevars + imagevars
+
+vars_re = {}
+for exp in vars:
+    vars_re[exp] = (re.compile('((^|[#\'"\s\-\+])[A-Za-z0-9_\-:${}\.]+):' + exp), r"\1_" + exp)
+
+shortvars_re = {}
+for exp in shortvars:
+    shortvars_re[exp] = (re.compile('((^|[#\'"\s\-\+])[A-Za-z0-9_\-:${}\.]+):' + exp + '([\(\'"\s:])'), r"\1_" + exp + r"\3")
+
+package_re = {}
+for exp in packagevars:
+    package_re[exp] = (re.compile('(^|[#\'"${\s\-\+]+)' + exp + ':' + '([$a-z"\'\s%\[<{\\\*].)'), r"\1" + exp + r"_\2")
+
+# Other substitutions to make
+subs = {
+    'r = re.compile("([^:]+):\s*(.*)")' : 'r = re.compile("(^.+?):\s+(.*)")',
+    "val = d.getVar('%s:%s' % (var, pkg))" : "val = d.getVar('%s_%s' % (var, pkg))",
+    "f.write('%s:%s: %s\\n' % (var, pkg, encode(val)))" : "f.write('%s_%s: %s\\n' % (var, pkg, encode(val)))",
+    "d.getVar('%s:%s' % (scriptlet_name, pkg))" : "d.getVar('%s_%s' % (scriptlet_name, pkg))",
+    'ret.append(v + ":" + p)' : 'ret.append(v + "_" + p)',
+}
+
+# Every rule above needs a ':' next to its keyword: "FILES:", ":append",
+# ":arc" and so on. One scan of a line with a combined alternation of those
+# literals finds the few rules that can match it, and only those regexes run,
+# in the order above. (Merging the rules into a single substitution would
+# not do: where two matches overlap, running them one after the other gives
+# a different result, and the output has to stay the same.)
+#
+# The literals are matched with '_' folded into ':', since a substitution
+# turns a ':' into '_' and so could in principle complete a later rule's
+# literal. Literals that are prefixes of others (":arm", ":armv5") are
+# expanded after the scan, which only reports the longest one at a position.
+rules = [(package_re[exp], exp + ":") for exp in packagevars]
+rules = rules + [(vars_re[exp], ":" + exp) for exp in vars]
+rules = rules + [(shortvars_re[exp], ":" + exp) for exp in shortvars]
+
+def foldcolons(text):
+    return text.replace("_", ":")
+
+rules_for = {}
+for index, (rule, literal) in enumerate(rules):
+    rules_for.setdefault(foldcolons(literal), []).append(index)
+for literal in rules_for:
+    rules_for[literal] = sorted(index for other in rules_for if literal.startswith(other) for index in rules_for[other])
+literals_re = re.compile("(?=(" + "|".join(re.escape(literal) for literal in sorted(rules_for, key=len, reverse=True)) + "))")
+
+def convertline(line):
+    # Converts one line, with its line ending.
+    if ":" not in line:
+        # Every rule, substitution and the pkg_postinst fixup needs a ':'.
+        return line
+    skip = False
+    for s in skips:
+        if s in line:
+            skip = True
+            if "ptest_append" in line or "ptest_remove" in line or "ptest_prepend" in line:
+                skip = False
+    for sub in subs:
+        if sub in line:
+            line = line.replace(sub, subs[sub])
+            skip = True
+    if not skip:
+        candidates = set()
+        for match in literals_re.finditer(foldcolons(line)):
+            candidates.update(rules_for[match.group(1)])
+        for index in sorted(candidates):
+            rule = rules[index][0]
+            line = rule[0].sub(rule[1], line)
+    if "pkg_postinst:ontarget" in line:
+        line = line.replace("pkg_postinst:ontarget", "pkg_postinst_ontarget")
+    return line
+
+def convert(text):
+    # Converts a whole text; its lines are split in universal newlines mode
+    # (so "\r\n" comes out as "\n"), as when reading a file in text mode.
+    return "".join(convertline(line) for line in io.StringIO(text, newline=None))
+
+def convertstream(infile, outfile):
+    # Converts the text stream infile line by line into outfile.
+    for line in infile:
+        outfile.write(convertline(line))
+
+# Bytes sniffed for a NUL before a file is decoded; one is taken to mean the
+# file is binary, as git and grep do.
+SNIFF_SIZE = 8192
+
+def processfile(fn, digest=None, stamped=False):
+    # Returns (status, stamp). status is "changed", "unchanged", "skipped" (not
+    # text) or "uptodate" (its content hashes to digest, so it was converted
+    # already); with stamped, stamp is the [size, mtime_ns, sha256] of the
+    # file as left, otherwise None and the file is not hashed at all.
+    # The file is only rewritten when its content changes, and then atomically,
+    # so untouched recipes keep their mtime (and BitBake's parse cache stays
+    # valid).
+    with open(fn, "rb") as old_file:
+        data = old_file.read(SNIFF_SIZE)
+        if b"\0" not in data:
+            data += old_file.read()
+        st = os.fstat(old_file.fileno())
+    stamp = None
+    if stamped:
+        sha256 = hashlib.sha256(data).hexdigest()
+        stamp = [st.st_size, st.st_mtime_ns, sha256]
+        if sha256 == digest:
+            return "uptodate", stamp
+    if b"\0" in data[:SNIFF_SIZE]:
+        return "skipped", None
+    # Decoded as open() in text mode would, keeping the line endings so an
+    # unchanged file compares equal.
+    text = io.TextIOWrapper(io.BytesIO(data), newline="")
+    try:
+        old = text.read()
+    except UnicodeDecodeError:
+        return "skipped", stamp
+    new = convert(old)
+    if new == old:
+        return "unchanged", stamp
+    data = new.encode(text.encoding)
+    fh, abs_path = tempfile.mkstemp(dir=os.path.dirname(fn) or ".")
+    try:
+        with os.fdopen(fh, 'wb') as new_file:
+            new_file.write(data)
+        shutil.copymode(fn, abs_path)
+        os.replace(abs_path, fn)
+        st = os.stat(fn)
+    except BaseException:
+        if os.path.exists(abs_path):
+            os.remove(abs_path)
+        raise
+    if stamped:
+        stamp = [st.st_size, st.st_mtime_ns, hashlib.sha256(data).hexdigest()]
+    return "changed", stamp
+
+def listfiles(targetdir, ourname):
+    # Yields (fn, wanted) for every file under targetdir; wanted is False for
+    # the files left alone (ourselves, links, git metadata, patches and so on).
+    for root, dirs, files in os.walk(targetdir):
+        for name in files:
+            fn = os.path.join(root, name)
+            if name == ourname or os.path.islink(fn):
+                yield fn, False
+            elif "/.git/" in fn or fn.endswith(".html") or fn.endswith(".patch") or fn.endswith(".m4") or fn.endswith(".diff"):
+                yield fn, False
+            else:
+                yield fn, True
+
+ourversion = "0.9.3"
+
+# A stamp file remembers, per absolute path, the [size, mtime_ns, sha256] each
+# file was left with. Its stamps only hold for the same script version and
+# rule lists, so those are recorded with them.
+def ruleshash():
+    rulelists = [vars, shortvars, packagevars, skips, sorted(subs.items())]
+    return hashlib.sha256(json.dumps(rulelists).encode()).hexdigest()
+
+def loadstamps(path):
+    try:
+        with open(path) as fh:
+            state = json.load(fh)
+    except (OSError, ValueError):
+        return {}
+    if state.get("version") != ourversion or state.get("rules") != ruleshash():
+        return {}
+    return state.get("files", {})
+
+def savestamps(path, stamps):
+    state = {"version": ourversion, "rules": ruleshash(), "files": stamps}
+    fh, abs_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)))
+    with os.fdopen(fh, 'w') as new_file:
+        json.dump(state, new_file, sort_keys=True)
+    os.replace(abs_path, path)
+
+def uptodate(fn, stamp):
+    # The cheap check: the file has the size and mtime it was left with.
+    try:
+        st = os.stat(fn)
+    except OSError:
+        return False
+    return [st.st_size, st.st_mtime_ns] == stamp[:2]
+
+def processtree(targets, jobs=0, stampfile=None, ourname=None, log=None):
+    # Converts the files under the target directories or, if the first target
+    # is a file, that file alone; returns the counts of files scanned (read as
+    # text), changed, skipped and up to date (per stampfile). jobs is the
+    # number of worker processes, 0 for one per CPU and 1 to convert in this
+    # process; log, if given, is called with a line of progress per file.
+    # The stamps of files under the targets that are gone, or no longer
+    # converted, are dropped from stampfile.
+    log = log or (lambda message: None)
+    counts = {"scanned": 0, "changed": 0, "skipped": 0, "uptodate": 0}
+    stamps = loadstamps(stampfile) if stampfile else {}
+    process = functools.partial(processfile, stamped=bool(stampfile))
+    seen = set()
+
+    def count(fn, status):
+        log("processing file '%s'" % fn)
+        if status in ("changed", "unchanged"):
+            counts["scanned"] += 1
+        if status != "unchanged":
+            counts[status] += 1
+
+    def run(mapper, todo):
+        # Files whose size and mtime match their stamp are not even opened;
+        # the others are hashed and only converted if that does not match.
+        pending = []
+        for fn in todo:
+            seen.add(os.path.abspath(fn))
+            stamp = stamps.get(os.path.abspath(fn))
+            if stamp and uptodate(fn, stamp):
+                count(fn, "uptodate")
+            else:
+                pending.append((fn, stamp[2] if stamp else None))
+        names = [fn for fn, digest in pending]
+        digests = [digest for fn, digest in pending]
+        for fn, (status, stamp) in zip(names, mapper(process, names, digests)):
+            count(fn, status)
+            if stamp:
+                stamps[os.path.abspath(fn)] = stamp
+            else:
+                stamps.pop(os.path.abspath(fn), None)
+
+    jobs = jobs or os.cpu_count() or 1
+    with contextlib.ExitStack() as stack:
+        if jobs == 1:
+            mapper = map
+        else:
+            # Regex matching holds the GIL, so files are converted in processes.
+            pool = stack.enter_context(concurrent.futures.ProcessPoolExecutor(jobs))
+            mapper = functools.partial(pool.map, chunksize=16)
+        if os.path.isfile(targets[0]):
+            targets = targets[:1]
+            run(mapper, targets)
+        else:
+            for targetdir in targets:
+                log("processing directory '%s'" % targetdir)
+                todo = []
+                for fn, wanted in listfiles(targetdir, ourname):
+                    if wanted:
+                        todo.append(fn)
+                    else:
+                        counts["skipped"] += 1
+                run(mapper, todo)
+
+    if stampfile:
+        roots = [os.path.abspath(target) for target in targets]
+        for path in list(stamps):
+            if path not in seen and any(
+                path == root or path.startswith(root + os.sep) for root in roots
+            ):
+                del stamps[path]
+        savestamps(stampfile, stamps)
+    return counts
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Convert bitbake metadata back to the old override syntax.")
+    parser.add_argument("targets", nargs="*", metavar="TARGET", help="Directories to convert, or a single file")
+    parser.add_argument("--stamp-file", help="Remember converted files here and skip them when unchanged on later runs")
+    parser.add_argument("-j", "--jobs", type=int, default=0, help="Worker processes (default: 0 = one per CPU)")
+    args = parser.parse_args(argv)
+    if not args.targets:
+        print("Please specify a directory to run the conversion script against.")
+        return 1
+
+    ourname = os.path.basename(sys.argv[0])
+    counts = processtree(args.targets, args.jobs, args.stamp_file, ourname, log=print)
+    summary = "%(scanned)d files scanned, %(changed)d changed, %(skipped)d skipped" % counts
+    if args.stamp_file:
+        summary += ", %(uptodate)d up to date" % counts
+    print(summary)
+    if not os.path.isfile(args.targets[0]):
+        print("All files processed with version %s" % ourversion)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,311 @@
+#!/usr/bin/env python3
+"""Throughput benchmark for the prepare-image.py compressor.
+
+Synthesizes a sparse, balenaOS-shaped disk image (1-8 GiB) and runs
+prepare_raw_image over it in each of its modes. Each mode runs in a fresh child
+process so the reported peak RSS belongs to that mode alone. Not a test: it is
+not discovered by ``unittest discover`` (no ``test_`` prefix).
+
+The image follows the balenaOS layout: a bootloader gap, resin-boot (FAT-like
+text), resin-rootA (text-like), an empty resin-rootB, resin-state and a
+resin-data partition holding some incompressible payload, with everything else
+left as holes. ``--table mbr`` puts state and data in an extended partition
+(EBR chain); ``--table gpt`` uses a GPT.
+
+    python3 tests/bench_prepare_image.py [--size-gib 1] [--table mbr|gpt]
+        [--modes serial,jobs,...] [--output report.json]
+        [--baseline report.json [--threshold 0.10]]
+
+Prints (and with ``--output`` writes) a JSON report: per mode, MB/s of image
+bytes, wall seconds, peak RSS in MiB, the total compressed bytes and the
+compression ratio per part type.
+With ``--baseline`` it exits 1 if any mode's MB/s dropped by more than
+``--threshold`` against the stored report.
+"""
+
+import argparse
+import importlib.util
+import json
+import os
+import resource
+import struct
+import subprocess
+import sys
+import tempfile
+import time
+
+_MODULE_PATH = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+    "automation",
+    "conversion_scripts",
+    "prepare_image.py",
+)
+
+MIB = 1 << 20
+SECTOR = 512
+
+# prepare_raw_image options per mode; "jobs" values are resolved in the child.
+MODES = {
+    "serial": {},
+    "jobs": {"jobs": "cpus"},
+    "blocks": {"jobs": "cpus", "block_size": 4 * MIB},
+    "mmap": {"use_mmap": True},
+    "pipelined": {"read_ahead": 4, "write_behind": 8},
+    "primed": {"prime_parts": True},
+    "split": {"max_part_size": 4 * MIB},
+    "split-primed": {"max_part_size": 4 * MIB, "prime_parts": True},
+    "no-zero-detect": {"detect_zeros": False},
+    "tuned": {"policy": "tuned"},
+    "auto": {"policy": "auto"},
+}
+
+
+def _load_module():
+    spec = importlib.util.spec_from_file_location("prepare_image", _MODULE_PATH)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+# --- image synthesis --------------------------------------------------------
+
+
+def _text_blocks(count=8):
+    """A few distinct 1 MiB blocks of log/config-like text, cycled for fill."""
+    blocks = []
+    for n in range(count):
+        lines = b"".join(
+            b"%d: /usr/lib/balena/unit-%05d.service Restart=on-failure pid=%d\n"
+            % (n, i, (i * 7919 + n) % 65536)
+            for i in range(MIB // 48)
+        )
+        blocks.append(lines[:MIB])
+    return blocks
+
+
+def _fill(fh, offset, length, kind, text):
+    """Write ``length`` bytes of ``kind`` content at ``offset`` (MiB granular)."""
+    fh.seek(offset)
+    for i in range(length // MIB):
+        fh.write(os.urandom(MIB) if kind == "random" else text[i % len(text)])
+
+
+def _layout(size):
+    """(name, start, length, fills) for each partition, in disk order.
+
+    ``fills`` is a list of (relative offset, length, kind) content regions; the
+    rest of the partition is left as a hole.
+    """
+    boot = 40 * MIB
+    rootfs = max(64 * MIB, size // 5 // MIB * MIB)
+    state = 20 * MIB
+    start = 4 * MIB
+    parts = [("boot", boot, [(0, boot // 2, "text")])]
+    parts.append(("rootfs", rootfs, [(0, rootfs * 7 // 10 // MIB * MIB, "text")]))
+    parts.append(("empty", rootfs, []))
+    parts.append(("state", state, [(0, 2 * MIB, "text")]))
+    # Leave room for the EBRs and the backup GPT at the end.
+    data = size - start - boot - 2 * rootfs - state - 8 * MIB
+    parts.append(("data", data, [(0, data // 10 // MIB * MIB, "random")]))
+    layout = []
+    for name, length, fills in parts:
+        if name == "state":
+            start += MIB  # room for an EBR ahead of each logical partition
+        layout.append((name, start, length, fills))
+        start += length
+        if name == "state":
+            start += MIB
+    return layout
+
+
+def _put_entry(buf, slot, ptype, lba_start, num_sectors):
+    base = 446 + slot * 16
+    buf[base + 4] = ptype
+    struct.pack_into("<II", buf, base + 8, lba_start, num_sectors)
+
+
+def _write_mbr(fh, layout):
+    """Primaries boot/rootfs/empty + extended with state and data (EBR chain)."""
+    mbr = bytearray(SECTOR)
+    for slot, (_name, start, length, _fills) in enumerate(layout[:3]):
+        _put_entry(mbr, slot, 0x83, start // SECTOR, length // SECTOR)
+    state, data = layout[3], layout[4]
+    ext_base = state[1] - MIB
+    ext_len = data[1] + data[2] - ext_base
+    _put_entry(mbr, 3, 0x05, ext_base // SECTOR, ext_len // SECTOR)
+    mbr[510:512] = b"\x55\xaa"
+    fh.seek(0)
+    fh.write(mbr)
+    ebr_offsets = (state[1] - MIB, data[1] - MIB)
+    for i, ((_name, start, length, _fills), ebr) in enumerate(
+        zip((state, data), ebr_offsets)
+    ):
+        buf = bytearray(SECTOR)
+        _put_entry(buf, 0, 0x83, (start - ebr) // SECTOR, length // SECTOR)
+        if i == 0:
+            next_ebr = ebr_offsets[1] - ext_base
+            _put_entry(buf, 1, 0x05, next_ebr // SECTOR, (MIB + data[2]) // SECTOR)
+        buf[510:512] = b"\x55\xaa"
+        fh.seek(ebr)
+        fh.write(buf)
+
+
+def _write_gpt(fh, layout, size):
+    mbr = bytearray(SECTOR)
+    _put_entry(mbr, 0, 0xEE, 1, min(size // SECTOR - 1, 0xFFFFFFFF))
+    mbr[510:512] = b"\x55\xaa"
+    header = bytearray(92)
+    header[:8] = b"EFI PART"
+    struct.pack_into("<QII", header, 72, 2, 128, 128)
+    table = bytearray(128 * 128)
+    for slot, (_name, start, length, _fills) in enumerate(layout):
+        off = slot * 128
+        table[off : off + 16] = b"\x11" * 16
+        first = start // SECTOR
+        struct.pack_into("<QQ", table, off + 32, first, first + length // SECTOR - 1)
+    fh.seek(0)
+    fh.write(mbr + header)
+    fh.seek(2 * SECTOR)
+    fh.write(table)
+
+
+def synthesize(path, size, table="mbr"):
+    """Write the sparse benchmark image; return {partition index: part type}."""
+    layout = _layout(size)
+    text = _text_blocks()
+    with open(path, "wb") as fh:
+        fh.truncate(size)
+        # Bootloader-like payload in the leading gap.
+        _fill(fh, MIB, MIB, "random", text)
+        for _name, start, _length, fills in layout:
+            for rel, length, kind in fills:
+                _fill(fh, start + rel, length, kind, text)
+        if table == "mbr":
+            _write_mbr(fh, layout)
+        else:
+            _write_gpt(fh, layout, size)
+    if table == "mbr":
+        indices = (1, 2, 3, 5, 6)
+    else:
+        indices = (1, 2, 3, 4, 5)
+    return {str(i): name for i, (name, *_rest) in zip(indices, layout)}
+
+
+# --- measurement ------------------------------------------------------------
+
+
+def _child(mode, image_path, kinds_json):
+    prepare_image = _load_module()
+    kinds = json.loads(kinds_json)
+    kwargs = {
+        k: (os.cpu_count() or 1) if v == "cpus" else v for k, v in MODES[mode].items()
+    }
+    size = os.path.getsize(image_path)
+    with tempfile.TemporaryDirectory() as d:
+        began = time.perf_counter()
+        manifest_path = prepare_image.prepare_raw_image(image_path, d, **kwargs)
+        elapsed = time.perf_counter() - began
+        with open(manifest_path) as fh:
+            parts = json.load(fh)["resin.img"]["parts"]
+    totals = {}
+    for part in parts:
+        kind = kinds.get(part.get("partitionIndex", "").strip("()"), "gap")
+        raw, packed = totals.get(kind, (0, 0))
+        totals[kind] = (raw + part["len"], packed + part["zLen"])
+    peak_kib = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    print(
+        json.dumps(
+            {
+                "mb_per_s": round(size / elapsed / 1e6, 1),
+                "seconds": round(elapsed, 3),
+                "peak_rss_mib": round(peak_kib / 1024, 1),
+                "z_bytes": sum(packed for _raw, packed in totals.values()),
+                "ratio": {
+                    kind: round(packed / raw, 4)
+                    for kind, (raw, packed) in sorted(totals.items())
+                },
+            }
+        )
+    )
+
+
+def compare(report, baseline, threshold):
+    """Return the regression messages of ``report`` against ``baseline``."""
+    failures = []
+    for mode, result in report["modes"].items():
+        before = baseline.get("modes", {}).get(mode)
+        if not before:
+            continue
+        floor = before["mb_per_s"] * (1 - threshold)
+        if result["mb_per_s"] < floor:
+            failures.append(
+                f"{mode}: {result['mb_per_s']} MB/s < {floor:.1f} MB/s "
+                f"({before['mb_per_s']} MB/s baseline - {threshold:.0%})"
+            )
+    return failures
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--size-gib", type=int, default=1, choices=range(1, 9))
+    parser.add_argument("--table", choices=("mbr", "gpt"), default="mbr")
+    parser.add_argument(
+        "--modes",
+        default=",".join(MODES),
+        help=f"Comma-separated modes to run (default: all of {','.join(MODES)})",
+    )
+    parser.add_argument("--repeat", type=int, default=1, help="Best of N per mode")
+    parser.add_argument("--output", help="Also write the JSON report here")
+    parser.add_argument("--baseline", help="Fail on regressions against this report")
+    parser.add_argument("--threshold", type=float, default=0.10)
+    parser.add_argument(
+        "--child", nargs=3, metavar=("MODE", "IMAGE", "KINDS"), help=argparse.SUPPRESS
+    )
+    args = parser.parse_args(argv)
+    if args.child:
+        _child(*args.child)
+        return 0
+    modes = args.modes.split(",")
+    for mode in modes:
+        if mode not in MODES:
+            parser.error(f"Unknown mode: {mode}")
+
+    report = {"size_gib": args.size_gib, "table": args.table, "modes": {}}
+    with tempfile.TemporaryDirectory() as d:
+        image_path = os.path.join(d, "bench.img")
+        kinds = synthesize(image_path, args.size_gib << 30, args.table)
+        for mode in modes:
+            # Best of N: the first run also warms the page cache for the rest.
+            runs = []
+            for _ in range(args.repeat):
+                out = subprocess.run(
+                    [
+                        sys.executable,
+                        __file__,
+                        "--child",
+                        mode,
+                        image_path,
+                        json.dumps(kinds),
+                    ],
+                    check=True,
+                    capture_output=True,
+                    text=True,
+                ).stdout
+                runs.append(json.loads(out))
+            report["modes"][mode] = max(runs, key=lambda r: r["mb_per_s"])
+            print(json.dumps({"mode": mode, **report["modes"][mode]}), flush=True)
+
+    if args.output:
+        with open(args.output, "w") as out:
+            json.dump(report, out, indent=4)
+    if args.baseline:
+        with open(args.baseline) as fh:
+            failures = compare(report, json.load(fh), args.threshold)
+        for failure in failures:
+            print(f"REGRESSION {failure}", file=sys.stderr)
+        return 1 if failures else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
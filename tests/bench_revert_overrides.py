@@ -0,0 +1,206 @@
+#!/usr/bin/env python3
+"""Throughput benchmark for the revert-overrides.py syntax converter.
+
+Synthesizes a layer tree the size of poky's meta plus meta-balena (recipes,
+bbappends, classes, includes and machine configs in the new ``:`` override
+syntax, with the patches and binaries a layer also carries) and converts a
+fresh copy of it with processtree in each mode. Each mode runs in a fresh
+child process so the reported peak RSS belongs to that mode alone. Not a test:
+it is not discovered by ``unittest discover`` (no ``test_`` prefix).
+
+    python3 tests/bench_revert_overrides.py [--files 4000] [--modes serial,parallel]
+        [--repeat 1] [--output report.json]
+
+Prints (and with ``--output`` writes) a JSON report: per mode, lines/s and
+files/s of the conversion, wall seconds, and the peak RSS in MiB of the driver
+and of its largest worker process.
+"""
+
+import argparse
+import importlib.util
+import json
+import os
+import random
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+_SCRIPTS_DIR = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+    "automation",
+    "conversion_scripts",
+)
+
+# processtree options per mode; "cpus" is resolved in the child.
+MODES = {
+    "serial": {"jobs": 1},
+    "parallel": {"jobs": "cpus"},
+}
+
+
+def _load_module():
+    spec = importlib.util.spec_from_file_location(
+        "revert_overrides", os.path.join(_SCRIPTS_DIR, "revert_overrides.py")
+    )
+    module = importlib.util.module_from_spec(spec)
+    # Registered so the worker processes can unpickle its functions.
+    sys.modules["revert_overrides"] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+# --- tree synthesis ---------------------------------------------------------
+
+OVERRIDES = ["append", "prepend", "remove", "class-native", "class-target", "arm"]
+OVERRIDES += ["aarch64", "x86-64", "qemux86", "libc-musl", "pn-gcc", "mips"]
+PACKAGE_VARS = ["FILES", "RDEPENDS", "RRECOMMENDS", "SUMMARY", "LICENSE"]
+PACKAGE_VARS += ["SYSTEMD_SERVICE", "INSANE_SKIP", "ALTERNATIVE", "CONFFILES"]
+PACKAGES = ["${PN}", "${PN}-dev", "${PN}-ptest", "${PN}-tools", "lib${BPN}"]
+
+
+def _recipe_lines(rng, count):
+    """``count`` lines of recipe-like metadata, about a third with overrides."""
+    lines = []
+    while len(lines) < count:
+        kind = rng.random()
+        override = rng.choice(OVERRIDES)
+        if kind < 0.15:
+            var = rng.choice(PACKAGE_VARS)
+            pkg = rng.choice(PACKAGES)
+            lines.append('%s:%s = "${bindir}/%s"' % (var, pkg, override))
+        elif kind < 0.3:
+            lines.append('EXTRA_OECONF:%s = " --enable-%s"' % (override, override))
+        elif kind < 0.38:
+            lines += ["do_install:%s() {" % override]
+            lines += ["\tinstall -d ${D}${sysconfdir}/%s" % override, "}"]
+        elif kind < 0.5:
+            lines.append("# %s" % " ".join(rng.choice(OVERRIDES) for _ in range(9)))
+        elif kind < 0.6:
+            lines.append('SRC_URI = "git://github.com/balena-os/x.git;branch=main"')
+        else:
+            lines.append('DEPENDS += "%s-native zlib openssl"' % override)
+    return lines[:count]
+
+
+def synthesize(root, files, seed=0):
+    """Write the benchmark layer tree; return (files, lines) to be converted."""
+    rng = random.Random(seed)
+    kinds = [
+        ("recipes-%d/pkg%d/pkg%d_1.0.bb", 60),
+        ("recipes-%d/pkg%d/pkg%d_%%.bbappend", 15),
+        ("recipes-%d/pkg%d/pkg%d.inc", 40),
+        ("classes/class%d-%d-%d.bbclass", 150),
+        ("conf/machine/include/tune%d-%d-%d.inc", 30),
+    ]
+    lines = 0
+    for n in range(files):
+        pattern, size = kinds[n % len(kinds)]
+        path = os.path.join(root, pattern % (n % 40, n, n))
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        body = _recipe_lines(rng, rng.randint(size // 2, size * 3 // 2))
+        lines += len(body)
+        with open(path, "w") as fh:
+            fh.write("\n".join(body) + "\n")
+    # Left alone by the converter: patches by name, binaries by content.
+    for n in range(files // 20):
+        path = os.path.join(root, "recipes-%d" % (n % 40), "files", "%d.patch" % n)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "w") as fh:
+            fh.write("+FILES:${PN}:append = \"x\"\n" * 20)
+        with open(os.path.join(os.path.dirname(path), "%d.bin" % n), "wb") as fh:
+            fh.write(b"\x7fELF\x00" + rng.randbytes(4096))
+    return files, lines
+
+
+# --- measurement ------------------------------------------------------------
+
+
+def _child(mode, tree, files, lines):
+    revert_overrides = _load_module()
+    kwargs = {
+        k: (os.cpu_count() or 1) if v == "cpus" else v for k, v in MODES[mode].items()
+    }
+    with tempfile.TemporaryDirectory() as d:
+        copy = os.path.join(d, "layer")
+        shutil.copytree(tree, copy)
+        began = time.perf_counter()
+        counts = revert_overrides.processtree([copy], **kwargs)
+        elapsed = time.perf_counter() - began
+    assert counts["scanned"] == int(files), counts
+    peak_kib = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    worker_kib = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    print(
+        json.dumps(
+            {
+                "lines_per_s": round(int(lines) / elapsed),
+                "files_per_s": round(int(files) / elapsed, 1),
+                "seconds": round(elapsed, 3),
+                "peak_rss_mib": round(peak_kib / 1024, 1),
+                "worker_peak_rss_mib": round(worker_kib / 1024, 1),
+                "changed": counts["changed"],
+            }
+        )
+    )
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--files", type=int, default=4000, help="Files to convert")
+    parser.add_argument(
+        "--modes",
+        default=",".join(MODES),
+        help=f"Comma-separated modes to run (default: all of {','.join(MODES)})",
+    )
+    parser.add_argument("--repeat", type=int, default=1, help="Best of N per mode")
+    parser.add_argument("--output", help="Also write the JSON report here")
+    parser.add_argument(
+        "--child",
+        nargs=4,
+        metavar=("MODE", "TREE", "FILES", "LINES"),
+        help=argparse.SUPPRESS,
+    )
+    args = parser.parse_args(argv)
+    if args.child:
+        _child(*args.child)
+        return 0
+    modes = args.modes.split(",")
+    for mode in modes:
+        if mode not in MODES:
+            parser.error(f"Unknown mode: {mode}")
+
+    with tempfile.TemporaryDirectory() as d:
+        tree = os.path.join(d, "layer")
+        files, lines = synthesize(tree, args.files)
+        report = {"files": files, "lines": lines, "cpus": os.cpu_count(), "modes": {}}
+        for mode in modes:
+            runs = []
+            for _ in range(args.repeat):
+                out = subprocess.run(
+                    [
+                        sys.executable,
+                        __file__,
+                        "--child",
+                        mode,
+                        tree,
+                        str(files),
+                        str(lines),
+                    ],
+                    check=True,
+                    capture_output=True,
+                    text=True,
+                ).stdout
+                runs.append(json.loads(out))
+            report["modes"][mode] = max(runs, key=lambda r: r["lines_per_s"])
+            print(json.dumps({"mode": mode, **report["modes"][mode]}), flush=True)
+
+    if args.output:
+        with open(args.output, "w") as out:
+            json.dump(report, out, indent=4)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,136 @@
+#!/usr/bin/env python3
+"""Size/seek trade-off benchmark for prepare-image.py's seek index.
+
+Synthesizes the same balenaOS-shaped image as bench_prepare_image.py and
+prepares it with each ``--index-interval``. For every interval it reports the
+total compressed size and its overhead against no index, and, for the largest
+part, what a consumer saves:
+
+  - seek: wall time to read 1 MiB three quarters into the part with
+    read_part_range, against inflating from the part's start;
+  - resume: for a flash of the part interrupted at an arbitrary point, how
+    many uncompressed and compressed MiB have to be redone from the nearest
+    restart point instead of from the part's start, on average.
+
+Not a test: it is not discovered by ``unittest discover`` (no ``test_`` prefix).
+
+    python3 tests/bench_seek_index.py [--size-gib 1] [--table mbr|gpt]
+        [--intervals 0,4,16,64] [--output report.json]
+"""
+
+import argparse
+import bisect
+import importlib.util
+import json
+import os
+import sys
+import tempfile
+import time
+
+_TESTS_DIR = os.path.dirname(os.path.abspath(__file__))
+MIB = 1 << 20
+
+
+def _load(name, path):
+    spec = importlib.util.spec_from_file_location(name, path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+bench = _load("bench_prepare_image", os.path.join(_TESTS_DIR, "bench_prepare_image.py"))
+prepare_image = bench._load_module()
+
+
+def _seek_seconds(part_path, points, offset):
+    began = time.perf_counter()
+    prepare_image.read_part_range(part_path, points, offset, MIB)
+    return time.perf_counter() - began
+
+
+def _resume_cost(points, length, z_length, samples=64):
+    """Mean (uncompressed, compressed) bytes redone after an interruption.
+
+    Interruptions are spread evenly over the part; the compressed position of
+    one is interpolated between the restart points around it.
+    """
+    bounds = points + [[length, z_length, None]]
+    redo = redo_z = 0
+    for k in range(samples):
+        offset = length * (2 * k + 1) // (2 * samples)
+        i = bisect.bisect_right([point[0] for point in bounds], offset) - 1
+        lo, hi = bounds[i], bounds[i + 1]
+        z_offset = lo[1] + (hi[1] - lo[1]) * (offset - lo[0]) / (hi[0] - lo[0])
+        redo += offset - lo[0]
+        redo_z += z_offset - lo[1]
+    return redo / samples, redo_z / samples
+
+
+def measure(image_path, interval):
+    with tempfile.TemporaryDirectory() as d:
+        manifest_path = prepare_image.prepare_raw_image(
+            image_path, d, index_interval=interval
+        )
+        with open(manifest_path) as fh:
+            parts = json.load(fh)["resin.img"]["parts"]
+        result = {"zLen": sum(part["zLen"] for part in parts)}
+        if not interval:
+            return result
+        index = prepare_image.load_index(manifest_path)
+        largest = max(parts, key=lambda part: part["len"])
+        points = index[largest["filename"]]
+        part_path = os.path.join(d, "compressed", largest["filename"])
+        target = largest["len"] * 3 // 4
+        size = (largest["len"], largest["zLen"])
+        redo, redo_z = _resume_cost(points, *size)
+        redo_start, redo_z_start = _resume_cost([[0, 0, 0]], *size)
+        result.update(
+            {
+                "points": sum(len(points) for points in index.values()),
+                "seek_s": round(_seek_seconds(part_path, points, target), 4),
+                "seek_from_start_s": round(
+                    _seek_seconds(part_path, [[0, 0, 0]], target), 4
+                ),
+                "resume_redo_mib": round(redo / MIB, 2),
+                "resume_redo_from_start_mib": round(redo_start / MIB, 2),
+                "resume_redo_z_mib": round(redo_z / MIB, 2),
+                "resume_redo_z_from_start_mib": round(redo_z_start / MIB, 2),
+            }
+        )
+    return result
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--size-gib", type=int, default=1, choices=range(1, 9))
+    parser.add_argument("--table", choices=("mbr", "gpt"), default="mbr")
+    parser.add_argument(
+        "--intervals",
+        default="0,4,16,64",
+        help="Comma-separated index intervals in MiB; 0 = no index (the baseline)",
+    )
+    parser.add_argument("--output", help="Also write the JSON report here")
+    args = parser.parse_args(argv)
+    intervals = [int(value) for value in args.intervals.split(",")]
+
+    report = {"size_gib": args.size_gib, "table": args.table, "intervals": {}}
+    with tempfile.TemporaryDirectory() as d:
+        image_path = os.path.join(d, "bench.img")
+        bench.synthesize(image_path, args.size_gib << 30, args.table)
+        baseline = None
+        for interval in sorted(intervals):
+            result = measure(image_path, interval * MIB)
+            if baseline is None:
+                baseline = result["zLen"]
+            result["overhead"] = round(result["zLen"] / baseline - 1, 5)
+            report["intervals"][str(interval)] = result
+            print(json.dumps({"interval_mib": interval, **result}), flush=True)
+
+    if args.output:
+        with open(args.output, "w") as out:
+            json.dump(report, out, indent=4)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
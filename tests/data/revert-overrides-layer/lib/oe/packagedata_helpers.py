@@ -0,0 +1,70 @@
+import codecs
+import os
+
+def packaged(pkg, d):
+    return os.access(get_subpkgedata_fn(pkg, d) + '.packaged', os.R_OK)
+
+def read_pkgdatafile(fn):
+    pkgdata = {}
+
+    def decode(str):
+        c = codecs.getdecoder("unicode_escape")
+        return c(str)[0]
+
+    if os.access(fn, os.R_OK):
+        import re
+        with open(fn, 'r') as f:
+            lines = f.readlines()
+        r = re.compile("([^:]+):\s*(.*)")
+        for l in lines:
+            m = r.match(l)
+            if m:
+                pkgdata[m.group(1)] = decode(m.group(2))
+
+    return pkgdata
+
+def get_subpkgedata_fn(pkg, d):
+    return d.expand('${PKGDATA_DIR}/runtime/%s' % pkg)
+
+def has_subpkgdata(pkg, d):
+    return os.access(get_subpkgedata_fn(pkg, d), os.R_OK)
+
+def read_subpkgdata(pkg, d):
+    return read_pkgdatafile(get_subpkgedata_fn(pkg, d))
+
+def write_pkgdata(d, pkg, var, encode):
+    with open(get_subpkgedata_fn(pkg, d), 'w') as f:
+        val = d.getVar('%s:%s' % (var, pkg))
+        if val:
+            f.write('%s:%s: %s\n' % (var, pkg, encode(val)))
+            return val
+        val = d.getVar('%s' % (var))
+        if val:
+            f.write('%s: %s\n' % (var, encode(val)))
+    return val
+
+def scriptlets(d, pkg):
+    for scriptlet_name in ('pkg_preinst', 'pkg_postinst', 'pkg_prerm', 'pkg_postrm'):
+        scriptlet = d.getVar('%s:%s' % (scriptlet_name, pkg))
+        if scriptlet:
+            yield scriptlet_name, scriptlet
+
+def pkgvars(d, pkg):
+    ret = []
+    for v in ('PKG', 'PKGE', 'PKGV', 'PKGR', 'DEBIAN_NOAUTONAME', 'PRIVATE_LIBS'):
+        for p in (pkg, '${PN}'):
+            ret.append(v + ":" + p)
+    return ret
+
+def recipe_to_append(recipefile, config, wildcard=False):
+    # Appends go next to the recipe; the names here are not overrides.
+    appendpath = os.path.join(config.workspace_path, 'appends')
+    extra_append = recipefile + ":append"
+    return appendpath, extra_append
+
+def check_bbappends(d):
+    show_appends = d.getVar('BB_SHOW_APPENDS:class-target')
+    for fn in (d.getVar('BBINCLUDED') or "").split():
+        if fn.endswith('.bbappend') and ':remove' in fn:
+            bb.warn("odd append name %s" % fn)
+    return show_appends
@@ -26,19 +26,31 @@ Stdlib only; runs in the sandbox with no dependencies:
 It is also pytest-discoverable outside the sandbox.
 """
 
+import ctypes
+import errno
+import gc
+import gzip
+import hashlib
 import importlib.util
+import io
 import json
+import lzma
 import os
 import struct
 import tempfile
+import threading
+import time
 import unittest
+import warnings
 import zlib
+from unittest import mock
+from xml.etree import ElementTree
 
 _MODULE_PATH = os.path.join(
     os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
     "automation",
     "conversion_scripts",
-    "prepare-image.py",
+    "prepare_image.py",
 )
 _spec = importlib.util.spec_from_file_location("prepare_image", _MODULE_PATH)
 prepare_image = importlib.util.module_from_spec(_spec)
@@ -130,6 +142,64 @@ GPT_GOLDEN_PLAN = [
 ]
 
 
+def _build_fs_image():
+    """MBR with a tiny ext2 (P1) and a FAT12 (P2), both over stale filler data.
+
+    Returns (image bytes, the image with the free blocks/clusters zeroed).
+    """
+    img = bytearray(_pattern(400 * SECTOR))
+    _zero_ptable(img, 0)
+    _put_entry(img, 0, 0, 0x83, 64, 128)  # ext2: 64 1 KiB blocks
+    _put_entry(img, 0, 1, 0x0C, 256, 64)  # FAT12: 64 sectors
+    img[510], img[511] = 0x55, 0xAA
+
+    ext = 64 * SECTOR
+    sb = ext + 1024  # block 1: first_data_block 1, 1 KiB blocks, 1 group
+    img[sb : sb + 1024] = bytes(1024)
+    struct.pack_into("<II", img, sb + 0x4, 64, 0)
+    struct.pack_into("<III", img, sb + 0x14, 1, 0, 0)
+    struct.pack_into("<I", img, sb + 0x20, 8192)
+    struct.pack_into("<H", img, sb + 0x38, 0xEF53)
+    gdt = ext + 2 * 1024
+    img[gdt : gdt + 32] = bytes(32)
+    struct.pack_into("<I", img, gdt, 3)  # block bitmap in block 3
+    used = set(range(1, 10)) | set(range(20, 30))
+    bitmap = bytearray(1024)
+    for block in used:
+        bitmap[(block - 1) // 8] |= 1 << ((block - 1) % 8)
+    img[ext + 3 * 1024 : ext + 4 * 1024] = bitmap
+
+    fat = 256 * SECTOR
+    boot = bytearray(img[fat : fat + SECTOR])
+    boot[0] = 0xEB
+    # 512 B sectors, 1 per cluster, 1 reserved, 2 FATs, 16 root entries,
+    # 64 sectors, 1 sector per FAT: data (cluster 2) starts at sector 4.
+    struct.pack_into("<HBHBHHBH", boot, 11, SECTOR, 1, 1, 2, 16, 64, 0xF8, 1)
+    boot[54:62] = b"FAT12   "
+    boot[510:512] = b"\x55\xaa"
+    img[fat : fat + SECTOR] = boot
+    table = bytearray(SECTOR)
+    entries = {0: 0xFF8, 1: 0xFFF, 2: 3, 3: 4, 4: 0xFFF, 5: 0xFFF, 9: 0xFFF}
+    for n, value in entries.items():
+        pair = int.from_bytes(table[n * 3 // 2 : n * 3 // 2 + 2], "little")
+        if n & 1:
+            pair = pair & 0x000F | value << 4
+        else:
+            pair = pair & 0xF000 | value
+        table[n * 3 // 2 : n * 3 // 2 + 2] = pair.to_bytes(2, "little")
+    img[fat + SECTOR : fat + 2 * SECTOR] = table
+
+    zeroed = bytearray(img)
+    for block in range(1, 64):
+        if block not in used:
+            zeroed[ext + block * 1024 : ext + (block + 1) * 1024] = bytes(1024)
+    for cluster in range(2, 62):
+        if cluster not in entries:
+            offset = fat + (4 + cluster - 2) * SECTOR
+            zeroed[offset : offset + SECTOR] = bytes(SECTOR)
+    return bytes(img), bytes(zeroed)
+
+
 class PrepareImageGoldenTest(unittest.TestCase):
     def _assert_plan(self, image_bytes, golden_plan):
         import io
@@ -180,6 +250,849 @@ class PrepareImageGoldenTest(unittest.TestCase):
             whole = zlib.decompress(blob + DEFLATE_END, -zlib.MAX_WBITS)
             self.assertEqual(whole, image_bytes)
 
+    def _prepare_outputs(self, image_bytes, holes=(), **kwargs):
+        """Run prepare_raw_image and return (manifest dict, {filename: bytes}).
+
+        ``holes`` lists (offset, length) zero ranges to leave unwritten, so the
+        image file is sparse where the filesystem supports it.
+        """
+        with tempfile.TemporaryDirectory() as d:
+            img_path = os.path.join(d, "resin.img")
+            with open(img_path, "wb") as fh:
+                pos = 0
+                for offset, length in sorted(holes):
+                    fh.write(image_bytes[pos:offset])
+                    fh.seek(offset + length)
+                    pos = offset + length
+                fh.write(image_bytes[pos:])
+                fh.truncate(len(image_bytes))
+            manifest_path = prepare_image.prepare_raw_image(img_path, d, **kwargs)
+            with open(manifest_path) as fh:
+                manifest = json.load(fh)
+            files = {}
+            for entry in manifest["resin.img"]["parts"]:
+                with open(os.path.join(d, "compressed", entry["filename"]), "rb") as pf:
+                    files[entry["filename"]] = pf.read()
+            return manifest, files
+
+    def test_parallel_jobs_match_serial(self):
+        image_bytes = _build_mbr_image()
+        self.assertEqual(
+            self._prepare_outputs(image_bytes, jobs=4),
+            self._prepare_outputs(image_bytes),
+        )
+
+    def test_mmap_matches_buffered(self):
+        image_bytes = _build_gpt_image() + _pattern(3 * prepare_image.CHUNK_SIZE + 7)
+        self.assertEqual(
+            self._prepare_outputs(image_bytes, use_mmap=True),
+            self._prepare_outputs(image_bytes),
+        )
+
+    def test_pipelined_matches_inline(self):
+        # Several chunks per part so the reader laps its buffer ring.
+        image_bytes = _build_gpt_image() + _pattern(5 * prepare_image.CHUNK_SIZE + 7)
+        for kwargs in ({}, {"block_size": 3000, "jobs": 2}):
+            pipelined = self._prepare_outputs(
+                image_bytes, read_ahead=1, write_behind=2, **kwargs
+            )
+            self.assertEqual(pipelined, self._prepare_outputs(image_bytes, **kwargs))
+
+    def test_write_behind_preallocation(self):
+        write_size = prepare_image.WRITE_SIZE
+        with tempfile.TemporaryDirectory() as d:
+            path = os.path.join(d, "part")
+            for result, size, expected in (
+                # Capped at the part's expected size.
+                (True, write_size + 5, [(0, write_size + 5)]),
+                # One refusal and the part is written without.
+                (False, 100 * write_size, [(0, prepare_image.PREALLOCATE_SIZE)]),
+            ):
+                calls = []
+
+                def preallocate(fd, offset, length):
+                    calls.append((offset, length))
+                    return result
+
+                with mock.patch.object(prepare_image, "_preallocate", preallocate):
+                    with prepare_image._open_output(path, 2, size=size) as out:
+                        for _ in range(3):
+                            out.write(bytes(write_size))
+                self.assertEqual(calls, expected)
+                self.assertEqual(os.path.getsize(path), 3 * write_size)
+
+            # A filesystem without fallocate is not asked again.
+            calls = []
+
+            def fallocate(fd, mode, offset, length):
+                calls.append((offset, length))
+                ctypes.set_errno(errno.EOPNOTSUPP)
+                return -1
+
+            with mock.patch.object(
+                prepare_image, "_fallocate_function", return_value=fallocate
+            ), mock.patch.object(prepare_image, "_NO_FALLOCATE", set()):
+                with open(path, "wb") as f:
+                    for _ in range(2):
+                        self.assertFalse(prepare_image._preallocate(f.fileno(), 0, 5))
+            self.assertEqual(calls, [(0, 5)])
+
+    def test_max_part_size(self):
+        chunk = prepare_image.CHUNK_SIZE
+        img = bytearray(_pattern(50 * SECTOR + 7 * chunk // 2))
+        _zero_ptable(img, 0)
+        _put_entry(img, 0, 0, 0x83, 40, 7 * chunk // 2 // SECTOR)  # 3.5 MiB
+        img[510], img[511] = 0x55, 0xAA
+        image_bytes = bytes(img)
+        manifest, files = self._prepare_outputs(image_bytes, max_part_size=chunk)
+        parts = manifest["resin.img"]["parts"]
+        starts = [40 * SECTOR + i * chunk for i in range(4)]
+        self.assertEqual(
+            [p["len"] for p in parts],
+            [40 * SECTOR, chunk, chunk, chunk, chunk // 2, 10 * SECTOR],
+        )
+        self.assertEqual(
+            [p.get("partitionIndex") for p in parts], [None] + ["(1)"] * 4 + [None]
+        )
+        for part, start in zip(parts[1:], starts):
+            data = image_bytes[start : start + part["len"]]
+            self.assertEqual(part["crc"], zlib.crc32(data))
+
+        # etcher-sdk consumption: concatenate every part, append DEFLATE_END.
+        blob = b"".join(files[p["filename"]] for p in parts)
+        whole = zlib.decompress(blob + DEFLATE_END, -zlib.MAX_WBITS)
+        self.assertEqual(whole, image_bytes)
+
+        self.assertEqual(
+            self._prepare_outputs(image_bytes, max_part_size=chunk, jobs=3),
+            (manifest, files),
+        )
+        stream = io.BufferedReader(io.BytesIO(gzip.compress(image_bytes)))
+        with tempfile.TemporaryDirectory() as d:
+            with prepare_image.open_image_stream(stream) as fh:
+                manifest_path = prepare_image.prepare_stream_image(
+                    fh, d, max_part_size=chunk
+                )
+            with open(manifest_path) as fh:
+                self.assertEqual(json.load(fh), manifest)
+
+    def test_zero_free_blocks(self):
+        image_bytes, zeroed = _build_fs_image()
+        manifest, files = self._prepare_outputs(image_bytes, zero_free=True)
+        parts = manifest["resin.img"]["parts"]
+        blob = b"".join(files[p["filename"]] for p in parts)
+        whole = zlib.decompress(blob + DEFLATE_END, -zlib.MAX_WBITS)
+        self.assertEqual(whole, zeroed)
+        offset = 0
+        for part in parts:
+            data = zeroed[offset : offset + part["len"]]
+            self.assertEqual(part["crc"], zlib.crc32(data))
+            offset += part["len"]
+        # Without the option the stale blocks are kept.
+        manifest, _ = self._prepare_outputs(image_bytes)
+        self.assertEqual(
+            manifest["resin.img"]["parts"][1]["crc"],
+            zlib.crc32(image_bytes[64 * SECTOR : 192 * SECTOR]),
+        )
+
+    def test_seek_index(self):
+        chunk = prepare_image.CHUNK_SIZE
+        tail = bytearray(_pattern(6 * chunk + 7))
+        tail[2 * chunk + 5 : 5 * chunk + 9] = bytes(3 * chunk + 4)  # 2 zero chunks
+        image_bytes = _build_gpt_image() + bytes(tail)
+        for kwargs in ({}, {"block_size": chunk // 4, "jobs": 2}):
+            with tempfile.TemporaryDirectory() as d:
+                img_path = os.path.join(d, "resin.img")
+                with open(img_path, "wb") as fh:
+                    fh.write(image_bytes)
+                manifest_path = prepare_image.prepare_raw_image(
+                    img_path, d, index_interval=chunk, **kwargs
+                )
+                with open(manifest_path) as fh:
+                    parts = json.load(fh)["resin.img"]["parts"]
+                index = prepare_image.load_index(manifest_path)
+                problems = prepare_image.verify_manifest(manifest_path, img_path)
+                self.assertEqual(problems, [])
+
+                start = len(image_bytes) - parts[-1]["len"]
+                data = image_bytes[start:]
+                part_path = os.path.join(d, "compressed", parts[-1]["filename"])
+                points = index[parts[-1]["filename"]]
+                self.assertGreaterEqual(len(points), 6)
+                for offset, z_offset, crc in points:
+                    self.assertEqual(crc, zlib.crc32(data[:offset]))
+                    with open(part_path, "rb") as fh:
+                        rest = b"".join(
+                            prepare_image.inflate_from(fh, [offset, z_offset, crc])
+                        )
+                    self.assertEqual(rest, data[offset:])
+                for offset in (0, 3 * chunk + 11, len(data) - 5):
+                    self.assertEqual(
+                        prepare_image.read_part_range(part_path, points, offset, 100),
+                        data[offset : offset + 100],
+                    )
+
+    def test_chunk_hashes(self):
+        chunk = prepare_image.CHUNK_SIZE
+        tail = bytearray(_pattern(6 * chunk + 7))
+        tail[chunk + 5 : 4 * chunk + 9] = bytes(3 * chunk + 4)  # 2 zero chunks
+        image_bytes = _build_gpt_image() + bytes(tail)
+        size = chunk * 3 // 2  # hash chunks straddle reads and zero runs
+        with tempfile.TemporaryDirectory() as d:
+            paths = []
+            for name, kwargs in (
+                ("old", {}),
+                ("new", {"block_size": chunk // 4, "jobs": 2}),
+            ):
+                os.mkdir(os.path.join(d, name))
+                img_path = os.path.join(d, name, "resin.img")
+                data = bytearray(image_bytes)
+                if name == "new":
+                    data[-3 * chunk] ^= 1
+                with open(img_path, "wb") as fh:
+                    fh.write(data)
+                manifest_path = prepare_image.prepare_raw_image(
+                    img_path, os.path.join(d, name), chunk_hash_size=size, **kwargs
+                )
+                paths.append(os.path.join(d, name, "image.hashes.json"))
+                for offset, length, digest in prepare_image.load_hashes(paths[-1])[1]:
+                    self.assertLessEqual(length, size)
+                    expected = hashlib.sha256(data[offset : offset + length])
+                    self.assertEqual(digest, expected.hexdigest())
+                with open(manifest_path) as fh:
+                    parts = json.load(fh)["resin.img"]["parts"]
+                self.assertNotIn("hashes", parts[0])
+
+            start = len(image_bytes) - parts[-1]["len"]
+            first = start + (len(image_bytes) - 3 * chunk - start) // size * size
+            self.assertEqual(
+                prepare_image.diff_hashes(*paths),
+                {
+                    "chunk_size": size,
+                    "changed": [[first, size]],
+                    "changed_bytes": size,
+                    "unchanged_bytes": len(image_bytes) - size,
+                },
+            )
+
+    def test_gzip_output(self):
+        image_bytes = _build_mbr_image() + bytes(prepare_image.CHUNK_SIZE) + b"tail"
+        for kwargs in ({}, {"block_size": 3000, "jobs": 2}):
+            with tempfile.TemporaryDirectory() as d:
+                img_path = os.path.join(d, "resin.img")
+                with open(img_path, "wb") as fh:
+                    fh.write(image_bytes)
+                prepare_image.prepare_raw_image(
+                    img_path, d, "-raw", gzip_output=True, **kwargs
+                )
+                with open(os.path.join(d, "image-raw.img.gz"), "rb") as fh:
+                    blob = fh.read()
+                self.assertTrue(blob.startswith(prepare_image.GZIP_HEADER))
+                self.assertEqual(gzip.decompress(blob), image_bytes)
+
+    def test_digests(self):
+        image_bytes = _build_mbr_image() + bytes(prepare_image.CHUNK_SIZE) + b"tail"
+        for kwargs in ({}, {"jobs": 3}, {"block_size": 3000, "jobs": 2}):
+            with tempfile.TemporaryDirectory() as d:
+                img_path = os.path.join(d, "resin.img")
+                with open(img_path, "wb") as fh:
+                    fh.write(image_bytes)
+                prepare_image.prepare_raw_image(
+                    img_path, d, gzip_output=True, digests=["sha256", "md5"], **kwargs
+                )
+                with open(os.path.join(d, "image.json")) as fh:
+                    self.assertNotIn("digests", json.load(fh)["resin.img"]["parts"][0])
+                with open(os.path.join(d, "image.digests.json")) as fh:
+                    digests = json.load(fh)["resin.img"]
+                self.assertEqual(
+                    digests["image"],
+                    {
+                        "sha256": hashlib.sha256(image_bytes).hexdigest(),
+                        "md5": hashlib.md5(image_bytes).hexdigest(),
+                    },
+                )
+                for name, entry in [("image.img.gz", digests["gzip"])] + [
+                    (os.path.join("compressed", part["filename"]), part)
+                    for part in digests["parts"]
+                ]:
+                    with open(os.path.join(d, name), "rb") as fh:
+                        data = fh.read()
+                    self.assertEqual(entry["sha256"], hashlib.sha256(data).hexdigest())
+            # Variable-length and unknown algorithms are refused before the
+            # image is even opened, by the CLI and by worker jobs alike.
+            for name in ("shake_128", "nope"):
+                with self.assertRaises(ValueError):
+                    prepare_image.prepare_job({"image": img_path, "digests": [name]})
+                with mock.patch("sys.stderr", io.StringIO()):
+                    with self.assertRaises(SystemExit):
+                        prepare_image.main(["--digests", name, img_path])
+
+    def test_ordered_digest(self):
+        # Parts fed out of order: part 2 runs past the budget, part 1 starts
+        # ahead of its turn and catches up once part 0 is done, and part 3
+        # comes from the cache, so only the bytes not held are read again.
+        size = 3000
+        image_bytes = bytearray(os.urandom(4 * size))
+        image_bytes[size + 1000 : size + 2000] = bytes(1000)
+        parts = [{"start": n * size, "end": (n + 1) * size - 1} for n in range(4)]
+        with tempfile.TemporaryDirectory() as d:
+            img_path = os.path.join(d, "resin.img")
+            with open(img_path, "wb") as fh:
+                fh.write(image_bytes)
+            h = hashlib.sha256()
+            ordered = prepare_image._OrderedDigest(img_path, parts, [h], budget=2500)
+            feeds = [ordered.feed(n) for n in range(4)]
+
+            def feed(n, lo, hi):
+                chunk = image_bytes[n * size + lo : n * size + hi]
+                if any(chunk):
+                    feeds[n].update(memoryview(chunk))
+                else:
+                    prepare_image._hash_zeros([feeds[n]], len(chunk))
+
+            ordered.finish(3)
+            for lo in range(0, size, 1000):
+                feed(2, lo, lo + 1000)
+            ordered.finish(2)
+            feed(1, 0, 1000)
+            feed(0, 0, size)
+            ordered.finish(0)
+            feed(1, 1000, size)
+            ordered.finish(1)
+            self.assertEqual(h.hexdigest(), hashlib.sha256(image_bytes).hexdigest())
+            self.assertEqual(ordered.reread, 1000 + 1000 + size)
+
+            # With no budget, part 1 is reread once part 0 is done; part 2
+            # keeps feeding its bytes while that reread is in progress.
+            h = hashlib.sha256()
+            ordered = prepare_image._OrderedDigest(img_path, parts, [h], budget=0)
+            feeds = [ordered.feed(n) for n in range(4)]
+            rereading, fed = threading.Event(), threading.Event()
+            reread, waited = ordered._reread, []
+
+            def slow_reread(*args):
+                rereading.set()
+                waited.append(fed.wait(5))
+                reread(*args)
+
+            feed(1, 0, size)
+            ordered.finish(1)
+            feed(0, 0, size)
+            with mock.patch.object(ordered, "_reread", slow_reread):
+                finishing = threading.Thread(target=ordered.finish, args=(0,))
+                finishing.start()
+                self.assertTrue(rereading.wait(5))
+                feed(2, 0, size)
+                fed.set()
+                finishing.join()
+                self.assertEqual(waited, [True])
+                ordered.finish(2)
+                feed(3, 0, size)
+                ordered.finish(3)
+            self.assertEqual(h.hexdigest(), hashlib.sha256(image_bytes).hexdigest())
+            self.assertEqual(ordered.reread, 2 * size)
+
+    def test_prime_parts(self):
+        # A zero run opening a logical partition: priming behind a zero run.
+        image = bytearray(_build_mbr_image())
+        image[51712:52712] = bytes(1000)
+        image_bytes = bytes(image)
+        plain = self._prepare_outputs(image_bytes)[0]["resin.img"]["parts"]
+        variants = (
+            {},
+            {"jobs": 3},
+            {"block_size": 3000, "jobs": 2},
+            {"index_interval": 4096},
+        )
+        for kwargs in variants:
+            manifest, files = self._prepare_outputs(
+                image_bytes, prime_parts=True, **kwargs
+            )
+            parts = manifest["resin.img"]["parts"]
+            self.assertEqual([p.get("primed") for p in parts], [None] + [True] * 6)
+            if not kwargs.get("block_size"):
+                self.assertLess(
+                    sum(p["zLen"] for p in parts), sum(p["zLen"] for p in plain)
+                )
+            blob = b"".join(files[p["filename"]] for p in parts)
+            whole = zlib.decompress(blob + DEFLATE_END, -zlib.MAX_WBITS)
+            self.assertEqual(whole, image_bytes)
+
+        with tempfile.TemporaryDirectory() as d:
+            img_path = os.path.join(d, "resin.img")
+            with open(img_path, "wb") as fh:
+                fh.write(image_bytes)
+            manifest_path = prepare_image.prepare_raw_image(
+                img_path, d, prime_parts=True, cache_dir=os.path.join(d, "cache")
+            )
+            self.assertEqual(prepare_image.verify_manifest(manifest_path), [])
+            self.assertEqual(prepare_image.verify_manifest(manifest_path, img_path), [])
+            with open(manifest_path) as fh:
+                manifest = json.load(fh)
+            stream_path = prepare_image.prepare_stream_image(
+                io.BytesIO(image_bytes), d, "-stream", prime_parts=True
+            )
+            with open(stream_path) as fh:
+                self.assertEqual(json.load(fh), manifest)
+
+    def test_bmap(self):
+        chunk = prepare_image.CHUNK_SIZE
+        tail = bytearray(_pattern(4 * chunk + 7))
+        tail[chunk + 5 : 3 * chunk + 9] = bytes(2 * chunk + 4)  # a zero chunk
+        tail[chunk + 9000 : chunk + 9002] = b"\x01\x02"  # in a zero chunk
+        tail[3 * chunk + 4096 : 3 * chunk + 3 * 4096] = bytes(2 * 4096)
+        image_bytes = _build_gpt_image() + bytes(tail)
+        hole = len(image_bytes) - len(tail) + chunk + 4 * 4096
+        for kwargs in ({}, {"block_size": chunk // 4, "jobs": 2}):
+            with tempfile.TemporaryDirectory() as d:
+                img_path = os.path.join(d, "resin.img")
+                with open(img_path, "wb") as fh:
+                    fh.write(image_bytes[:hole])
+                    fh.seek(hole + chunk)  # sparse where the filesystem allows
+                    fh.write(image_bytes[hole + chunk :])
+                manifest_path = prepare_image.prepare_raw_image(
+                    img_path, d, bmap=True, **kwargs
+                )
+                with open(manifest_path) as fh:
+                    self.assertNotIn("bmap", json.load(fh)["resin.img"]["parts"][0])
+                with open(os.path.join(d, "image.bmap")) as fh:
+                    text = fh.read()
+                root = ElementTree.fromstring(text)
+                checksum = root.findtext("BmapFileChecksum").strip()
+                zeroed = text.replace(checksum, "0" * 64)
+                self.assertEqual(checksum, hashlib.sha256(zeroed.encode()).hexdigest())
+                block_size = int(root.findtext("BlockSize"))
+                self.assertEqual(int(root.findtext("ImageSize")), len(image_bytes))
+
+                mapped = bytearray(len(image_bytes))
+                for item in root.iter("Range"):
+                    first, _sep, last = item.text.strip().partition("-")
+                    start = int(first) * block_size
+                    end = min((int(last or first) + 1) * block_size, len(image_bytes))
+                    data = image_bytes[start:end]
+                    digest = hashlib.sha256(data).hexdigest()
+                    self.assertEqual(item.get("chksum"), digest)
+                    mapped[start:end] = data
+                self.assertEqual(bytes(mapped), image_bytes)  # nothing unmapped
+                self.assertLess(
+                    int(root.findtext("MappedBlocksCount")),
+                    int(root.findtext("BlocksCount")) - 2 * chunk // block_size,
+                )
+
+    def test_crc32_combine(self):
+        a, b = _pattern(1000), _pattern(70000)[::-1]
+        self.assertEqual(
+            prepare_image.crc32_combine(zlib.crc32(a), zlib.crc32(b), len(b)),
+            zlib.crc32(a + b),
+        )
+
+    def test_block_parallel_roundtrip(self):
+        # Blocks smaller than the window and not sector-aligned exercise the
+        # zdict history carried across block boundaries.
+        image_bytes = _build_mbr_image()
+        manifest, files = self._prepare_outputs(image_bytes, jobs=3, block_size=3000)
+        serial, _ = self._prepare_outputs(image_bytes)
+        blob = b""
+        parts = zip(manifest["resin.img"]["parts"], serial["resin.img"]["parts"])
+        for entry, ref in parts:
+            self.assertEqual((entry["crc"], entry["len"]), (ref["crc"], ref["len"]))
+            raw = files[entry["filename"]]
+            self.assertTrue(raw.endswith(SYNC_FLUSH_MARKER))
+            blob += raw
+        whole = zlib.decompress(blob + DEFLATE_END, -zlib.MAX_WBITS)
+        self.assertEqual(whole, image_bytes)
+
+        # Parts compressing at once share one pool of jobs block threads.
+        lock = threading.Lock()
+        running, peak = 0, 0
+        compress_block = prepare_image._compress_block
+
+        def counting(*args):
+            nonlocal running, peak
+            with lock:
+                running += 1
+                peak = max(peak, running)
+            time.sleep(0.001)
+            try:
+                return compress_block(*args)
+            finally:
+                with lock:
+                    running -= 1
+
+        with mock.patch.object(prepare_image, "_compress_block", counting):
+            again = self._prepare_outputs(image_bytes, jobs=3, block_size=3000)
+        self.assertEqual(again, (manifest, files))
+        self.assertLessEqual(peak, 3)
+
+    def test_crc32_zeros(self):
+        a = _pattern(777)
+        chunk = prepare_image.CHUNK_SIZE
+        for n in (0, 1, 4096, chunk, chunk + 1, 3 * 1024 * 1024 + 5):
+            self.assertEqual(
+                prepare_image.crc32_zeros(zlib.crc32(a), n),
+                zlib.crc32(a + bytes(n)),
+            )
+
+    def test_zero_runs_roundtrip(self):
+        # A data partition with a hole plus an all-zero (but written) region, and
+        # a zero gap, straddling chunk boundaries.
+        image_bytes = bytearray(_build_mbr_image())
+        image_bytes += _pattern(3 * prepare_image.CHUNK_SIZE)
+        image_bytes[200000:2500000] = bytes(2300000)
+        image_bytes[2600000:2700000] = bytes(100000)
+        image_bytes = bytes(image_bytes)
+        holes = [(1 << 20, 1 << 20)]
+        plain, _ = self._prepare_outputs(image_bytes, detect_zeros=False)
+        for kwargs in (
+            {},
+            {"use_mmap": True},
+            {"jobs": 2, "block_size": 1 << 19, "use_mmap": True},
+        ):
+            manifest, files = self._prepare_outputs(image_bytes, holes, **kwargs)
+            parts = manifest["resin.img"]["parts"]
+            self.assertEqual(
+                [(p["crc"], p["len"]) for p in parts],
+                [(p["crc"], p["len"]) for p in plain["resin.img"]["parts"]],
+            )
+            blob = b"".join(files[p["filename"]] for p in parts)
+            self.assertTrue(blob.endswith(SYNC_FLUSH_MARKER))
+            whole = zlib.decompress(blob + DEFLATE_END, -zlib.MAX_WBITS)
+            self.assertEqual(whole, image_bytes)
+
+    def test_part_cache(self):
+        image_bytes = _build_gpt_image()
+
+        def cached():
+            return sorted(
+                name
+                for _root, _dirs, files in os.walk(cache_dir)
+                for name in files
+                if name.endswith(".deflate")
+            )
+
+        with tempfile.TemporaryDirectory() as cache_dir:
+            # A cold cache: a part is either read for its key (and found, if
+            # it repeats an earlier part) or compressed with the key hashed
+            # alongside, never read twice.
+            with mock.patch.object(
+                prepare_image, "_cache_key", wraps=prepare_image._cache_key
+            ) as key, mock.patch.object(
+                prepare_image, "compress_range", wraps=prepare_image.compress_range
+            ) as compress:
+                first = self._prepare_outputs(image_bytes, cache_dir=cache_dir)
+            parts = len(first[0]["resin.img"]["parts"])
+            self.assertEqual(key.call_count + compress.call_count, parts)
+            self.assertEqual(compress.call_count, len(cached()))
+            entries = len(cached())
+            calls = []
+            original = prepare_image.compress_range
+            prepare_image.compress_range = lambda *a, **k: calls.append(a)
+            try:
+                second = self._prepare_outputs(image_bytes, jobs=2, cache_dir=cache_dir)
+            finally:
+                prepare_image.compress_range = original
+            self.assertEqual(calls, [])
+            self.assertEqual(second, first)
+
+            # Different settings must not hit entries made with other settings.
+            manifest, _ = self._prepare_outputs(
+                image_bytes, detect_zeros=False, cache_dir=cache_dir
+            )
+            self.assertEqual(manifest, first[0])
+            self.assertEqual(len(cached()), 2 * entries)
+
+            # Same first and last chunk, other bytes between: the probe key
+            # matches, but the full key keeps the stale entry from being used.
+            chunk = prepare_image.CHUNK_SIZE
+            big = _build_gpt_image() + _pattern(3 * chunk)
+            changed = bytearray(big)
+            changed[len(big) - 2 * chunk] ^= 0xFF
+            self._prepare_outputs(big, cache_dir=cache_dir)
+            manifest, _ = self._prepare_outputs(bytes(changed), cache_dir=cache_dir)
+            self.assertEqual(manifest, self._prepare_outputs(bytes(changed))[0])
+
+            # Entries evicted by another build while being fetched: each is
+            # either still served or counted a miss and compressed again.
+            link = os.link
+
+            def evicting_link(src, dst):
+                link(src, dst)
+                os.remove(src[: -len(".deflate")] + ".json")
+                os.remove(src)
+
+            with mock.patch.object(os, "link", evicting_link):
+                evicted = self._prepare_outputs(image_bytes, cache_dir=cache_dir)
+            self.assertEqual(evicted, first)
+
+            prepare_image.evict_cache(cache_dir, 0)
+            self.assertEqual(cached(), [])
+            self.assertEqual(
+                [files for _root, _dirs, files in os.walk(cache_dir) if files], []
+            )
+
+    def test_multiple_images_one_invocation(self):
+        mbr, gpt = _build_mbr_image(), _build_gpt_image()
+        with tempfile.TemporaryDirectory() as d:
+            for name, data in (("main.img", mbr), ("flasher.img", gpt)):
+                with open(os.path.join(d, name), "wb") as fh:
+                    fh.write(data)
+            prepare_image.main(
+                [
+                    os.path.join(d, "main.img"),
+                    os.path.join(d, "flasher.img") + ":flasher",
+                    "--jobs",
+                    "3",
+                ]
+            )
+            for suffix, data in (("", mbr), ("-flasher", gpt)):
+                with open(os.path.join(d, f"image{suffix}.json")) as fh:
+                    manifest = json.load(fh)
+                self.assertEqual(manifest, self._prepare_outputs(data)[0])
+                blob = b""
+                for entry in manifest["resin.img"]["parts"]:
+                    parts_dir = os.path.join(d, f"compressed{suffix}")
+                    with open(os.path.join(parts_dir, entry["filename"]), "rb") as pf:
+                        blob += pf.read()
+                whole = zlib.decompress(blob + DEFLATE_END, -zlib.MAX_WBITS)
+                self.assertEqual(whole, data)
+
+    def test_worker(self):
+        mbr, gpt = _build_mbr_image(), _build_gpt_image()
+        with tempfile.TemporaryDirectory() as d:
+            for name, data in (("main.img", mbr), ("flasher.img", gpt)):
+                with open(os.path.join(d, name), "wb") as fh:
+                    fh.write(data)
+            # A truncated .img.gz fails in the gzip reader (EOFError) and
+            # must not take the worker, and the jobs queued behind it, down.
+            with open(os.path.join(d, "bad.img.gz"), "wb") as fh:
+                fh.write(gzip.compress(mbr)[:-100])
+            lines = io.StringIO(
+                json.dumps(os.path.join(d, "bad.img.gz"))
+                + "\n"
+                + json.dumps(os.path.join(d, "main.img"))
+                + "\n"
+                + json.dumps({"image": os.path.join(d, "missing.img")})
+                + "\n"
+            )
+            events = []
+            umask = os.umask(0o022)
+            os.umask(umask)
+            # The failed job's file is closed with its stream, not left to leak.
+            with warnings.catch_warnings(record=True) as caught:
+                warnings.simplefilter("always", ResourceWarning)
+                prepare_image.run_worker(
+                    prepare_image.read_jobs(lines), events.append, 2
+                )
+                gc.collect()
+            self.assertEqual(
+                [w for w in caught if issubclass(w.category, ResourceWarning)], []
+            )
+            self.assertEqual(os.umask(umask), umask)
+            self.assertEqual(
+                [e["event"] for e in events], ["job_failed", "job_done", "job_failed"]
+            )
+            self.assertTrue(events[0]["error"])
+            with open(events[1]["manifest"]) as fh:
+                self.assertEqual(json.load(fh), self._prepare_outputs(mbr)[0])
+
+            # Two images matching the same glob, and a link to one of them:
+            # each image gets its own output directory, the link none.
+            with open(os.path.join(d, "other.img"), "wb") as fh:
+                fh.write(gpt)
+            os.symlink("main.img", os.path.join(d, "latest.img"))
+            matches = [("flasher.*", "flasher"), ("*.img", "")]
+            with mock.patch.object(prepare_image, "WATCH_POLL", 0):
+                jobs = list(prepare_image.watch_jobs(d, matches, polls=2))
+            self.assertEqual(
+                jobs,
+                [
+                    {
+                        "image": os.path.join(d, name),
+                        "type": image_type,
+                        "output_dir": os.path.join(d, f"{name}.prepared"),
+                    }
+                    for name, image_type in (
+                        ("flasher.img", "flasher"),
+                        ("main.img", ""),
+                        ("other.img", ""),
+                    )
+                ],
+            )
+            events = []
+            prepare_image.run_worker(jobs, events.append, 2)
+            for job, data in zip(jobs, (gpt, mbr, gpt)):
+                suffix = f"-{job['type']}" if job["type"] else ""
+                with open(os.path.join(job["output_dir"], f"image{suffix}.json")) as fh:
+                    self.assertEqual(json.load(fh), self._prepare_outputs(data)[0])
+            # Each is now older than its own manifest.
+            with mock.patch.object(prepare_image, "WATCH_POLL", 0):
+                rescan = list(prepare_image.watch_jobs(d, matches, polls=2))
+            self.assertEqual(rescan, [])
+
+    def test_compression_policies(self):
+        image_bytes = bytearray(_build_gpt_image())
+        # Random bytes in partition 3 so the tuned policy stores it.
+        image_bytes[23040:25600] = os.urandom(25600 - 23040)
+        image_bytes = bytes(image_bytes)
+        default, _ = self._prepare_outputs(image_bytes)
+        for policy in ("tuned", "auto"):
+            with tempfile.TemporaryDirectory() as d:
+                img_path = os.path.join(d, "resin.img")
+                with open(img_path, "wb") as fh:
+                    fh.write(image_bytes)
+                manifest_path = prepare_image.prepare_raw_image(
+                    img_path, d, policy=policy
+                )
+                with open(manifest_path) as fh:
+                    parts = json.load(fh)["resin.img"]["parts"]
+                with open(os.path.join(d, "image.stats.json")) as fh:
+                    stats = json.load(fh)["resin.img"]["parts"]
+                blob = b""
+                for entry in parts:
+                    part_path = os.path.join(d, "compressed", entry["filename"])
+                    with open(part_path, "rb") as pf:
+                        blob += pf.read()
+            self.assertEqual(
+                [(p["crc"], p["len"]) for p in parts],
+                [(p["crc"], p["len"]) for p in default["resin.img"]["parts"]],
+            )
+            self.assertEqual(
+                [s["filename"] for s in stats], [p["filename"] for p in parts]
+            )
+            whole = zlib.decompress(blob + DEFLATE_END, -zlib.MAX_WBITS)
+            self.assertEqual(whole, image_bytes)
+            if policy == "tuned":
+                self.assertEqual(
+                    [(s["level"], s["reason"]) for s in stats],
+                    [
+                        (1, "gap"),
+                        (9, "partition"),
+                        (1, "gap"),
+                        (0, "incompressible"),
+                        (1, "gap"),
+                    ],
+                )
+
+        # "auto" ranks by sampled size, cheapest candidate first on near-ties,
+        # so the choice never depends on how fast this run happened to be.
+        f = io.BytesIO(image_bytes)
+        with mock.patch.object(time, "perf_counter", side_effect=AssertionError):
+            incompressible = prepare_image.choose_settings(
+                f, {"start": 23040, "end": 25599, "partition_index": 3}, "auto"
+            )
+            run = prepare_image.choose_settings(
+                io.BytesIO(b"\x01" * 24576), {"start": 0, "end": 24575}, "auto"
+            )
+            # Levels 6 and 9 tie here; 6 is cheaper.
+            text = prepare_image.choose_settings(
+                io.BytesIO(b"resin " * 4096), {"start": 0, "end": 24575}, "auto"
+            )
+        self.assertEqual(incompressible["level"], 0)
+        self.assertEqual((run["level"], run["strategy"]), (1, zlib.Z_RLE))
+        self.assertEqual(
+            (text["level"], text["strategy"]), (6, zlib.Z_DEFAULT_STRATEGY)
+        )
+
+    def test_stats_and_progress(self):
+        image_bytes = _build_mbr_image()
+        events = []
+        with tempfile.TemporaryDirectory() as d:
+            img_path = os.path.join(d, "resin.img")
+            with open(img_path, "wb") as fh:
+                fh.write(image_bytes)
+            summary_path = os.path.join(d, "summary.json")
+            prepare_image.prepare_raw_image(
+                img_path,
+                d,
+                instrument=True,
+                progress=events.append,
+                stats_path=summary_path,
+            )
+            with open(os.path.join(d, "image.stats.json")) as fh:
+                stats = json.load(fh)["resin.img"]["parts"]
+            with open(summary_path) as fh:
+                summary = json.load(fh)["images"]
+
+        self.assertEqual(len(stats), len(MBR_GOLDEN_PLAN))
+        for part, golden in zip(stats, MBR_GOLDEN_PLAN):
+            self.assertEqual(part["bytes_in"], golden["end"] - golden["start"] + 1)
+            for phase in prepare_image.TIMED_PHASES:
+                self.assertGreaterEqual(part[f"{phase}_s"], 0)
+        self.assertEqual(summary[0]["bytes_in"], len(image_bytes))
+        self.assertEqual(
+            [e["event"] for e in events],
+            ["part_start", "part_done"] * len(MBR_GOLDEN_PLAN),
+        )
+
+    def test_stream_matches_file(self):
+        # The MBR image truncated right after L2 exercises a stream that ends
+        # exactly at the last partition (no trailing gap part).
+        images = (_build_mbr_image(), _build_gpt_image(), _build_mbr_image()[:82432])
+        for image_bytes in images:
+            expected = self._prepare_outputs(image_bytes)
+            for compress in (gzip.compress, lzma.compress):
+                # BufferedReader: peekable like stdin, but not a real file.
+                stream = io.BufferedReader(io.BytesIO(compress(image_bytes)))
+                with tempfile.TemporaryDirectory() as d:
+                    with prepare_image.open_image_stream(stream) as fh:
+                        manifest_path = prepare_image.prepare_stream_image(fh, d)
+                    with open(manifest_path) as fh:
+                        manifest = json.load(fh)
+                    files = {}
+                    for entry in manifest["resin.img"]["parts"]:
+                        part_path = os.path.join(d, "compressed", entry["filename"])
+                        with open(part_path, "rb") as pf:
+                            files[entry["filename"]] = pf.read()
+                self.assertEqual((manifest, files), expected)
+
+    def test_verify(self):
+        image_bytes = _build_mbr_image()
+        with tempfile.TemporaryDirectory() as d:
+            img_path = os.path.join(d, "resin.img")
+            with open(img_path, "wb") as fh:
+                fh.write(image_bytes)
+            manifest_path = prepare_image.prepare_raw_image(img_path, d)
+            self.assertEqual(prepare_image.verify_manifest(manifest_path, img_path), [])
+            self.assertEqual(
+                prepare_image.main(["verify", manifest_path, "--image", img_path]), 0
+            )
+            # The subcommand does not depend on which files exist: an image
+            # named "verify" is compressed only when given after "--".
+            cwd = os.getcwd()
+            os.chdir(d)
+            try:
+                os.link(img_path, "verify")
+                args = ["verify", manifest_path, "--image", img_path]
+                self.assertEqual(prepare_image.main(args), 0)
+                os.mkdir("named")
+                with mock.patch("sys.stdout", io.StringIO()):
+                    prepare_image.main(["-o", "named", "--", "verify"])
+            finally:
+                os.chdir(cwd)
+            with open(os.path.join(d, "named", "image.json")) as fh:
+                with open(manifest_path) as ref:
+                    self.assertEqual(json.load(fh), json.load(ref))
+
+            # A different image, a wrong crc and a part without its sync marker.
+            other = os.path.join(d, "other.img")
+            with open(other, "wb") as fh:
+                fh.write(image_bytes[:-1] + b"\x01")
+            with open(manifest_path) as fh:
+                manifest = json.load(fh)
+            parts = manifest["resin.img"]["parts"]
+            parts[1]["crc"] ^= 1
+            with open(manifest_path, "w") as fh:
+                json.dump(manifest, fh)
+            last = os.path.join(d, "compressed", parts[-1]["filename"])
+            with open(last, "r+b") as fh:
+                fh.truncate(parts[-1]["zLen"] - 4)
+            problems = prepare_image.verify_manifest(manifest_path, other, jobs=2)
+            self.assertEqual(len(problems), 4, problems)
+            self.assertIn("crc", problems[0])
+            self.assertIn("zLen", problems[1])
+            self.assertIn("sync flush marker", problems[2])
+            self.assertIn(f"offset {len(image_bytes) - 1}", problems[3])
+
     def test_mbr_plan(self):
         self._assert_plan(_build_mbr_image(), MBR_GOLDEN_PLAN)
 
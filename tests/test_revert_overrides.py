@@ -0,0 +1,383 @@
+#!/usr/bin/env python3
+"""Golden test for revert-overrides.py, the new-to-old override converter.
+
+Runs the script over a small layer tree written from the strings below and
+asserts every file comes out byte-for-byte as EXPECTED. EXPECTED was produced
+by the original one-substitution-per-rule implementation, so this pins the
+output while the matching engine underneath changes. The inputs cover each
+rule family (package variables, overrides, the restricted short overrides),
+the skip list and its ptest exception, the literal substitutions, the
+pkg_postinst:ontarget fixup and lines with a ':' that is not an override.
+
+The engine is also imported directly (revert_overrides) to check that
+converting a string, a stream and a tree serially or on a process pool agree
+with the script, and line by line against the original per-regex rules kept
+verbatim in revert_overrides_reference.py: over the sample layer in
+data/revert-overrides-layer, over generated lines, and over any real layers
+(e.g. poky and meta-balena checkouts) listed in $REVERT_OVERRIDES_LAYERS.
+
+Stdlib only:
+    python3 tests/test_revert_overrides.py
+"""
+
+import importlib.util
+import io
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import unittest
+import warnings
+
+_SCRIPTS_DIR = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+    "automation",
+    "conversion_scripts",
+)
+_SCRIPT_PATH = os.path.join(_SCRIPTS_DIR, "revert-overrides.py")
+_spec = importlib.util.spec_from_file_location(
+    "revert_overrides", os.path.join(_SCRIPTS_DIR, "revert_overrides.py")
+)
+revert_overrides = importlib.util.module_from_spec(_spec)
+# Registered so processtree's worker processes can unpickle its functions.
+sys.modules["revert_overrides"] = revert_overrides
+_spec.loader.exec_module(revert_overrides)
+
+_TESTS_DIR = os.path.dirname(os.path.abspath(__file__))
+_spec = importlib.util.spec_from_file_location(
+    "revert_overrides_reference",
+    os.path.join(_TESTS_DIR, "revert_overrides_reference.py"),
+)
+reference = importlib.util.module_from_spec(_spec)
+with warnings.catch_warnings():
+    # Its verbatim regexes use invalid escapes ('\s') in plain strings.
+    warnings.simplefilter("ignore", (DeprecationWarning, SyntaxWarning))
+    _spec.loader.exec_module(reference)
+# A layer of bitbake metadata in the idioms of poky and meta-balena.
+SAMPLE_LAYER = os.path.join(_TESTS_DIR, "data", "revert-overrides-layer")
+
+CORPUS = {
+    "recipes-core/balena-engine/balena-engine_git.bb": '''\
+SUMMARY:${PN} = "Moby-based container engine"
+DESCRIPTION:${PN}-dev = "Development files"
+LICENSE:${PN} = "Apache-2.0"
+SRC_URI:append = " file://balena.service"
+SRC_URI:append:class-native = " file://native.patch"
+DEPENDS:append:arm = " libseccomp"
+GO_LDFLAGS:remove:aarch64 = "-s"
+GOARCH:arc = "arc"
+GOARCH:arch = "unchanged"
+FILES:${PN} += "${bindir}/balena-engine"
+FILES:${PN}-dev:append = " ${includedir}"
+RDEPENDS:${PN} = "curl util-linux-lsblk"
+RDEPENDS:${PN}:append:qemux86 = " kernel-module-tun"
+RRECOMMENDS:${PN}:class-target = "kernel-modules"
+SYSTEMD_SERVICE:${PN} = "balena.service balena-engine.socket"
+SYSTEMD_AUTO_ENABLE:${PN} = "enable"
+INSANE_SKIP:${PN} += "already-stripped"
+ALTERNATIVE:${PN} = "docker"
+pkg_postinst:ontarget:${PN}() {
+	systemctl daemon-reload
+}
+do_install:append() {
+	install -d ${D}${systemd_unitdir}/system
+}
+do_compile:prepend:x86-x32() {
+	export GO386=softfloat
+}
+''',
+    "classes/image-balena.bbclass": '''\
+IMAGE_CMD:balenaos-img () {
+	dd if=/dev/zero of=${BALENA_RAW_IMG} bs=1M count=0
+}
+IMAGE_TYPEDEP:balenaos-img = "ext4"
+CONVERSION_CMD:gz = "gzip -f -9 ${IMAGE_NAME}"
+python __anonymous () {
+    d.appendVar("IMAGE_INSTALL", " balena")
+    val = d.getVar('%s:%s' % (var, pkg))
+    r = re.compile("([^:]+):\\s*(.*)")
+    bb.build.exec_func('parser_append:foo', d)
+    if d.getVar('OVERRIDES:x86'):
+        pass
+}
+do_rootfs[depends] += "mtools-native:do_populate_sysroot"
+BALENA_BOOT_PARTITION_FILES:append:raspberrypi = " bootcode.bin:/"
+''',
+    "conf/machine/include/genericx86.inc": '''\
+# Override order matters: MACHINEOVERRIDES =. "genericx86:"
+TUNE_FEATURES:tune-core2 = "m32 core2"
+PREFERRED_PROVIDER:virtual/kernel:genericx86 = "linux-yocto"
+KERNEL_IMAGETYPE:mips = "vmlinux"
+KERNEL_IMAGETYPE:mipsel = "vmlinux"
+EXTRA_OECONF:append:libc-musl = " --disable-nls"
+EXTRA_OECONF:remove:pn-gcc = "--with-foo"
+CFLAGS:append:sh4 = " -ml"
+VAR:forcevariable = "1"
+FOO:arm:poky = "a"
+RDEPENDS:${PN}-ptest:append = " bash"
+do_install_ptest_append() {
+	:
+}
+TEST:armv5 = "x" TEST2:armv6 = "y"
+URL = "https://example.org:8080/path"
+''',
+}
+
+# Output of the original implementation on CORPUS.
+EXPECTED = {
+    "recipes-core/balena-engine/balena-engine_git.bb": '''\
+SUMMARY_${PN} = "Moby-based container engine"
+DESCRIPTION_${PN}-dev = "Development files"
+LICENSE_${PN} = "Apache-2.0"
+SRC_URI_append = " file://balena.service"
+SRC_URI_append_class-native = " file://native.patch"
+DEPENDS_append_arm = " libseccomp"
+GO_LDFLAGS_remove_aarch64 = "-s"
+GOARCH_arc = "arc"
+GOARCH:arch = "unchanged"
+FILES_${PN} += "${bindir}/balena-engine"
+FILES_${PN}-dev_append = " ${includedir}"
+RDEPENDS_${PN} = "curl util-linux-lsblk"
+RDEPENDS_${PN}_append_qemux86 = " kernel-module-tun"
+RRECOMMENDS_${PN}_class-target = "kernel-modules"
+SYSTEMD_SERVICE_${PN} = "balena.service balena-engine.socket"
+SYSTEMD_AUTO_ENABLE_${PN} = "enable"
+INSANE_SKIP_${PN} += "already-stripped"
+ALTERNATIVE_${PN} = "docker"
+pkg_postinst_ontarget:${PN}() {
+	systemctl daemon-reload
+}
+do_install_append() {
+	install -d ${D}${systemd_unitdir}/system
+}
+do_compile_prepend_x86-x32() {
+	export GO386=softfloat
+}
+''',
+    "classes/image-balena.bbclass": '''\
+IMAGE_CMD_balenaos-img () {
+	dd if=/dev/zero of=${BALENA_RAW_IMG} bs=1M count=0
+}
+IMAGE_TYPEDEP_balenaos-img = "ext4"
+CONVERSION_CMD_gz = "gzip -f -9 ${IMAGE_NAME}"
+python __anonymous () {
+    d.appendVar("IMAGE_INSTALL", " balena")
+    val = d.getVar('%s_%s' % (var, pkg))
+    r = re.compile("(^.+?):\\s+(.*)")
+    bb.build.exec_func('parser_append:foo', d)
+    if d.getVar('OVERRIDES_x86'):
+        pass
+}
+do_rootfs[depends] += "mtools-native:do_populate_sysroot"
+BALENA_BOOT_PARTITION_FILES_append:raspberrypi = " bootcode.bin:/"
+''',
+    "conf/machine/include/genericx86.inc": '''\
+# Override order matters: MACHINEOVERRIDES =. "genericx86:"
+TUNE_FEATURES_tune-core2 = "m32 core2"
+PREFERRED_PROVIDER:virtual/kernel:genericx86 = "linux-yocto"
+KERNEL_IMAGETYPE_mips = "vmlinux"
+KERNEL_IMAGETYPE_mipsel = "vmlinux"
+EXTRA_OECONF_append_libc-musl = " --disable-nls"
+EXTRA_OECONF_remove_pn-gcc = "--with-foo"
+CFLAGS_append_sh4 = " -ml"
+VAR_forcevariable = "1"
+FOO_arm_poky = "a"
+RDEPENDS_${PN}-ptest_append = " bash"
+do_install_ptest_append() {
+	:
+}
+TEST_armv5 = "x" TEST2_armv6 = "y"
+URL = "https://example.org:8080/path"
+''',
+}
+
+
+def _write_tree(root, files):
+    for name, text in files.items():
+        path = os.path.join(root, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "w") as fh:
+            fh.write(text)
+
+
+def _read_tree(root):
+    files = {}
+    for dirpath, _dirs, names in os.walk(root):
+        for name in names:
+            path = os.path.join(dirpath, name)
+            with open(path) as fh:
+                files[os.path.relpath(path, root)] = fh.read()
+    return files
+
+
+class RevertOverridesTest(unittest.TestCase):
+    def _run(self, *args):
+        return subprocess.run(
+            [sys.executable, _SCRIPT_PATH, *args],
+            check=True,
+            capture_output=True,
+            text=True,
+        ).stdout
+
+    def test_directory(self):
+        with tempfile.TemporaryDirectory() as d:
+            _write_tree(d, CORPUS)
+            out = self._run(d)
+            self.assertEqual(_read_tree(d), EXPECTED)
+        self.assertIn("3 files scanned, 3 changed, 0 skipped", out)
+
+    def test_unchanged_files_untouched(self):
+        # Files needing no conversion keep their inode and mtime; files that
+        # are not text are counted as skipped and left as they are.
+        with tempfile.TemporaryDirectory() as d:
+            _write_tree(d, {"recipe.bb": 'SRC_URI += "file://a.patch"\n'})
+            _write_tree(d, {"recipe.bbappend": 'SRC_URI:append = " file://b"\n'})
+            with open(os.path.join(d, "logo.png"), "wb") as fh:
+                fh.write(b"\x89PNG\r\n\x1a\n\xff\xfe:append")
+            path = os.path.join(d, "recipe.bb")
+            os.utime(path, (1, 1))
+            before = os.stat(path)
+            out = self._run(d)
+            after = os.stat(path)
+            self.assertEqual(
+                (after.st_ino, after.st_mtime), (before.st_ino, before.st_mtime)
+            )
+            with open(os.path.join(d, "recipe.bbappend")) as fh:
+                self.assertEqual(fh.read(), 'SRC_URI_append = " file://b"\n')
+            self.assertEqual(
+                sorted(os.listdir(d)), ["logo.png", "recipe.bb", "recipe.bbappend"]
+            )
+        self.assertIn("2 files scanned, 1 changed, 1 skipped", out)
+
+    def test_single_file(self):
+        name = "conf/machine/include/genericx86.inc"
+        with tempfile.TemporaryDirectory() as d:
+            _write_tree(d, {name: CORPUS[name]})
+            self._run(os.path.join(d, name))
+            self.assertEqual(_read_tree(d), {name: EXPECTED[name]})
+
+    def test_stamp_file(self):
+        with tempfile.TemporaryDirectory() as d:
+            tree = os.path.join(d, "layer")
+            stamp_file = os.path.join(d, "stamps.json")
+            _write_tree(tree, CORPUS)
+            with open(os.path.join(tree, "logo.png"), "wb") as fh:
+                fh.write(b"\x89PNG\r\n\x1a\n\x00\x00:append")
+            first = self._run("--stamp-file", stamp_file, tree)
+            self.assertIn("3 changed, 1 skipped, 0 up to date", first)
+            # Converting again would change image-balena.bbclass further (the
+            # conversion is not idempotent); the stamps keep that from happening.
+            second = self._run("--stamp-file", stamp_file, tree)
+            self.assertIn("0 changed, 1 skipped, 3 up to date", second)
+            # Touched but not modified: rehashed, not converted.
+            name = "recipes-core/balena-engine/balena-engine_git.bb"
+            path = os.path.join(tree, name)
+            os.utime(path, (1, 1))
+            third = self._run("--stamp-file", stamp_file, tree)
+            self.assertIn("0 changed, 1 skipped, 3 up to date", third)
+            with open(path, "a") as fh:
+                fh.write('DEPENDS:append = " go"\n')
+            fourth = self._run("--stamp-file", stamp_file, tree)
+            self.assertIn("1 changed, 1 skipped, 2 up to date", fourth)
+            with open(path) as fh:
+                self.assertTrue(fh.read().endswith('\nDEPENDS_append = " go"\n'))
+            # Stamps of files gone from the tree are dropped; those of files
+            # outside it are kept.
+            other = os.path.join(d, "other", "recipe.bb")
+            _write_tree(d, {"other/recipe.bb": 'A:append = "1"\n'})
+            self._run("--stamp-file", stamp_file, other)
+            os.remove(path)
+            fifth = self._run("--stamp-file", stamp_file, tree)
+            self.assertIn("0 changed, 1 skipped, 2 up to date", fifth)
+            with open(stamp_file) as fh:
+                stamped = sorted(json.load(fh)["files"])
+            self.assertEqual(
+                stamped,
+                sorted(
+                    [os.path.join(tree, n) for n in CORPUS if n != name] + [other]
+                ),
+            )
+        # Without a stamp file nothing is hashed or stamped.
+        with tempfile.TemporaryDirectory() as d:
+            _write_tree(d, {"recipe.bb": 'A:append = "1"\n'})
+            status = revert_overrides.processfile(os.path.join(d, "recipe.bb"))
+        self.assertEqual(status, ("changed", None))
+
+    def _assert_same_as_reference(self, lines, where):
+        for number, line in enumerate(lines, 1):
+            self.assertEqual(
+                revert_overrides.convertline(line),
+                reference.referenceline(line),
+                f"{where}:{number}: {line!r}",
+            )
+
+    def test_reference_layers(self):
+        # The engine against the original per-regex rules, line by line, over
+        # the sample layer and over any real layers (e.g. poky and
+        # meta-balena checkouts) listed in REVERT_OVERRIDES_LAYERS.
+        layers = [SAMPLE_LAYER]
+        layers += os.environ.get("REVERT_OVERRIDES_LAYERS", "").split(os.pathsep)
+        files = 0
+        for layer in filter(None, layers):
+            for fn, wanted in revert_overrides.listfiles(layer, None):
+                if not wanted:
+                    continue
+                try:
+                    with open(fn, encoding="utf-8") as fh:
+                        lines = fh.readlines()
+                except UnicodeDecodeError:
+                    continue
+                self._assert_same_as_reference(lines, fn)
+                files += 1
+        self.assertGreaterEqual(files, 10)
+
+    def test_reference_generated(self):
+        # Lines put together from the rules' own keywords and the characters
+        # around them, so that rules overlap and complete one another.
+        rng = random.Random(0)
+        names = [*reference.packagevars, "SRC_URI", "do_install", "${PN}", "x.y"]
+        overrides = [*reference.vars, *reference.shortvars, "arch", "mipsel2"]
+        overrides += ["${PN}", "${PN}-dev", "ontarget", "tune-cortexa53"]
+        lead = ["", "", "", "#", " ", "\t", "-", "+", "'", '"', "${", 'X = "']
+        glue = [":", ":", ":", "_", " ", "(", "'", '"', "[", "<", "{", "%", "\\"]
+        glue += ["*", ".", "}", "$"]
+        lines = []
+        for _ in range(4000):
+            line = ""
+            for _ in range(rng.choice([1, 1, 2, 3])):
+                line += rng.choice(lead) + rng.choice(names)
+                for _ in range(rng.randint(0, 3)):
+                    line += rng.choice(glue) + rng.choice(overrides)
+                line += rng.choice(glue) + rng.choice([' = "x"', " ", "", "() {", ":"])
+            if rng.random() < 0.05:
+                line += " " + rng.choice([*reference.skips, "ptest_append"])
+            lines.append(line + rng.choice(["\n", "\n", " \\\n", ""]))
+        lines += [sub + "\n" for sub in reference.subs]
+        self._assert_same_as_reference(lines, "generated")
+
+    def test_convert(self):
+        for name, text in CORPUS.items():
+            self.assertEqual(revert_overrides.convert(text), EXPECTED[name])
+            out = io.StringIO()
+            revert_overrides.convertstream(io.StringIO(text), out)
+            self.assertEqual(out.getvalue(), EXPECTED[name])
+        # Line endings are normalized, as reading a file in text mode does.
+        self.assertEqual(
+            revert_overrides.convert("A:append = 1\r\n"), "A_append = 1\n"
+        )
+
+    def test_processtree(self):
+        for jobs in (1, 2):
+            with tempfile.TemporaryDirectory() as d:
+                _write_tree(d, CORPUS)
+                counts = revert_overrides.processtree([d], jobs=jobs)
+                self.assertEqual(_read_tree(d), EXPECTED)
+            self.assertEqual(
+                counts, {"scanned": 3, "changed": 3, "skipped": 0, "uptodate": 0}
+            )
+
+
+if __name__ == "__main__":
+    unittest.main()